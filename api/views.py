@@ -12,7 +12,7 @@ from busstops.models import Operator, Service, StopPoint
 from bustimes.models import StopTime, Trip
 from bustimes.utils import contiguous_stoptimes_only
 from vehicles.models import Livery, Vehicle, VehicleJourney, VehicleType
-from vehicles.utils import redis_client
+from vehicles.history import get_locations
 
 from sql_util.utils import Exists
 
@@ -137,8 +137,7 @@ class VehicleJourneyViewSet(viewsets.ReadOnlyModelViewSet):
             instance.trip.stops = TripViewSet.get_stops(instance.trip)
             extra_data["times"] = serializers.TripSerializer().get_times(instance.trip)
 
-        if redis_client:
-            locations = redis_client.lrange(instance.get_redis_key(), 0, -1)
+        if locations := get_locations(instance):
             locations = [
                 struct.unpack("I 2f ?h ?h", location) for location in locations
             ]
@@ -67,6 +67,7 @@ urlpatterns = [
     path("maintenance", TemplateView.as_view(template_name="maintenance.html")),
     path("data", TemplateView.as_view(template_name="data.html")),
     path("status", views.status),
+    path("status/metrics.json", views.ingest_metrics),
     path("timetable-source-stats.json", views.timetable_source_stats),
     path("stats.json", views.stats),
     path("robots.txt", views.robots_txt),
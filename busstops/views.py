@@ -50,6 +50,7 @@ from bustimes.models import Route, StopTime, Trip
 from departures import live
 from disruptions.models import Consequence, Situation
 from fares.models import FareTable
+from vehicles.ingest_metrics import get_metrics
 from vehicles.models import Vehicle
 from vehicles.utils import redis_client
 from vosa.models import Registration
@@ -278,6 +279,10 @@ def status(request):
     )
 
 
+def ingest_metrics(request):
+    return JsonResponse(get_metrics())
+
+
 def stats(request):
     return JsonResponse(cache.get("vehicle-tracking-stats", []), safe=False)
 
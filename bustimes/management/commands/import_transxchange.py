@@ -47,6 +47,7 @@ from ...models import (
     Trip,
     VehicleType,
 )
+from ...service_index import update_service_index
 
 logger = logging.getLogger(__name__)
 
@@ -471,6 +472,8 @@ class Command(BaseCommand):
 
         services.update(modified_at=Now())
 
+        update_service_index(self.service_ids)
+
     def get_bank_holiday(self, bank_holiday_name: str):
         if self.bank_holidays is None:
             self.bank_holidays = BankHoliday.objects.in_bulk(field_name="name")
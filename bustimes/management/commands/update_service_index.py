@@ -0,0 +1,16 @@
+from itertools import batched
+
+from django.core.management.base import BaseCommand
+
+from busstops.models import Service
+
+from ...service_index import update_service_index
+
+
+class Command(BaseCommand):
+    help = "(Re)build the index used by live vehicle importers to find services"
+
+    def handle(self, **options):
+        service_ids = Service.objects.filter(current=True).values_list("id", flat=True)
+        for chunk in batched(service_ids.iterator(), 1000):
+            update_service_index(chunk)
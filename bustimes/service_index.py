@@ -0,0 +1,147 @@
+"""An index of current services by operator, line name and stop,
+kept in Redis so that live vehicle importers can usually find
+the service a journey belongs to without a series of complex queries.
+
+Keys look like "service_index:FECS|42" and "service_index:^First Eastern Counties|42|290"
+(operator NOC or ^parent, lower case line name, and optionally the first 3 characters
+of an ATCO code of a stop on the service) and are sets of service ids.
+"""
+
+from collections import defaultdict
+
+from redis.exceptions import ConnectionError
+
+from busstops.models import Service, ServiceCode, StopUsage
+from vehicles.utils import redis_client
+
+from .models import Route
+
+VERSION_KEY = "service_index_version"
+KEYS_KEY = "service_index_keys"  # hash of service id: keys it's a member of
+
+
+def normalise_line_name(line_name: str) -> str:
+    return line_name.replace("_", " ").strip().lower()
+
+
+def get_operator_keys(operators) -> list:
+    keys = []
+    for operator in operators:
+        keys.append(operator.noc)
+        if operator.parent:
+            keys.append(f"^{operator.parent}")
+    return keys
+
+
+def get_stop_prefixes(destination_ref: str) -> list:
+    prefixes = [destination_ref[:3]]
+    # cope with a missing leading zero
+    if (
+        destination_ref.isdigit()
+        and destination_ref[0] != "0"
+        and destination_ref[3] == "0"
+    ):
+        prefixes.append(f"0{destination_ref}"[:3])
+    return prefixes
+
+
+def get_keys(operator_keys, line_names, stop_prefixes=None) -> list:
+    keys = []
+    for operator_key in operator_keys:
+        for line_name in line_names:
+            if stop_prefixes is None:
+                keys.append(f"service_index:{operator_key}|{line_name}")
+            else:
+                keys += [
+                    f"service_index:{operator_key}|{line_name}|{prefix}"
+                    for prefix in stop_prefixes
+                ]
+    return keys
+
+
+def update_service_index(service_ids):
+    """Called after services have been imported or changed"""
+
+    if not redis_client or not service_ids:
+        return
+
+    services = Service.objects.filter(id__in=service_ids, current=True)
+    services = services.prefetch_related("operator").only("id", "line_name")
+
+    line_names = defaultdict(set)
+    for service_id, line_name in (
+        Route.objects.filter(service__in=services)
+        .values_list("service", "line_name")
+        .distinct()
+    ):
+        if line_name:
+            line_names[service_id].add(normalise_line_name(line_name))
+    for service_id, code in ServiceCode.objects.filter(
+        service__in=services, scheme__endswith="SIRI"
+    ).values_list("service", "code"):
+        line_names[service_id].add(normalise_line_name(code))
+
+    stop_prefixes = defaultdict(set)
+    for service_id, stop_id in (
+        StopUsage.objects.filter(service__in=services)
+        .values_list("service", "stop")
+        .distinct()
+    ):
+        stop_prefixes[service_id].add(stop_id[:3])
+
+    new_keys = {}
+    for service in services:
+        service_line_names = line_names[service.id]
+        if service.line_name:
+            service_line_names.add(normalise_line_name(service.line_name))
+        operator_keys = get_operator_keys(service.operator.all())
+        new_keys[service.id] = get_keys(operator_keys, service_line_names) + get_keys(
+            operator_keys, service_line_names, stop_prefixes[service.id]
+        )
+
+    service_ids = list(service_ids)
+
+    try:
+        old_keys = redis_client.hmget(KEYS_KEY, service_ids)
+
+        pipeline = redis_client.pipeline(transaction=False)
+        for service_id, keys in zip(service_ids, old_keys):
+            if keys:
+                for key in keys.decode().split("\n"):
+                    pipeline.srem(key, service_id)
+            if keys := new_keys.get(service_id):
+                for key in keys:
+                    pipeline.sadd(key, service_id)
+                pipeline.hset(KEYS_KEY, service_id, "\n".join(keys))
+            else:
+                pipeline.hdel(KEYS_KEY, service_id)
+        pipeline.incr(VERSION_KEY)
+        pipeline.execute()
+    except ConnectionError:
+        pass
+
+
+def get_service_ids(operator_keys, line_names, stop_prefixes=None) -> set:
+    """Ids of current (or recently current) services
+    matching any combination of operator and line name (and stop prefix)
+    """
+
+    operator_keys = set(filter(None, operator_keys))
+    if not redis_client or not operator_keys:
+        return set()
+
+    line_names = {normalise_line_name(line_name) for line_name in line_names}
+    keys = get_keys(operator_keys, line_names, stop_prefixes)
+    try:
+        return {int(service_id) for service_id in redis_client.sunion(keys)}
+    except ConnectionError:
+        return set()
+
+
+def get_version():
+    if not redis_client:
+        return
+    try:
+        return redis_client.get(VERSION_KEY)
+    except ConnectionError:
+        return
@@ -0,0 +1,6 @@
+from huey import crontab
+from huey.contrib.djhuey import db_periodic_task
+
+from departures import gtfsr
+
+nta_trip_updates = db_periodic_task(crontab(minute="*"))(gtfsr.update_trip_updates)
@@ -1,12 +1,15 @@
 import os
 from datetime import date, datetime, timedelta, timezone
+from unittest.mock import patch
 
+import fakeredis
 from django.test import TestCase
 from vcr import use_cassette
 
-from busstops.models import DataSource, Service
+from busstops.models import DataSource, Operator, Service, StopPoint, StopUsage
 from vehicles.models import Livery, Vehicle, VehicleCode
 
+from . import service_index, trip_index
 from .models import Calendar, CalendarDate, Garage, Route, StopTime, Trip
 from .utils import get_routes
 
@@ -395,3 +398,82 @@ class BusTimesTest(TestCase):
         self.assertEqual(str(garage), "Lowestoft Town")
         garage.name = "LOW"
         self.assertEqual(str(garage), "LOW")
+
+    def test_service_index(self):
+        operator = Operator.objects.create(noc="FECS", name="First", parent="First")
+        service = Service.objects.create(line_name="X1")
+        service.operator.add(operator)
+        StopPoint.objects.create(atco_code="2900A181", common_name="", active=True)
+        StopUsage.objects.create(
+            service=service, stop_id="2900A181", direction="", order=0
+        )
+        Route.objects.create(
+            source=DataSource.objects.create(), service=service, line_name="x1_"
+        )
+
+        with patch("bustimes.service_index.redis_client", fakeredis.FakeStrictRedis()):
+            service_index.update_service_index([service.id])
+            version = service_index.get_version()
+
+            self.assertEqual(
+                service_index.get_service_ids(["FECS"], ["X1"]), {service.id}
+            )
+            self.assertEqual(
+                service_index.get_service_ids(["^First"], ["x1"], ["290"]),
+                {service.id},
+            )
+            self.assertEqual(
+                service_index.get_service_ids(["FECS"], ["X1"], ["340"]), set()
+            )
+            self.assertEqual(service_index.get_service_ids(["FSCE"], ["X1"]), set())
+
+            service.line_name = "X2"
+            service.save(update_fields=["line_name"])
+            Route.objects.update(line_name="X2")
+            service_index.update_service_index([service.id])
+
+            self.assertEqual(service_index.get_service_ids(["FECS"], ["X1"]), set())
+            self.assertEqual(
+                service_index.get_service_ids(["FECS"], ["X2"]), {service.id}
+            )
+            self.assertNotEqual(service_index.get_version(), version)
+
+    def test_trip_index(self):
+        def trip(
+            id, start, code, block="", inbound=False, destination=None, calendar=1
+        ):
+            return (
+                id,
+                timedelta(seconds=start),
+                timedelta(seconds=start + 3600),
+                inbound,
+                code,
+                "",
+                block,
+                destination,
+                calendar,
+            )
+
+        index = trip_index.TripIndex(
+            [
+                trip(1, 32400, "0900"),
+                trip(2, 32400, "0900", calendar=2),
+                trip(3, 36000, "1000", block="7", inbound=True),
+                trip(4, 36000, "1000", block="8", inbound=True, destination="2900A"),
+            ],
+            {2},
+            None,
+        )
+        self.assertEqual(len(index), 4)
+
+        # tie broken in favour of the trip that runs on the date
+        self.assertEqual(index.get_trip_id(code="0900"), 2)
+        self.assertEqual(index.get_trip_id(starts=[32400]), 2)
+        self.assertIsNone(index.get_trip_id(code="0930"))
+
+        self.assertEqual(index.get_trip_id(code="1000", block="8"), 4)
+        self.assertEqual(
+            index.get_trip_id(starts=[36000], inbound=False, destination="2900A"), 4
+        )
+        self.assertEqual(index.get_trip_id(code="1000", ends=[39600]), 3)
+        self.assertIsNone(index.get_trip_id(code="0900", inbound=True))
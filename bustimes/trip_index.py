@@ -0,0 +1,219 @@
+"""An in-memory index of a service's trips on a particular date,
+so that live vehicle importers can match a journey to a trip (see get_trip)
+without a scored database query per journey.
+
+An index is loaded the first time it's needed,
+and loaded again if the service's modified_at changes (after a timetable import)
+or it gets old.
+"""
+
+from array import array
+from collections import OrderedDict, defaultdict
+from datetime import date, timedelta
+from threading import Lock
+
+from django.utils import timezone
+
+from .models import Trip
+
+MAX_INDEXES = 2000
+MAX_AGE = timedelta(hours=1)
+
+indexes = OrderedDict()  # (service id, date): TripIndex, least recently used first
+# (run_live_feeds runs importers in several threads)
+indexes_lock = Lock()
+
+
+class TripIndex:
+    __slots__ = (
+        "modified_at",
+        "loaded_at",
+        "ids",
+        "starts",
+        "ends",
+        "inbound",
+        "blocks",
+        "destinations",
+        "running",
+        "by_code",
+        "by_start",
+    )
+
+    def __init__(self, trips, running_calendar_ids, modified_at):
+        self.modified_at = modified_at
+        self.loaded_at = timezone.now()
+
+        self.ids = array("l")
+        self.starts = array("l")  # seconds since midnight
+        self.ends = array("l")
+        self.inbound = array("b")
+        self.running = array("b")  # 1 if the trip's calendar runs on the date
+        self.blocks = []
+        self.destinations = []
+
+        by_code = defaultdict(list)
+        by_start = defaultdict(list)
+
+        for i, trip in enumerate(trips):
+            (
+                trip_id,
+                start,
+                end,
+                inbound,
+                ticket_machine_code,
+                vehicle_journey_code,
+                block,
+                destination_id,
+                calendar_id,
+            ) = trip
+            start = int(start.total_seconds())
+            self.ids.append(trip_id)
+            self.starts.append(start)
+            self.ends.append(int(end.total_seconds()))
+            self.inbound.append(inbound)
+            self.running.append(calendar_id in running_calendar_ids)
+            self.blocks.append(block)
+            self.destinations.append(destination_id)
+            if ticket_machine_code:
+                by_code[ticket_machine_code].append(i)
+            if vehicle_journey_code and vehicle_journey_code != ticket_machine_code:
+                by_code[vehicle_journey_code].append(i)
+            by_start[start].append(i)
+
+        self.by_code = dict(by_code)
+        self.by_start = dict(by_start)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_trip_id(
+        self,
+        code=None,
+        block=None,
+        starts=(),
+        ends=(),
+        inbound=None,
+        destination=None,
+    ):
+        """Same ranking as the old scored query in get_trip:
+        trips matching the code or start time (and the direction or destination)
+        are scored by how many of the things they match,
+        and a tie is broken in favour of trips whose calendar runs on the date
+        """
+
+        code_matches = set(self.by_code.get(code, ())) if code else set()
+
+        if code_matches or starts:
+            candidates = code_matches.copy()
+            for start in starts:
+                candidates.update(self.by_start.get(start, ()))
+        elif code:
+            return
+        else:
+            candidates = range(len(self.ids))
+
+        scored = []
+        for i in candidates:
+            if inbound is not None and not (
+                self.inbound[i] == inbound
+                or destination
+                and self.destinations[i] == destination
+            ):
+                continue
+            score = 0
+            if i in code_matches:
+                score += 1
+            if block and self.blocks[i] == block:
+                score += 1
+            if starts and self.starts[i] in starts:
+                score += 1
+            if ends and self.ends[i] in ends:
+                score += 1
+            if inbound is not None and self.inbound[i] == inbound:
+                score += 1
+            if destination and self.destinations[i] == destination:
+                score += 1
+            scored.append((-score, self.ids[i], i))
+
+        if not scored:
+            return
+
+        scored.sort()
+        if len(scored) > 1 and scored[0][0] == scored[1][0]:
+            for item in scored:
+                if self.running[item[2]]:
+                    return item[1]
+
+        return scored[0][1]
+
+
+def get_modified_at(service):
+    if "modified_at" in service.get_deferred_fields():
+        return (
+            type(service)
+            .objects.filter(id=service.id)
+            .values_list("modified_at", flat=True)
+            .first()
+        )
+    return service.modified_at
+
+
+def load_index(service, date: date, modified_at) -> TripIndex:
+    from .utils import get_calendars, get_routes
+
+    routes = get_routes(service.route_set.select_related("source"), date)
+    if routes:
+        trips = Trip.objects.filter(route__in=routes)
+    else:
+        trips = Trip.objects.filter(route__service=service)
+    trips = list(
+        trips.order_by("id").values_list(
+            "id",
+            "start",
+            "end",
+            "inbound",
+            "ticket_machine_code",
+            "vehicle_journey_code",
+            "block",
+            "destination",
+            "calendar",
+        )
+    )
+
+    calendar_ids = {trip[-1] for trip in trips if trip[-1] is not None}
+    if calendar_ids:
+        running_calendar_ids = set(
+            get_calendars(date, calendar_ids).values_list("id", flat=True)
+        )
+    else:
+        running_calendar_ids = set()
+
+    return TripIndex(trips, running_calendar_ids, modified_at)
+
+
+def get_index(service, date: date) -> TripIndex:
+    key = (service.id, date)
+    modified_at = get_modified_at(service)
+
+    with indexes_lock:
+        index = indexes.get(key)
+    if (
+        index is None
+        or index.modified_at != modified_at
+        or timezone.now() - index.loaded_at > MAX_AGE
+    ):
+        # (loaded outside the lock, so threads don't wait for each other's queries)
+        index = load_index(service, date, modified_at)
+
+    with indexes_lock:
+        indexes[key] = index
+        indexes.move_to_end(key)
+        if len(indexes) > MAX_INDEXES:
+            indexes.popitem(last=False)
+
+    return index
+
+
+def clear():
+    with indexes_lock:
+        indexes.clear()
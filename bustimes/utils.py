@@ -5,18 +5,17 @@ from itertools import pairwise
 
 from ciso8601 import parse_datetime
 from django.db.models import (
-    Case,
     DateTimeField,
     ExpressionWrapper,
     F,
     Q,
     Value,
-    When,
     OuterRef,
 )
 from django.utils import timezone
 from sql_util.utils import Exists
 
+from . import trip_index
 from .models import Calendar, CalendarBankHoliday, CalendarDate, StopTime, Trip, Route
 
 differ = Differ(charjunk=lambda _: True)
@@ -295,25 +294,21 @@ def get_trip(
     if not date:
         date = (departure_time or datetime).date()
 
-    routes = get_routes(journey.service.route_set.select_related("source"), date)
-    if routes:
-        trips = Trip.objects.filter(route__in=routes)
-    else:
-        trips = Trip.objects.filter(route__service=journey.service)
-
-    if destination_ref and " " not in destination_ref and destination_ref[:3].isdigit():
-        destination = Q(destination=destination_ref)
-    else:
-        destination = Q()
-
-    if journey.direction == "outbound":
-        direction = Q(inbound=False)
-    elif journey.direction == "inbound":
-        direction = Q(inbound=True)
-    else:
-        direction = Q()
+    # special strategy for TfL data
+    if (
+        operator_ref == "TFLO"
+        and departure_time
+        and origin_ref
+        and destination_ref
+        and " " not in destination_ref
+        and destination_ref[:3].isdigit()
+    ):
+        routes = get_routes(journey.service.route_set.select_related("source"), date)
+        if routes:
+            trips = Trip.objects.filter(route__in=routes)
+        else:
+            trips = Trip.objects.filter(route__service=journey.service)
 
-    if departure_time:
         start_time = timezone.localtime(departure_time)
         start = Q(start=timedelta(hours=start_time.hour, minutes=start_time.minute))
         if start_time.hour < 6:
@@ -322,25 +317,7 @@ def get_trip(
                     days=1, hours=start_time.hour, minutes=start_time.minute
                 )
             )
-    elif len(journey_code) == 4 and journey_code.isdigit() and int(journey_code) < 2400:
-        hours = int(journey_code[:-2])
-        minutes = int(journey_code[-2:])
-        start = Q(start=timedelta(hours=hours, minutes=minutes))
-    else:
-        start = Q()
-
-    if arrival_time:
-        arrival_time = timezone.localtime(arrival_time)
-        end = Q(end=timedelta(hours=arrival_time.hour, minutes=arrival_time.minute))
-        if arrival_time.hour < 6:
-            end |= Q(
-                end=timedelta(
-                    days=1, hours=arrival_time.hour, minutes=arrival_time.minute
-                )
-            )
 
-    # special strategy for TfL data
-    if operator_ref == "TFLO" and departure_time and origin_ref and destination:
         try:
             try:
                 trips = trips.filter(
@@ -355,43 +332,51 @@ def get_trip(
         except (Trip.DoesNotExist, Trip.MultipleObjectsReturned):
             return
 
-    if journey.code:
-        code = Q(ticket_machine_code=journey.code) | Q(
-            vehicle_journey_code=journey.code
-        )
+    if destination_ref and " " not in destination_ref and destination_ref[:3].isdigit():
+        destination = destination_ref
     else:
-        code = Q()
-
-    if operator_ref == "NT" and len(journey_code) > 30:
-        code = Q()
-
-    score = 0
-    if code:
-        score += Case(When(code, then=1), default=0)
-    if block_ref:
-        score += Case(When(block=block_ref, then=1), default=0)
-    if start:
-        score += Case(When(start, then=1), default=0)
-    if arrival_time:
-        score += Case(When(end, then=1), default=0)
-    if direction:
-        score += Case(When(direction, then=1), default=0)
-    if destination:
-        score += Case(When(destination, then=1), default=0)
+        destination = None
 
-    condition = code | start
-    if direction:
-        condition &= destination | direction
+    if journey.direction == "outbound":
+        inbound = False
+    elif journey.direction == "inbound":
+        inbound = True
+    else:
+        inbound = None
 
-    trips = trips.filter(condition).annotate(score=score).order_by("-score")
+    if departure_time:
+        start_time = timezone.localtime(departure_time)
+        starts = [start_time.hour * 3600 + start_time.minute * 60]
+        if start_time.hour < 6:
+            starts.append(86400 + starts[0])
+    elif len(journey_code) == 4 and journey_code.isdigit() and int(journey_code) < 2400:
+        starts = [int(journey_code[:-2]) * 3600 + int(journey_code[-2:]) * 60]
+    else:
+        starts = []
 
-    if trips:
-        if len(trips) > 1 and trips[0].score == trips[1].score:
-            filtered_trips = trips.filter(calendar__in=get_calendars(date))
-            if filtered_trips:
-                trips = filtered_trips
+    if arrival_time:
+        arrival_time = timezone.localtime(arrival_time)
+        ends = [arrival_time.hour * 3600 + arrival_time.minute * 60]
+        if arrival_time.hour < 6:
+            ends.append(86400 + ends[0])
+    else:
+        ends = []
 
-        return trips[0]
+    code = journey.code
+    if operator_ref == "NT" and len(journey_code) > 30:
+        code = None
+
+    index = trip_index.get_index(journey.service, date)
+    trip_id = index.get_trip_id(
+        code=code,
+        block=block_ref,
+        starts=starts,
+        ends=ends,
+        inbound=inbound,
+        destination=destination,
+    )
+    if trip_id:
+        return Trip.objects.filter(id=trip_id).first()
 
 
 def contiguous_stoptimes_only(stoptimes, trip_id):
@@ -489,11 +489,10 @@ class TripDetailView(DetailView):
             if stops[-1].stop:
                 context["destination"] = stops[-1].stop.locality
 
-            if self.object.route.source.name == "Realtime Transport Operators":
-                trip_update = gtfsr.get_trip_update(self.object)
-                if trip_update:
-                    context["trip_update"] = trip_update
-                    gtfsr.apply_trip_update(stops, trip_update)
+            trip_update = gtfsr.get_trip_update(self.object)
+            if trip_update:
+                context["trip_update"] = trip_update
+                gtfsr.apply_trip_update(stops, trip_update)
 
         context["stops"] = stops
         self.object.stops = stops
@@ -713,17 +712,26 @@ def tfl_vehicle(request, reg: str):
 
 @require_GET
 def trip_updates(request):
-    feed = gtfsr.get_feed_entities()
+    source_id = request.GET.get("source") or gtfsr.get_nta_source_id()
+    if source_id:
+        try:
+            source_id = int(source_id)
+        except ValueError:
+            raise Http404
+        timestamp, entities = gtfsr.get_all_trip_updates(source_id)
+    else:
+        timestamp, entities = None, {}
 
-    journey_codes = feed["entity"].keys()
-    trips = Trip.objects.filter(ticket_machine_code__in=journey_codes)
+    trips = Trip.objects.filter(
+        ticket_machine_code__in=entities.keys(), route__source=source_id
+    )
     operators = Operator.objects.filter(
         service__route__in=set(trip.route_id for trip in trips)
     ).distinct()
     trips = {trip.ticket_machine_code: trip for trip in trips}
 
     trip_updates = [
-        (entity, trips.get(trip_id)) for trip_id, entity in feed["entity"].items()
+        (entity, trips.get(trip_id)) for trip_id, entity in entities.items()
     ]
 
     return render(
@@ -732,7 +740,7 @@ def trip_updates(request):
         {
             "trips": len(trips),
             "operators": operators,
-            "timestamp": datetime.fromtimestamp(int(feed["header"]["timestamp"])),
+            "timestamp": timestamp and datetime.fromtimestamp(timestamp),
             "trip_updates": trip_updates,
         },
     )
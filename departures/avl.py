@@ -1,5 +1,4 @@
-import json
-
+from vehicles.location_encoding import decode_location
 from vehicles.utils import redis_client
 
 
@@ -18,6 +17,6 @@ def get_tracking(stop, services):
     vehicle_locations = redis_client.mget(
         [f"vehicle{int(vehicle_id)}" for vehicle_id in vehicle_ids]
     )
-    vehicle_locations = [json.loads(item) for item in vehicle_locations if item]
+    vehicle_locations = [decode_location(item) for item in vehicle_locations if item]
 
     return vehicle_locations
@@ -1,20 +1,50 @@
+"""GTFS-RT trip updates.
+
+The whole TripUpdates feed of a source is fetched in the background - by a periodic
+task for the NTA (Ireland) feed (see bustimes.tasks), and by import_gtfsr for feeds
+configured in a DataSource's settings - and each entity is stored as raw protobuf
+bytes in a Redis hash per timetable source, keyed by trip id (ticket machine code).
+So pages only have to fetch and decode the few trips they need (with HMGET) -
+as dicts like json_format.MessageToDict would produce.
+"""
+
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import requests
 from django.conf import settings
-from django.core.cache import cache
 from google.protobuf import json_format
 from google.transit import gtfs_realtime_pb2
+from redis.exceptions import ConnectionError
 
+from busstops.models import DataSource
 from bustimes.formatting import format_timedelta
 from vehicles.utils import redis_client
 
+NTA_SOURCE_NAME = "Realtime Transport Operators"
+EXPIRE = 300  # seconds - in case the poller stops
+
+
+def get_trip_updates_key(source_id) -> str:
+    # trip id: serialised FeedEntity
+    return f"gtfsr_trip_updates:{source_id}"
+
+
+def get_version_key(source_id) -> str:
+    # the feed header's timestamp
+    return f"gtfsr_trip_updates_version:{source_id}"
+
+
+def get_nta_source_id() -> int | None:
+    return (
+        DataSource.objects.filter(name=NTA_SOURCE_NAME)
+        .values_list("id", flat=True)
+        .first()
+    )
+
 
 def _get_feed():
     if settings.NTA_API_KEY:
-        if not redis_client.set("ntaie_lock", 1, ex=60, nx=True):
-            return
         url = "https://api.nationaltransport.ie/gtfsr/v2/TripUpdates"
         response = requests.get(
             url, headers={"x-api-key": settings.NTA_API_KEY}, timeout=10
@@ -25,27 +55,112 @@ def _get_feed():
             return feed
 
 
-def get_feed_entities() -> dict:
+def save_trip_updates(source_id, feed) -> int:
+    """Replace a source's stored trip updates with those in a FeedMessage"""
+
+    trip_updates = {
+        entity.trip_update.trip.trip_id: entity.SerializeToString()
+        for entity in feed.entity
+        if entity.trip_update.trip.trip_id
+    }
+
+    # (replace the whole hash at once, so trips no longer in the feed disappear)
+    key = get_trip_updates_key(source_id)
+    tmp_key = f"{key}_tmp"
+    pipe = redis_client.pipeline()
+    pipe.delete(tmp_key)
+    if trip_updates:
+        pipe.hset(tmp_key, mapping=trip_updates)
+        pipe.expire(tmp_key, EXPIRE)
+        pipe.rename(tmp_key, key)
+    else:
+        pipe.delete(key)
+    pipe.set(get_version_key(source_id), feed.header.timestamp, ex=EXPIRE)
+    pipe.execute()
+
+    return len(trip_updates)
+
+
+def update_trip_updates() -> int:
+    """Fetch the NTA feed and replace the stored trip updates"""
+
+    if not redis_client:
+        return 0
+
     feed = _get_feed()
-    if feed:
-        feed = json_format.MessageToDict(feed)
-        if "entity" in feed:
-            feed["entity"] = {
-                entity["tripUpdate"]["trip"]["tripId"]: entity
-                for entity in feed["entity"]
-                if "tripId" in entity["tripUpdate"]["trip"]
-            }
-            cache.set("ntaie", feed, 300)  # cache for 5 minutes
-            return feed
-    return cache.get("ntaie")
+    if not feed:
+        return 0
+
+    source_id = get_nta_source_id()
+    if not source_id:
+        return 0
+
+    return save_trip_updates(source_id, feed)
+
+
+def decode_trip_update(value: bytes) -> dict:
+    entity = gtfs_realtime_pb2.FeedEntity()
+    entity.ParseFromString(value)
+    return json_format.MessageToDict(entity)
+
+
+def get_sources_with_trip_updates(source_ids) -> set:
+    """Which of the sources have trip updates at the moment"""
+
+    source_ids = list(set(source_ids))
+    if not source_ids or not redis_client:
+        return set()
+
+    pipe = redis_client.pipeline(transaction=False)
+    for source_id in source_ids:
+        pipe.exists(get_trip_updates_key(source_id))
+    try:
+        return {
+            source_id for source_id, exists in zip(source_ids, pipe.execute()) if exists
+        }
+    except ConnectionError:
+        return set()
+
+
+def get_trip_updates(source_id, trip_ids) -> dict:
+    """{trip id: trip update dict} for any of the trips in the source's feed"""
+
+    trip_ids = list(filter(None, set(trip_ids)))
+    if not trip_ids or not redis_client:
+        return {}
+
+    try:
+        values = redis_client.hmget(get_trip_updates_key(source_id), trip_ids)
+    except ConnectionError:
+        return {}
+
+    return {
+        trip_id: decode_trip_update(value)
+        for trip_id, value in zip(trip_ids, values)
+        if value
+    }
+
+
+def get_all_trip_updates(source_id) -> tuple[int | None, dict]:
+    """The feed header's timestamp and all the trip updates - for debugging"""
+
+    if not redis_client:
+        return None, {}
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(get_version_key(source_id))
+    pipe.hgetall(get_trip_updates_key(source_id))
+    timestamp, values = pipe.execute()
+
+    return int(timestamp) if timestamp else None, {
+        trip_id.decode(): decode_trip_update(value) for trip_id, value in values.items()
+    }
 
 
 def get_trip_update(trip) -> dict:
     trip_id = trip.ticket_machine_code
     if trip_id:
-        feed = get_feed_entities()
-        if feed and trip_id in feed["entity"]:
-            return feed["entity"][trip_id]
+        return get_trip_updates(trip.route.source_id, [trip_id]).get(trip_id)
 
 
 def get_expected_time(scheduled_time, stop_time_update, key):
@@ -114,14 +229,28 @@ def update_departure(departure: dict, trip_update: dict) -> None:
             departure["live"] = departure["time"] + delay
 
 
-def update_stop_departures(departures: list) -> None:
-    feed = get_feed_entities()
-    if not feed:
-        return
+def update_stop_departures(departures: list, route_sources: dict) -> None:
+    """route_sources is {route id: source id} for the routes of sources with trip
+    updates
+    """
 
+    trip_ids = {}  # source id: trip ids
     for departure in departures:
-        stop_time = departure["stop_time"]
-        trip = stop_time.trip
-        trip_update = feed["entity"].get(trip.ticket_machine_code)
-        if trip_update:
-            update_departure(departure, trip_update)
+        trip = departure["stop_time"].trip
+        if trip.route_id in route_sources:
+            trip_ids.setdefault(route_sources[trip.route_id], set()).add(
+                trip.ticket_machine_code
+            )
+    trip_updates = {
+        source_id: get_trip_updates(source_id, source_trip_ids)
+        for source_id, source_trip_ids in trip_ids.items()
+    }
+
+    for departure in departures:
+        trip = departure["stop_time"].trip
+        if trip.route_id in route_sources:
+            trip_update = trip_updates[route_sources[trip.route_id]].get(
+                trip.ticket_machine_code
+            )
+            if trip_update:
+                update_departure(departure, trip_update)
@@ -109,9 +109,16 @@ def get_departures(stop, services, when) -> dict:
     ).select_related("source")
     departures = None
 
-    gtfsr_available = any(
-        route.source.name == "Realtime Transport Operators" for route in routes
+    # {route id: source id} for routes whose sources have GTFS-RT trip updates
+    gtfsr_sources = gtfsr.get_sources_with_trip_updates(
+        route.source_id for route in routes
     )
+    gtfsr_routes = {
+        route.id: route.source_id
+        for route in routes
+        if route.source_id in gtfsr_sources
+    }
+    gtfsr_available = bool(gtfsr_routes)
 
     if not when and live_departures is None and not gtfsr_available:
         vehicle_locations = avl.get_tracking(stop, services)
@@ -185,7 +192,7 @@ def get_departures(stop, services, when) -> dict:
     one_hour_ago = now - one_hour
 
     if departures and gtfsr_available:
-        gtfsr.update_stop_departures(departures)
+        gtfsr.update_stop_departures(departures, gtfsr_routes)
 
     if when or live_departures or type(stop) is not StopPoint:
         pass
@@ -101,16 +101,12 @@ class GTFSRTTest(TestCase):
         fakeredis.FakeStrictRedis(),
     )
     def test_nta_ie(self):
-        with override_settings(
-            NTA_API_KEY="poopants",
-            CACHES={
-                "default": {
-                    "BACKEND": "django.core.cache.backends.redis.RedisCache",
-                    "LOCATION": "redis://",
-                    "OPTIONS": {"connection_class": fakeredis.FakeConnection},
-                }
-            },
-        ), vcr.use_cassette("fixtures/vcr/nta_ie_trip_updates.yaml"):
+        with override_settings(NTA_API_KEY="poopants"), vcr.use_cassette(
+            "fixtures/vcr/nta_ie_trip_updates.yaml"
+        ):
+            # (the periodic task)
+            self.assertEqual(gtfsr.update_trip_updates(), 3051)
+
             # trip with some delays
             with self.assertNumQueries(7):
                 response = self.client.get(self.trip.get_absolute_url())
@@ -120,6 +116,14 @@ class GTFSRTTest(TestCase):
             self.assertContains(response, "3051 trip_updates")
             self.assertContains(response, "2 matching trips")
 
+            response = self.client.get(
+                f"/trip_updates?source={self.trip.route.source_id}"
+            )
+            self.assertContains(response, "3051 trip_updates")
+            self.assertEqual(
+                self.client.get("/trip_updates?source=poo").status_code, 404
+            )
+
             response = self.client.get("/stops/8250DB000429?date=2022-05-04&time=05:00")
             self.assertContains(response, "Ex&shy;pected")
             self.assertContains(response, "Sched&shy;uled")
@@ -133,8 +137,11 @@ class GTFSRTTest(TestCase):
             self.assertTrue(response.context["stops_json"])
 
     def test_no_feed(self):
-        with patch("departures.gtfsr.get_feed_entities", return_value=None):
-            self.assertIsNone(gtfsr.update_stop_departures(()))
+        self.assertEqual(gtfsr.update_trip_updates(), 0)
+        self.assertIsNone(gtfsr.update_stop_departures((), {}))
+        source_id = self.trip.route.source_id
+        self.assertEqual(gtfsr.get_trip_updates(source_id, ["4323_12791"]), {})
+        self.assertEqual(gtfsr.get_sources_with_trip_updates([source_id]), set())
 
     def test_get_expected_time(self):
         update = {
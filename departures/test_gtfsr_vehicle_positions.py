@@ -6,6 +6,7 @@ from django.test import TestCase, override_settings
 
 from busstops.models import DataSource, Operator, Service
 from bustimes.models import Calendar, Route, Trip
+from vehicles.management.commands import import_gtfsr
 from vehicles.management.commands.import_gtfsr_ie import Command
 from vehicles.models import Vehicle, VehicleJourney
 
@@ -81,3 +82,63 @@ class GTFSRTTest(TestCase):
 
         vehicle_journey = VehicleJourney.objects.filter(trip__isnull=False).get()
         self.assertEqual(str(vehicle_journey.datetime), "2024-06-06 01:55:00+00:00")
+
+    @patch(
+        "vehicles.management.import_live_vehicles.redis_client",
+        fakeredis.FakeStrictRedis(),
+    )
+    def test_generic_command(self):
+        DataSource.objects.filter(name="Realtime Transport Operators").update(
+            url="https://api.nationaltransport.ie/gtfsr/v2/Vehicles",
+            settings={
+                "headers": {"x-api-key": "poopants"},
+                "timezone": "Europe/Dublin",
+            },
+        )
+
+        with vcr.use_cassette(
+            "fixtures/vcr/nta_ie_vehicle_positions.yaml", allow_playback_repeats=True
+        ):
+            c = import_gtfsr.Command()
+            c.source_name = "Realtime Transport Operators"
+            c.do_source()
+            c.update()
+
+            self.assertEqual(VehicleJourney.objects.count(), 51)
+            self.assertEqual(self.trip_1.vehiclejourney_set.count(), 1)
+            self.assertEqual(self.trip_2.vehiclejourney_set.count(), 0)
+
+            vehicle_journey = VehicleJourney.objects.filter(trip__isnull=False).get()
+            self.assertEqual(str(vehicle_journey.datetime), "2024-06-06 01:55:00+00:00")
+            self.assertEqual(vehicle_journey.service, self.service)
+
+            # nothing has changed
+            with self.assertNumQueries(0):
+                self.assertEqual(c.get_items(), [])
+
+    @patch(
+        "vehicles.management.import_live_vehicles.redis_client",
+        fakeredis.FakeStrictRedis(),
+    )
+    def test_generic_command_trip_updates_error(self):
+        DataSource.objects.filter(name="Realtime Transport Operators").update(
+            url="https://api.nationaltransport.ie/gtfsr/v2/Vehicles",
+            settings={
+                "trip_updates_url": "https://api.nationaltransport.ie/gtfsr/v2/TripUpdates",
+                "headers": {"x-api-key": "poopants"},
+                "timezone": "Europe/Dublin",
+            },
+        )
+
+        # the trip updates request isn't in the cassette, so fails
+        with (
+            vcr.use_cassette("fixtures/vcr/nta_ie_vehicle_positions.yaml"),
+            self.assertLogs(import_gtfsr.__name__, "ERROR"),
+        ):
+            c = import_gtfsr.Command()
+            c.source_name = "Realtime Transport Operators"
+            c.do_source()
+            c.update()
+
+        # but vehicle positions are still imported
+        self.assertEqual(VehicleJourney.objects.count(), 51)
@@ -31,7 +31,13 @@ import StopPopup, { type Stop } from "./StopPopup";
 import { Route } from "./TripMap";
 import TripTimetable, { type Trip, tripFromJourney } from "./TripTimetable";
 import VehiclePopup from "./VehiclePopup";
-import { getBounds, getFont } from "./utils";
+import {
+  STREAMING_POLL_INTERVAL,
+  getBounds,
+  getFont,
+  mergeVehicles,
+  streamVehicles,
+} from "./utils";
 
 import { decodeTimeAwarePolyline } from "./time-aware-polyline";
 
@@ -530,6 +536,16 @@ export default function BigMap(
   const vehiclesTimeout = React.useRef<number | null>(null);
   const vehiclesAbortController = React.useRef<AbortController | null>(null);
   const vehiclesLength = React.useRef<number>(0);
+  // the live vehicle stream (see utils.streamVehicles), if any, and its query string
+  const vehiclesStream = React.useRef<{ query: string; close: () => void }>();
+  const vehiclesStreamOpen = React.useRef(false);
+
+  const closeVehiclesStream = React.useCallback(() => {
+    if (vehiclesStream.current) {
+      vehiclesStream.current.close();
+      vehiclesStream.current = undefined;
+    }
+  }, []);
 
   const loadStops = React.useCallback(() => {
     const _bounds = boundsRef.current as LngLatBounds;
@@ -591,6 +607,7 @@ export default function BigMap(
       if (!url) {
         return;
       }
+      const query = url;
 
       setLoadingBuses(true);
 
@@ -643,8 +660,39 @@ export default function BigMap(
               setLoadingBuses(false);
             }
 
+            if (vehiclesStream.current?.query !== query) {
+              closeVehiclesStream();
+              vehiclesStream.current = {
+                query,
+                close: streamVehicles<VehicleLocation>(
+                  query,
+                  (changed, removed) => {
+                    for (const item of changed) {
+                      if (
+                        (trip && trip.id === item.trip_id) ||
+                        journey?.vehicle_id === item.id
+                      ) {
+                        setTripVehicle(item);
+                      }
+                    }
+                    setVehicles((items) => {
+                      const merged = mergeVehicles(items, changed, removed);
+                      vehiclesLength.current = merged.length;
+                      return merged;
+                    });
+                  },
+                  (open) => {
+                    vehiclesStreamOpen.current = open;
+                  },
+                ),
+              };
+            }
+
             if (!document.hidden) {
-              vehiclesTimeout.current = window.setTimeout(loadVehicles, 12000); // 12 seconds
+              vehiclesTimeout.current = window.setTimeout(
+                loadVehicles,
+                vehiclesStreamOpen.current ? STREAMING_POLL_INTERVAL : 12000, // 12 seconds
+              );
             }
           },
           () => {
@@ -657,9 +705,19 @@ export default function BigMap(
           // setLoadingBuses(false);
         });
     },
-    [props.mode, props.noc, trip, journey, props.vehicleId],
+    [
+      props.mode,
+      props.noc,
+      trip,
+      journey,
+      props.vehicleId,
+      closeVehiclesStream,
+    ],
   );
 
+  // close the stream when leaving the map
+  React.useEffect(() => closeVehiclesStream, [closeVehiclesStream]);
+
   React.useEffect(() => {
     if (props.tripId) {
       // trip mode
@@ -759,7 +817,9 @@ export default function BigMap(
   // (re)load vehicles on tab visibility change
   React.useEffect(() => {
     const handleVisibilityChange = () => {
-      if (!document.hidden) {
+      if (document.hidden) {
+        closeVehiclesStream();
+      } else {
         loadVehicles();
       }
     };
@@ -769,7 +829,7 @@ export default function BigMap(
     return () => {
       window.removeEventListener("visibilitychange", handleVisibilityChange);
     };
-  }, [loadVehicles]);
+  }, [loadVehicles, closeVehiclesStream]);
 
   const [clickedVehicleMarkerId, setClickedVehicleMarker] = React.useState<
     number | undefined
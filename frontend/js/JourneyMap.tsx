@@ -18,7 +18,12 @@ import VehicleMarker, {
   getClickedVehicleMarkerId,
 } from "./VehicleMarker";
 import VehiclePopup from "./VehiclePopup";
-import { getBounds, getFont } from "./utils";
+import {
+  STREAMING_POLL_INTERVAL,
+  getBounds,
+  getFont,
+  streamVehicles,
+} from "./utils";
 
 type VehicleJourneyLocation = {
   id: number;
@@ -363,13 +368,31 @@ function JourneyVehicle({
 
     let timeout: number;
     let current = true;
+    let streamOpen = false;
+
+    const query = `?id=${vehicleId}`;
+
+    const closeStream = streamVehicles<Vehicle>(
+      query,
+      (changed) => {
+        if (current && changed.length) {
+          setVehicle(changed[0]);
+        }
+      },
+      (open) => {
+        streamOpen = open;
+      },
+    );
 
     const loadVehicle = () => {
-      fetch(`/vehicles.json?id=${vehicleId}`).then((response) => {
+      fetch(`/vehicles.json${query}`).then((response) => {
         response.json().then((data: Vehicle[]) => {
           if (current && data && data.length) {
             setVehicle(data[0]);
-            timeout = window.setTimeout(loadVehicle, 12000); // 12 seconds
+            timeout = window.setTimeout(
+              loadVehicle,
+              streamOpen ? STREAMING_POLL_INTERVAL : 12000, // 12 seconds
+            );
           }
         });
       });
@@ -380,6 +403,7 @@ function JourneyVehicle({
     return () => {
       current = false;
       clearTimeout(timeout);
+      closeStream();
     };
   }, [vehicleId]);
 
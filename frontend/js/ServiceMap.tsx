@@ -5,6 +5,7 @@ import loadjs from "loadjs";
 import LoadingSorry from "./LoadingSorry";
 import type { ServiceMapMapProps } from "./ServiceMapMap";
 import type { Vehicle } from "./VehicleMarker";
+import { STREAMING_POLL_INTERVAL, mergeVehicles, streamVehicles } from "./utils";
 
 const ServiceMapMap = lazy(() => import("./ServiceMapMap"));
 
@@ -137,20 +138,43 @@ export default function ServiceMap({ serviceId }: ServiceMapProps) {
 
   React.useEffect(() => {
     let timeout: number;
+    let closeStream: (() => void) | undefined;
+    let streamOpen = false;
+
+    const query = `?service=${Array.from(selectedServices).join(",")}`;
 
     const loadVehicles = () => {
       if ((document.hidden && !first.current) || !selectedServices.size) {
         return;
       }
 
-      const url = `${apiRoot}vehicles.json?service=${Array.from(selectedServices).join(",")}`;
-      fetch(url).then(
+      fetch(`${apiRoot}vehicles.json${query}`).then(
         (response) => {
           response.json().then((items) => {
             setVehicles(items);
             clearTimeout(timeout);
-            if (isOpen && items.length && !document.hidden) {
-              timeout = window.setTimeout(loadVehicles, 10000); // 10 seconds
+            if (isOpen && !document.hidden) {
+              if (!closeStream) {
+                closeStream = streamVehicles<Vehicle>(
+                  query,
+                  (changed, removed) => {
+                    setVehicles((vehicles) =>
+                      mergeVehicles(vehicles, changed, removed),
+                    );
+                  },
+                  (open) => {
+                    streamOpen = open;
+                  },
+                );
+              }
+              if (streamOpen) {
+                timeout = window.setTimeout(
+                  loadVehicles,
+                  STREAMING_POLL_INTERVAL,
+                );
+              } else if (items.length) {
+                timeout = window.setTimeout(loadVehicles, 10000); // 10 seconds
+              }
             }
           });
         },
@@ -168,6 +192,8 @@ export default function ServiceMap({ serviceId }: ServiceMapProps) {
     const handleVisibilityChange = () => {
       if (document.hidden) {
         clearTimeout(timeout);
+        closeStream?.();
+        closeStream = undefined;
       } else {
         loadVehicles();
       }
@@ -180,6 +206,7 @@ export default function ServiceMap({ serviceId }: ServiceMapProps) {
     return () => {
       window.removeEventListener("visibilitychange", handleVisibilityChange);
       clearTimeout(timeout);
+      closeStream?.();
     };
   }, [isOpen, selectedServices]);
 
@@ -37,3 +37,61 @@ export function getBounds<T>(
     return bounds;
   }
 }
+
+// while the live vehicle stream is open, vehicles.json is still polled (less often)
+// to catch vehicles that disappear without moving out of the map
+export const STREAMING_POLL_INTERVAL = 120000; // 2 minutes
+
+// listen to /vehicles/stream (see vehicles/live_updates.py) for vehicles that change,
+// with the same query string as vehicles.json.
+// onOpenChange(false) means it's not (yet, or any longer) open, so keep polling
+export function streamVehicles<T extends { id: number }>(
+  query: string,
+  onUpdate: (vehicles: T[], removed: number[]) => void,
+  onOpenChange: (open: boolean) => void,
+) {
+  if (!window.EventSource) {
+    return () => {};
+  }
+
+  const eventSource = new EventSource(
+    `${process.env.API_ROOT}vehicles/stream${query}`,
+  );
+  eventSource.onopen = () => onOpenChange(true);
+  eventSource.onerror = () => onOpenChange(false); // (it'll try to reconnect)
+  eventSource.onmessage = (event) => {
+    const data = JSON.parse(event.data);
+    onUpdate(data.vehicles, data.removed);
+  };
+
+  return () => {
+    eventSource.close();
+    onOpenChange(false);
+  };
+}
+
+export function mergeVehicles<T extends { id: number }>(
+  vehicles: T[] | undefined,
+  changed: T[],
+  removed: number[],
+) {
+  const changedById: { [id: number]: T } = {};
+  for (const item of changed) {
+    changedById[item.id] = item;
+  }
+  const result: T[] = [];
+  for (const item of vehicles || []) {
+    if (item.id in changedById) {
+      result.push(changedById[item.id]);
+      delete changedById[item.id];
+    } else if (removed.indexOf(item.id) === -1) {
+      result.push(item);
+    }
+  }
+  for (const item of changed) {
+    if (item.id in changedById) {
+      result.push(item);
+    }
+  }
+  return result;
+}
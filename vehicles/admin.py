@@ -11,6 +11,7 @@ from sql_util.utils import SubqueryCount
 
 
 from . import models
+from .utils import journeys_modified
 
 UserModel = get_user_model()
 
@@ -113,9 +114,9 @@ class VehicleTypeAdmin(admin.ModelAdmin):
 
     def merge(self, request, queryset):
         first = queryset[0]
-        models.Vehicle.objects.filter(vehicle_type__in=queryset).update(
-            vehicle_type=first
-        )
+        vehicles = models.Vehicle.objects.filter(vehicle_type__in=queryset)
+        journeys_modified(vehicle_ids=list(vehicles.values_list("id", flat=True)))
+        vehicles.update(vehicle_type=first)
         models.VehicleRevision.objects.filter(from_type__in=queryset).update(
             from_type=first
         )
@@ -235,11 +236,13 @@ class VehicleAdmin(admin.ModelAdmin):
     def copy_livery(self, request, queryset):
         livery = models.Livery.objects.filter(vehicle__in=queryset).first()
         count = queryset.update(livery=livery)
+        journeys_modified(vehicle_ids=list(queryset.values_list("id", flat=True)))
         self.message_user(request, f"Copied {livery} to {count} vehicles.")
 
     def copy_type(self, request, queryset):
         vehicle_type = models.VehicleType.objects.filter(vehicle__in=queryset).first()
         count = queryset.update(vehicle_type=vehicle_type)
+        journeys_modified(vehicle_ids=list(queryset.values_list("id", flat=True)))
         self.message_user(request, f"Copied {vehicle_type} to {count} vehicles.")
 
     def make_livery(self, request, queryset):
@@ -251,6 +254,7 @@ class VehicleAdmin(admin.ModelAdmin):
             vehicles = models.Vehicle.objects.filter(
                 colours=vehicle.colours, branding=vehicle.branding
             )
+            journeys_modified(vehicle_ids=list(vehicles.values_list("id", flat=True)))
             count = vehicles.update(colours="", branding="", livery=livery)
             self.message_user(request, f"Updated {count} vehicles.")
         else:
@@ -326,6 +330,7 @@ class VehicleAdmin(admin.ModelAdmin):
             vehicle_type=None,
             notes="Spare ticket machine",
         )
+        journeys_modified(vehicle_ids=list(queryset.values_list("id", flat=True)))
 
     def lock(self, request, queryset):
         queryset.update(locked=True)
@@ -627,6 +632,9 @@ class LiveryAdmin(SimpleHistoryAdmin):
             )
         else:
             for livery in queryset[1:]:
+                journeys_modified(
+                    vehicle_ids=list(livery.vehicle_set.values_list("id", flat=True))
+                )
                 livery.vehicle_set.update(livery=queryset[0])
                 livery.revision_from.update(from_livery=queryset[0])
                 livery.revision_to.update(to_livery=queryset[0])
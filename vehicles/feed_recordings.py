@@ -0,0 +1,153 @@
+"""Recording live feeds' responses and replaying them, so that importers can be
+benchmarked offline on identical input (see the record_live_feed and
+replay_live_feed commands).
+
+A recording is a directory with a file for each response body, exactly as it was
+downloaded (zipped SIRI-VM, GTFS-RT protobuf, JSON...), and an index.jsonl with a line
+for each response - which update cycle it was part of, when, the request's method and
+URL (with any credentials in the query string redacted - see redact_url), and the
+response's status code and headers.
+
+Only requests made with the importer's session (ImportLiveVehiclesCommand.session)
+are recorded and replayed.
+"""
+
+import json
+import re
+import time
+from collections import deque
+from pathlib import Path
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .ingest_metrics import IngestMetrics
+
+INDEX = "index.jsonl"
+
+# (the body is saved already decoded)
+SKIP_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+# query string parameters whose values are credentials, not to be written to disk
+CREDENTIAL_PARAMS = ("api_key", "apikey", "app_key", "key", "token", "access_token")
+credential_param_re = re.compile(
+    rf"([?&](?:{'|'.join(CREDENTIAL_PARAMS)}))=[^&#]*", re.IGNORECASE
+)
+
+
+def redact_url(url: str) -> str:
+    return credential_param_re.sub(r"\1=REDACTED", url)
+
+
+class Recorder:
+    """A requests response hook that adds each response to a recording"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path / INDEX
+        self.count = 0
+        self.cycle = 0
+        if self.index_path.exists():
+            # carry on after the existing recording
+            for cycle in read_recording(self.path):
+                self.count += len(cycle)
+                self.cycle = cycle[-1]["cycle"] + 1
+
+    def __call__(self, response, *args, **kwargs):
+        self.count += 1
+        filename = f"{self.count:06d}"
+        (self.path / filename).write_bytes(response.content)
+
+        entry = {
+            "cycle": self.cycle,
+            "time": time.time(),
+            "method": response.request.method,
+            "url": redact_url(response.request.url),
+            "status_code": response.status_code,
+            "reason": response.reason,
+            "headers": {
+                name: value
+                for name, value in response.headers.items()
+                if name.lower() not in SKIP_HEADERS
+            },
+            "file": filename,
+        }
+        with self.index_path.open("a") as open_file:
+            open_file.write(json.dumps(entry) + "\n")
+
+
+def read_recording(path: Path) -> list:
+    """A list of cycles, in order - each a list of index entries"""
+
+    cycles = {}
+    with (Path(path) / INDEX).open() as open_file:
+        for line in open_file:
+            entry = json.loads(line)
+            cycles.setdefault(entry["cycle"], []).append(entry)
+    return [cycles[cycle] for cycle in sorted(cycles)]
+
+
+class ReplayAdapter(BaseAdapter):
+    """Responds to requests with the recorded responses to the same method and URL
+    (compared with credentials redacted), in the order they were recorded -
+    a cycle at a time (see load_cycle)
+    """
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = Path(path)
+        self.responses = {}  # (method, url): deque of entries
+
+    def load_cycle(self, entries: list):
+        self.responses.clear()
+        for entry in entries:
+            key = (entry["method"], redact_url(entry["url"]))
+            self.responses.setdefault(key, deque()).append(entry)
+
+    def send(self, request, **kwargs):
+        url = redact_url(request.url)
+        try:
+            entry = self.responses[(request.method, url)].popleft()
+        except (KeyError, IndexError):
+            raise requests.exceptions.ConnectionError(
+                f"{request.method} {url} not recorded in this cycle",
+                request=request,
+            )
+
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.reason = entry["reason"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = (self.path / entry["file"]).read_bytes()
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def get_replay_session(adapter: ReplayAdapter) -> requests.Session:
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ReplayMetrics(IngestMetrics):
+    """Keeps each cycle's figures for the replay_live_feed report,
+    as well as flushing them to Redis as usual
+    """
+
+    def __init__(self):
+        self.cycles = []
+        super().__init__()
+
+    def flush(self, source_name: str, time_taken: float):
+        self.cycles.append(self.get_cycle(time_taken))
+        super().flush(source_name, time_taken)
@@ -0,0 +1,458 @@
+"""Journey location history.
+
+While a journey is recent, its history is a Redis list (see
+VehicleLocation.get_appendage). Each list expires EXPIRE after the journey's
+last point, but before then archive() moves it to a compressed file on disk -
+one file per day per operator, which later runs merge more journeys into - with a
+column per field, so reading one journey back only means decompressing a few small
+arrays. Each day's directory has an index of which file each journey is in.
+
+get_locations() reads from Redis while a journey is hot and from the archive
+when it's cold, and returns the packed values either way.
+
+Stop events - when a journey's vehicle was near each of its trip's stops, detected
+by live importers as locations arrive (see rtpi.Segments.get_stop_events) - are
+kept and archived the same way, so get_stop_events() doesn't have to work them out
+from the locations.
+"""
+
+import json
+import logging
+import math
+import struct
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from redis.exceptions import ConnectionError
+
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+EXPIRE = timedelta(hours=getattr(settings, "JOURNEY_HISTORY_HOURS", 6))
+ARCHIVE_AFTER = EXPIRE - timedelta(hours=1)
+
+# history key: timestamp of the journey's last point
+LAST_POINTS_KEY = "journey_history_last_points"
+
+# in each day's archive directory - {journey id: file name}
+INDEX = "index.json"
+
+location_struct = struct.Struct("I 2f ?h ?h")
+
+COLUMNS = (
+    ("timestamp", np.uint32),
+    ("x", np.float32),
+    ("y", np.float32),
+    ("has_heading", np.bool_),
+    ("heading", np.int16),
+    ("has_delay", np.bool_),
+    ("delay", np.int16),
+)
+
+# for reading packed locations straight into arrays
+location_dtype = np.dtype(
+    {
+        "names": [name for name, _ in COLUMNS],
+        "formats": [dtype for _, dtype in COLUMNS],
+        "offsets": [0, 4, 8, 12, 14, 16, 18],
+        "itemsize": location_struct.size,
+    }
+)
+
+stop_event_struct = struct.Struct("I I")  # stop time id, timestamp
+
+
+def get_stop_events_key(journey_id) -> str:
+    return f"journey{journey_id}stopevents"
+
+
+def get_archive_dir() -> Path:
+    return Path(
+        getattr(settings, "JOURNEY_HISTORY_DIR", settings.DATA_DIR / "journey_history")
+    )
+
+
+def get_date_dir(date) -> Path:
+    return get_archive_dir() / date.isoformat()
+
+
+def get_partition_name(operator_id) -> str:
+    """Relative to the day's directory"""
+    return f"{operator_id or '_'}.npz"
+
+
+def read_index(date_dir: Path) -> dict:
+    try:
+        return json.loads((date_dir / INDEX).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def write_index(date_dir: Path, index: dict):
+    tmp_path = date_dir / f"{INDEX}.tmp"
+    tmp_path.write_text(json.dumps(index, sort_keys=True))
+    tmp_path.rename(date_dir / INDEX)
+
+
+def push(pipe, key: bytes, value: bytes, timestamp: float):
+    """For importers that don't use UPDATE_LOCATIONS_SCRIPT"""
+    pipe.rpush(key, value)
+    pipe.expire(key, EXPIRE)
+    pipe.zadd(LAST_POINTS_KEY, {key: timestamp})
+
+
+def push_stop_event(pipe, journey_id: int, stop_time_id: int, timestamp: float):
+    key = get_stop_events_key(journey_id)
+    pipe.rpush(key, stop_event_struct.pack(stop_time_id, round(timestamp)))
+    pipe.expire(key, EXPIRE)
+
+
+def decode_stop_events(values) -> dict:
+    """{stop time id: datetime} - the last event at each stop"""
+    stop_events = dict(stop_event_struct.iter_unpack(b"".join(values)))
+    return {
+        stop_time_id: datetime.fromtimestamp(timestamp, dt_timezone.utc)
+        for stop_time_id, timestamp in stop_events.items()
+    }
+
+
+def read_journeys(path: Path) -> list:
+    """All the journeys in a file, as (journey id, packed locations,
+    packed stop events) tuples
+    """
+
+    with np.load(path) as archive:
+        journey_ids = archive["journey_ids"].tolist()
+        offsets = archive["offsets"].tolist()
+        rows = np.zeros(offsets[-1], location_dtype)
+        for name, _ in COLUMNS:
+            rows[name] = archive[name]
+
+        if "stop_event_offsets" in archive.files:
+            stop_event_offsets = archive["stop_event_offsets"].tolist()
+            stop_events = np.stack(
+                [
+                    archive["stop_event_stop_time_ids"],
+                    archive["stop_event_timestamps"],
+                ],
+                axis=1,
+            ).astype(np.uint32)
+        else:  # archived before there were stop events
+            stop_event_offsets = [0] * len(offsets)
+            stop_events = np.empty((0, 2), np.uint32)
+
+    return [
+        (
+            journey_id,
+            rows[offsets[i] : offsets[i + 1]].tobytes(),
+            stop_events[stop_event_offsets[i] : stop_event_offsets[i + 1]].tobytes(),
+        )
+        for i, journey_id in enumerate(journey_ids)
+    ]
+
+
+def write_partition(path: Path, journeys: list) -> list:
+    """journeys is a list of (journey id, [packed locations], [packed stop events])
+    tuples - merged with the file's existing journeys, if any (a journey archived
+    again, after an interruption, replaces its earlier history).
+    Returns the journey ids in the file
+    """
+
+    journeys = {
+        journey_id: (b"".join(locations), b"".join(stop_events))
+        for journey_id, locations, stop_events in journeys
+    }
+    if path.exists():
+        for journey_id, locations, stop_events in read_journeys(path):
+            journeys.setdefault(journey_id, (locations, stop_events))
+
+    journey_ids = sorted(journeys)
+
+    locations = [journeys[journey_id][0] for journey_id in journey_ids]
+    rows = np.frombuffer(b"".join(locations), dtype=location_dtype)
+
+    offsets = np.zeros(len(journey_ids) + 1, dtype=np.int64)
+    np.cumsum(
+        [len(values) // location_struct.size for values in locations], out=offsets[1:]
+    )
+
+    stop_events = [journeys[journey_id][1] for journey_id in journey_ids]
+    stop_event_offsets = np.zeros(len(journey_ids) + 1, dtype=np.int64)
+    np.cumsum(
+        [len(values) // stop_event_struct.size for values in stop_events],
+        out=stop_event_offsets[1:],
+    )
+    stop_events = np.frombuffer(b"".join(stop_events), dtype=np.uint32).reshape(-1, 2)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".npz.tmp")
+    with tmp_path.open("wb") as open_file:
+        np.savez_compressed(
+            open_file,
+            journey_ids=np.array(journey_ids, np.int64),
+            offsets=offsets,
+            **{name: np.ascontiguousarray(rows[name]) for name, _ in COLUMNS},
+            stop_event_offsets=stop_event_offsets,
+            stop_event_stop_time_ids=np.ascontiguousarray(stop_events[:, 0]),
+            stop_event_timestamps=np.ascontiguousarray(stop_events[:, 1]),
+        )
+    tmp_path.rename(path)
+
+    return journey_ids
+
+
+def read_partition(path: Path, journey_id: int, stop_events=False) -> list | None:
+    with np.load(path) as archive:
+        journey_ids = archive["journey_ids"]
+        i = np.searchsorted(journey_ids, journey_id)
+        if i == len(journey_ids) or journey_ids[i] != journey_id:
+            return
+
+        if stop_events:
+            if "stop_event_offsets" not in archive.files:
+                return []  # archived before there were stop events
+            start, end = archive["stop_event_offsets"][i : i + 2]
+            columns = [
+                archive["stop_event_stop_time_ids"][start:end].tolist(),
+                archive["stop_event_timestamps"][start:end].tolist(),
+            ]
+            return [stop_event_struct.pack(*row) for row in zip(*columns)]
+
+        start, end = archive["offsets"][i : i + 2]
+        columns = [archive[name][start:end].tolist() for name, _ in COLUMNS]
+
+    return [location_struct.pack(*row) for row in zip(*columns)]
+
+
+def get_partition_paths(journey):
+    date_dir = get_date_dir(timezone.localdate(journey.datetime))
+
+    if name := read_index(date_dir).get(str(journey.id)):
+        yield date_dir / name
+
+    # archived before there were indexes - a file per run, in a directory per
+    # operator (and the vehicle might have changed operator since)
+    operator_id = journey.vehicle and journey.vehicle.operator_id
+    partition_dir = date_dir / (operator_id or "_")
+    yield from sorted(partition_dir.glob("*.npz"))
+    for path in sorted(date_dir.glob("*/*.npz")):
+        if path.parent != partition_dir:
+            yield path
+
+
+def get_archived(journey, stop_events=False) -> list:
+    for path in get_partition_paths(journey):
+        values = read_partition(path, journey.id, stop_events)
+        if values is not None:
+            return values
+    return []
+
+
+def get_locations(journey) -> list:
+    """Packed locations (see VehicleLocation.decode_appendage)"""
+
+    if redis_client:
+        try:
+            locations = redis_client.lrange(journey.get_redis_key(), 0, -1)
+        except ConnectionError:
+            pass
+        else:
+            if locations:
+                return locations
+
+    return get_archived(journey)
+
+
+def get_stop_events(journey) -> dict:
+    """{stop time id: datetime}, hot or cold"""
+
+    if redis_client:
+        try:
+            values = redis_client.lrange(get_stop_events_key(journey.id), 0, -1)
+        except ConnectionError:
+            pass
+        else:
+            if values:
+                return decode_stop_events(values)
+
+    return decode_stop_events(get_archived(journey, stop_events=True))
+
+
+def decode_locations(values: list):
+    """Packed locations as a structured array, in time order"""
+    locations = np.frombuffer(b"".join(values), dtype=location_dtype)
+    return locations[np.argsort(locations["timestamp"], kind="stable")]
+
+
+def remove_stationary(locations, threshold=0.0005):
+    """Leave out locations within threshold (in degrees) of the last one kept -
+    apart from the last location of each stationary period
+    """
+    # (each location is compared to the last one kept, not just the previous one,
+    # so this has to go through them in order - but with plain floats, not Points)
+    keep = []
+    stationary = False
+    kept_x = kept_y = None
+    for i, (x, y) in enumerate(zip(locations["x"].tolist(), locations["y"].tolist())):
+        if kept_x is not None:
+            if math.hypot(x - kept_x, y - kept_y) < threshold:
+                stationary = True
+            elif stationary:
+                keep.append(i - 1)  # mark end of stationary period
+                stationary = False
+
+        if not stationary:
+            keep.append(i)
+            kept_x, kept_y = x, y
+
+    if stationary:
+        keep.append(len(locations) - 1)
+
+    return locations[keep]
+
+
+def get_datetimes(locations) -> list:
+    """ISO 8601 strings, as DjangoJSONEncoder would format the datetimes"""
+    return [
+        f"{value}Z"
+        for value in np.datetime_as_string(
+            locations["timestamp"].astype("datetime64[s]"), unit="s"
+        ).tolist()
+    ]
+
+
+def locations_json(locations) -> list:
+    """Like VehicleLocation.decode_appendage, for a whole array at once"""
+    return [
+        {
+            "id": timestamp,
+            "coordinates": [x, y],
+            "delta": delay if has_delay else None,
+            "direction": heading if has_heading else None,
+            "datetime": when,
+        }
+        for timestamp, x, y, has_heading, heading, has_delay, delay, when in zip(
+            *(locations[name].tolist() for name, _ in COLUMNS),
+            get_datetimes(locations),
+        )
+    ]
+
+
+def has_locations(journeys: list, now=None) -> list:
+    """For each journey, whether it has some location history - or None (maybe) if
+    Redis couldn't be asked, or if it might have been archived before there were
+    indexes, as finding out would mean opening the archive files
+    """
+
+    result = [None] * len(journeys)
+
+    if not redis_client:
+        return result
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for journey in journeys:
+            pipe.exists(journey.get_redis_key())
+        result = [bool(exists) for exists in pipe.execute()]
+    except (ConnectionError, AttributeError):
+        return result
+
+    if now is None:
+        now = timezone.now()
+    cutoff = now - ARCHIVE_AFTER
+
+    # date: (index, whether anything was archived that day before there were indexes)
+    archived_dates = {}
+    for i, journey in enumerate(journeys):
+        if result[i] or not journey.id or journey.datetime >= cutoff:
+            continue
+        date = timezone.localdate(journey.datetime)
+        if date not in archived_dates:
+            date_dir = get_date_dir(date)
+            archived_dates[date] = (
+                read_index(date_dir),
+                date_dir.exists() and any(path.is_dir() for path in date_dir.iterdir()),
+            )
+        index, unindexed = archived_dates[date]
+        if str(journey.id) in index:
+            result[i] = True
+        elif unindexed:
+            result[i] = None
+
+    return result
+
+
+def archive(now=None, batch_size=1000):
+    """Move the history of journeys whose last point was more than ARCHIVE_AFTER ago
+    from Redis to disk
+    """
+    from .models import VehicleJourney
+
+    if not redis_client:
+        return
+
+    if now is None:
+        now = timezone.now()
+    cutoff = (now - ARCHIVE_AFTER).timestamp()
+
+    total = 0
+    while keys := redis_client.zrangebyscore(
+        LAST_POINTS_KEY, "-inf", cutoff, start=0, num=batch_size
+    ):
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.lrange(key, 0, -1)
+        values = pipe.execute()
+
+        journeys = VehicleJourney.objects.filter(
+            uuid__in=[uuid.UUID(bytes=key) for key in keys]
+        ).values_list("uuid", "id", "datetime", "vehicle__operator_id")
+        journeys = {journey[0].bytes: journey[1:] for journey in journeys}
+
+        stop_events_keys = [
+            get_stop_events_key(journey_id) for journey_id, _, _ in journeys.values()
+        ]
+        pipe = redis_client.pipeline(transaction=False)
+        for stop_events_key in stop_events_keys:
+            pipe.lrange(stop_events_key, 0, -1)
+        stop_events = dict(zip(stop_events_keys, pipe.execute()))
+
+        partitions = {}
+        for key, locations in zip(keys, values):
+            if key in journeys and locations:
+                journey_id, journey_datetime, operator_id = journeys[key]
+                partition = (timezone.localdate(journey_datetime), operator_id)
+                partitions.setdefault(partition, []).append(
+                    (
+                        journey_id,
+                        locations,
+                        stop_events[get_stop_events_key(journey_id)],
+                    )
+                )
+
+        indexes = {}
+        for (date, operator_id), partition_journeys in partitions.items():
+            date_dir = get_date_dir(date)
+            if date not in indexes:
+                indexes[date] = read_index(date_dir)
+            name = get_partition_name(operator_id)
+            for journey_id in write_partition(date_dir / name, partition_journeys):
+                indexes[date][str(journey_id)] = name
+        for date, index in indexes.items():
+            write_index(get_date_dir(date), index)
+
+        # only delete them once they're safely on disk
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.delete(*keys, *stop_events_keys)
+        pipe.zrem(LAST_POINTS_KEY, *keys)
+        pipe.execute()
+
+        total += len(keys)
+
+    if total:
+        logger.info("archived %s journeys", total)
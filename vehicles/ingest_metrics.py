@@ -0,0 +1,157 @@
+"""Timings and counts for each stage of a live vehicle importer's update cycle
+(download, parse, vehicle lookup, journey matching, saving, etc),
+so that a slow cycle can be explained.
+
+Each cycle's figures are added to running totals in a Redis hash per source,
+alongside a copy of the latest cycle's, and served by the /status/metrics.json view.
+"""
+
+import json
+from collections import Counter
+from time import perf_counter
+
+from django.db import connection
+from django.utils import timezone
+from redis.exceptions import ConnectionError
+
+from .utils import redis_client
+
+SOURCES_KEY = "ingest_metrics_sources"
+
+
+def get_key(source_name: str) -> str:
+    return f"ingest_metrics:{source_name}"
+
+
+class Stage:
+    """Context manager that times a block and counts the database queries in it"""
+
+    __slots__ = ("totals", "start", "queries")
+
+    def __init__(self, totals: list):
+        self.totals = totals  # [calls, seconds, queries]
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.queries = 0
+        connection.execute_wrappers.append(self)
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.totals[1] += perf_counter() - self.start
+        connection.execute_wrappers.remove(self)
+        self.totals[0] += 1
+        self.totals[2] += self.queries
+
+
+class IngestMetrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = {}  # name: [calls, seconds, queries]
+        self.counts = Counter()
+        self.feed_age = None
+        self.newest = None  # datetime of the newest accepted location
+
+    def stage(self, name: str) -> Stage:
+        """with metrics.stage("download"): ..."""
+        if name not in self.stages:
+            self.stages[name] = [0, 0.0, 0]
+        return Stage(self.stages[name])
+
+    def count(self, reason: str, n: int = 1):
+        """Count items rejected for some reason"""
+        self.counts[reason] += n
+
+    def accept(self, when):
+        self.counts["accepted"] += 1
+        if when and (self.newest is None or when > self.newest):
+            self.newest = when
+
+    def set_feed_age(self, now, feed_datetime):
+        """For feeds with a timestamp of their own -
+        otherwise the feed age is that of the newest accepted location
+        """
+        if feed_datetime:
+            self.feed_age = (now - feed_datetime).total_seconds()
+
+    def get_cycle(self, time_taken: float) -> dict:
+        now = timezone.now()
+        feed_age = self.feed_age
+        if feed_age is None and self.newest:
+            feed_age = (now - self.newest).total_seconds()
+        return {
+            "datetime": now.isoformat(),
+            "time_taken": time_taken,
+            "feed_age": feed_age,
+            "stages": {
+                name: {"calls": calls, "seconds": seconds, "queries": queries}
+                for name, (calls, seconds, queries) in self.stages.items()
+            },
+            "items": dict(self.counts),
+        }
+
+    def flush(self, source_name: str, time_taken: float):
+        """Add this cycle's figures to the totals in Redis, and start again"""
+
+        if not redis_client:
+            self.reset()
+            return
+
+        key = get_key(source_name)
+
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.sadd(SOURCES_KEY, source_name)
+        pipe.hincrby(key, "cycles", 1)
+        pipe.hincrbyfloat(key, "seconds", time_taken)
+        for name, (calls, seconds, queries) in self.stages.items():
+            pipe.hincrby(key, f"stage:{name}:calls", calls)
+            pipe.hincrbyfloat(key, f"stage:{name}:seconds", seconds)
+            pipe.hincrby(key, f"stage:{name}:queries", queries)
+        for reason, n in self.counts.items():
+            pipe.hincrby(key, f"items:{reason}", n)
+        pipe.hset(key, "last", json.dumps(self.get_cycle(time_taken)))
+        try:
+            pipe.execute()
+        except ConnectionError:
+            pass
+
+        self.reset()
+
+
+def get_metrics() -> dict:
+    """Totals and the latest cycle for each source, for the metrics view"""
+
+    if not redis_client:
+        return {}
+
+    source_names = sorted(name.decode() for name in redis_client.smembers(SOURCES_KEY))
+
+    pipe = redis_client.pipeline(transaction=False)
+    for source_name in source_names:
+        pipe.hgetall(get_key(source_name))
+
+    metrics = {}
+    for source_name, values in zip(source_names, pipe.execute()):
+        totals = {"stages": {}, "items": {}}
+        last = None
+        for field, value in values.items():
+            field = field.decode()
+            if field == "last":
+                last = json.loads(value)
+                continue
+            value = float(value) if field.endswith("seconds") else int(value)
+            match field.split(":"):
+                case ["stage", stage, name]:
+                    totals["stages"].setdefault(stage, {})[name] = value
+                case ["items", reason]:
+                    totals["items"][reason] = value
+                case _:
+                    totals[field] = value
+        metrics[source_name] = {"totals": totals, "last": last}
+
+    return metrics
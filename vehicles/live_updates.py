@@ -0,0 +1,156 @@
+"""Pushing live vehicle locations to the maps as they change,
+instead of the maps polling vehicles.json.
+
+Live importers publish each batch of saved locations to a Redis pub/sub channel
+(see ImportLiveVehiclesCommand.save_locations).
+
+Each ASGI process (see buses.asgi, and the "Live vehicle stream" section of the
+README) has one Broadcaster, which subscribes to the channel once, decodes each
+batch once, and passes it to the Subscribers - one per open /vehicles/stream
+connection - each of which only sends on the locations in the bounding box or
+services or operators or vehicles it's interested in, and the ids of vehicles it
+has sent before that have since left them.
+"""
+
+import asyncio
+import logging
+import struct
+
+from django.conf import settings
+from redis import asyncio as aioredis
+from redis.exceptions import ConnectionError
+
+from .location_encoding import decode_location
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "vehicle_location_updates"
+
+lengths = struct.Struct("<HH")
+
+
+def pack_updates(updates) -> bytes:
+    """updates is a list of (encoded location, space-separated set names) tuples
+    (see UPDATE_LOCATIONS_SCRIPT)
+    """
+    message = bytearray()
+    for record, set_names in updates:
+        set_names = set_names.encode()
+        message += lengths.pack(len(record), len(set_names))
+        message += record
+        message += set_names
+    return bytes(message)
+
+
+def unpack_updates(message: bytes) -> list:
+    """A list of (location dict, set of set names) tuples"""
+    updates = []
+    i = 0
+    while i < len(message):
+        record_length, set_names_length = lengths.unpack_from(message, i)
+        i += lengths.size
+        record = message[i : i + record_length]
+        i += record_length
+        set_names = message[i : i + set_names_length].decode().split()
+        i += set_names_length
+        updates.append((decode_location(record), set(set_names)))
+    return updates
+
+
+class Subscriber:
+    def __init__(
+        self, bounds=None, service_ids=None, operator_ids=None, vehicle_ids=None
+    ):
+        self.bounds = bounds  # (xmin, ymin, xmax, ymax)
+        self.vehicle_ids = vehicle_ids and set(vehicle_ids)
+        self.set_names = None
+        if service_ids:
+            self.set_names = {
+                f"service{service_id}vehicles" for service_id in service_ids
+            }
+        elif operator_ids:
+            self.set_names = {
+                f"operator{operator_id}vehicles" for operator_id in operator_ids
+            }
+        self.sent = set()  # ids of vehicles the client has been sent
+        self.queue = asyncio.Queue(maxsize=10)
+
+    def matches(self, item: dict, set_names: set) -> bool:
+        if self.vehicle_ids:
+            return item["id"] in self.vehicle_ids
+        if self.bounds:
+            xmin, ymin, xmax, ymax = self.bounds
+            x, y = item["coordinates"]
+            return xmin <= x <= xmax and ymin <= y <= ymax
+        if self.set_names is not None:
+            return not self.set_names.isdisjoint(set_names)
+        return True
+
+    def put(self, updates: list):
+        items = []
+        removed = []  # ids of vehicles that have moved out of the box, etc
+        for item, set_names in updates:
+            if self.matches(item, set_names):
+                items.append(item)
+                self.sent.add(item["id"])
+            elif item["id"] in self.sent:
+                removed.append(item["id"])
+                self.sent.remove(item["id"])
+
+        if items or removed:
+            if self.queue.full():
+                # a slow client - drop the oldest batch
+                # (the map will just miss an intermediate position)
+                # but keep its removals, unless they've come back since
+                _, dropped_removed = self.queue.get_nowait()
+                removed += [
+                    vehicle_id
+                    for vehicle_id in dropped_removed
+                    if vehicle_id not in self.sent
+                ]
+            self.queue.put_nowait((items, removed))
+
+
+class Broadcaster:
+    def __init__(self):
+        self.subscribers = set()
+        self.task = None
+
+    def subscribe(self, subscriber: Subscriber):
+        self.subscribers.add(subscriber)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def run(self):
+        try:
+            while self.subscribers:
+                try:
+                    await self.listen()
+                except ConnectionError as e:
+                    logger.exception(e)
+                    await asyncio.sleep(5)
+        finally:
+            self.task = None
+
+    async def listen(self):
+        client = aioredis.from_url(settings.REDIS_URL)
+        try:
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe(CHANNEL)
+                # (stop when there's no one left to listen)
+                while self.subscribers:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=5
+                    )
+                    if message and message["type"] == "message":
+                        updates = unpack_updates(message["data"])
+                        for subscriber in list(self.subscribers):
+                            subscriber.put(updates)
+        finally:
+            await client.aclose()
+
+
+broadcaster = Broadcaster()
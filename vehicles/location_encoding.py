@@ -0,0 +1,107 @@
+"""A compact encoding of the live location records stored in "vehicle{id}" Redis keys,
+instead of JSON.
+
+Version 1 is a fixed header - id, journey id, coordinates, and a bitmask of which of
+FIELDS are present - followed by the datetime, and then the values of those fields
+as a JSON array, so field names aren't repeated in every record.
+
+decode_location() returns the same dict as json.loads() would have for the old
+JSON encoding, and can still read that, so old records can be read until they expire.
+"""
+
+import functools
+import json
+import struct
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+VERSION = b"\x01"
+
+# id, journey id, longitude, latitude, which FIELDS are present, length of datetime
+header = struct.Struct("<IIddHB")
+HEADER_END = 1 + header.size
+
+# (only ever add to the end of this)
+FIELDS = (
+    "heading",
+    "destination",
+    "block",
+    "delay",
+    "tfl_code",
+    "trip_id",
+    "service_id",
+    "service",
+    "seats",
+    "wheelchair",
+    "progress",
+)
+FIELD_NUMBERS = {field: i for i, field in enumerate(FIELDS)}
+
+encoder = DjangoJSONEncoder(separators=(",", ":"))
+
+
+@functools.cache
+def get_fields(mask: int) -> tuple:
+    return tuple(field for i, field in enumerate(FIELDS) if mask & (1 << i))
+
+
+def encode_location(item: dict) -> bytes:
+    """Encode the dict returned by VehicleLocation.get_redis_json()
+    (or as JSON, if it contains anything unexpected)
+    """
+
+    mask = 0
+    values = []
+    try:
+        for key, value in item.items():
+            if key in FIELD_NUMBERS:
+                mask |= 1 << FIELD_NUMBERS[key]
+                values.append((FIELD_NUMBERS[key], value))
+            elif key not in ("id", "journey_id", "coordinates", "datetime"):
+                raise ValueError(key)
+        values.sort(key=lambda value: value[0])
+
+        when = encoder.default(item["datetime"]).encode()
+        return b"".join(
+            (
+                VERSION,
+                header.pack(
+                    item["id"],
+                    item["journey_id"] or 0,
+                    *item["coordinates"],
+                    mask,
+                    len(when),
+                ),
+                when,
+                encoder.encode([value for _, value in values]).encode(),
+            )
+        )
+    except (KeyError, ValueError, TypeError, struct.error):
+        return json.dumps(item, cls=DjangoJSONEncoder).encode()
+
+
+def decode_location(value: bytes | str | None) -> dict | None:
+    """The one way to read a "vehicle{id}" record, in either encoding"""
+
+    if not value:
+        return value
+    if value[:1] != VERSION:
+        return json.loads(value)
+
+    vehicle_id, journey_id, x, y, mask, length = header.unpack_from(value, 1)
+    end = HEADER_END + length
+
+    # (in the same order as get_redis_json)
+    item = {
+        "id": vehicle_id,
+        "journey_id": journey_id or None,
+        "coordinates": [x, y],
+        "heading": None,
+        "datetime": value[HEADER_END:end].decode(),
+    }
+    item.update(zip(get_fields(mask), json.loads(value[end:].decode())))
+    return item
+
+
+def decode_locations(values) -> list:
+    return [decode_location(value) for value in values]
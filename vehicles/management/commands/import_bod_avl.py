@@ -1,11 +1,10 @@
 from collections import namedtuple
 import functools
 import io
-import json
+import itertools
 import zipfile
 from datetime import date, timedelta
 
-import xmltodict
 from ciso8601 import parse_datetime
 from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry
@@ -23,10 +22,11 @@ from busstops.models import (
     ServiceCode,
     StopPoint,
 )
+from bustimes import service_index
 from bustimes.models import Route, Trip
 
-from ...models import Vehicle, VehicleCode, VehicleJourney, VehicleLocation
-from ...utils import redis_client
+from ... import siri_vm
+from ...models import Vehicle, VehicleJourney, VehicleLocation
 from ..import_live_vehicles import ImportLiveVehiclesCommand, logger
 
 
@@ -84,6 +84,7 @@ def get_line_name_query(line_ref: str) -> Q:
 
 class Command(ImportLiveVehiclesCommand):
     source_name = "Bus Open Data"
+    vehicle_code_scheme = "BODS"
     services = (
         Service.objects.using(settings.READ_DATABASE)
         .filter(current=True)
@@ -97,6 +98,7 @@ class Command(ImportLiveVehiclesCommand):
         self.identifiers = {}
         self.journeys_ids = {}
         self.journeys_ids_ids = {}
+        self.indexed_services = {}  # service id: Service, or None if not current
 
     @staticmethod
     def get_datetime(item):
@@ -112,7 +114,7 @@ class Command(ImportLiveVehiclesCommand):
             | Q(noc=operator_ref) & ~Exists(operator_codes)
         )
 
-    def get_vehicle(self, item):
+    def get_vehicle(self, item, commit=True):
         monitored_vehicle_journey = item["MonitoredVehicleJourney"]
         operator_ref = monitored_vehicle_journey["OperatorRef"]
         vehicle_ref = monitored_vehicle_journey["VehicleRef"] or ""
@@ -195,7 +197,13 @@ class Command(ImportLiveVehiclesCommand):
         vehicles = vehicles.filter(condition)
 
         try:
-            vehicle, created = vehicles.get_or_create(defaults)
+            if commit:
+                vehicle, created = vehicles.get_or_create(defaults)
+            else:
+                vehicle, created = vehicles.get(), False
+        except Vehicle.DoesNotExist:
+            # let the caller save it (VehicleResolver creates new vehicles in bulk)
+            return Vehicle(**defaults), True
         except (Vehicle.MultipleObjectsReturned, IntegrityError) as e:
             print(e, operator_ref, vehicle_ref)
             vehicle = vehicles.first()
@@ -209,6 +217,60 @@ class Command(ImportLiveVehiclesCommand):
 
         return vehicle, created
 
+    def get_indexed_services(self, service_ids):
+        if missing := [
+            service_id
+            for service_id in service_ids
+            if service_id not in self.indexed_services
+        ]:
+            services = self.services.in_bulk(missing)
+            for service_id in missing:
+                self.indexed_services[service_id] = services.get(service_id)
+        return [
+            self.indexed_services[service_id]
+            for service_id in service_ids
+            if self.indexed_services[service_id]
+        ]
+
+    def get_indexed_service(
+        self, operators, line_names, destination_ref, vehicle_operator_id
+    ):
+        """Try to find the service using the service index (see bustimes.service_index)
+        in a similar way to get_service, but only if there's exactly one candidate
+        """
+
+        operator = operators[0]
+        if len(operators) == 1 and operator.parent and destination_ref:
+            # first try taking OperatorRef at face value
+            services = self.get_indexed_services(
+                service_index.get_service_ids([operator.noc], line_names)
+            )
+            if len(services) == 1:
+                return services[0]
+
+            operator_keys = [f"^{operator.parent}"]
+        else:
+            operator_keys = [operator.noc for operator in operators]
+
+            services = self.get_indexed_services(
+                service_index.get_service_ids(
+                    operator_keys + [vehicle_operator_id], line_names
+                )
+            )
+            if len(services) == 1:
+                return services[0]
+
+        if destination_ref:
+            services = self.get_indexed_services(
+                service_index.get_service_ids(
+                    operator_keys + [vehicle_operator_id],
+                    line_names,
+                    service_index.get_stop_prefixes(destination_ref),
+                )
+            )
+            if len(services) == 1:
+                return services[0]
+
     def get_service(self, operators, item, line_ref, vehicle_operator_id):
         monitored_vehicle_journey = item["MonitoredVehicleJourney"]
 
@@ -222,7 +284,7 @@ class Command(ImportLiveVehiclesCommand):
                 "Operational"
             ]["TicketMachine"]["TicketMachineServiceCode"]
         except (KeyError, TypeError):
-            pass
+            ticket_machine_service_code = None
         else:
             if ticket_machine_service_code.lower() != line_ref.lower():
                 line_name_query |= get_line_name_query(ticket_machine_service_code)
@@ -232,6 +294,16 @@ class Command(ImportLiveVehiclesCommand):
         if item["MonitoredVehicleJourney"]["OperatorRef"] == "TFLO":
             return services.filter(source__name="L").first()
 
+        if operators:
+            line_names = [line_ref]
+            if ticket_machine_service_code:
+                line_names.append(ticket_machine_service_code)
+            service = self.get_indexed_service(
+                operators, line_names, destination_ref, vehicle_operator_id
+            )
+            if service:
+                return service
+
         if not operators:
             pass
         elif len(operators) == 1 and operators[0].parent and destination_ref:
@@ -556,7 +628,6 @@ class Command(ImportLiveVehiclesCommand):
                         vehicle.operator_id = trip.operator_id
                         update_fields.append("operator")
 
-                    update_fields.append("operator")
                     if update_fields:
                         vehicle.save(update_fields=update_fields)
 
@@ -604,39 +675,47 @@ class Command(ImportLiveVehiclesCommand):
         if self.fallback_mode:
             url = self.source.settings.get("fallback_url") or url
 
-        response = self.session.get(url, timeout=61)
+        with self.metrics.stage("download"):
+            response = self.session.get(url, timeout=61)
 
         if not response.ok:
             print(response.headers, response.content, response)
             return []
 
-        if response.headers["content-type"] == "application/zip":
-            with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-                namelist = archive.namelist()
-                assert len(namelist) == 1
-                with archive.open(namelist[0]) as open_file:
-                    data = open_file.read()
-        else:
-            data = response.content
+        items = self.iter_items(response)
 
-        data = xmltodict.parse(data, force_list=["VehicleActivity"])
+        header = next(items)
 
         previous_time = self.source.datetime
 
-        self.source.datetime = parse_datetime(
-            data["Siri"]["ServiceDelivery"]["ResponseTimestamp"]
-        )
+        self.source.datetime = parse_datetime(header["ResponseTimestamp"])
 
         if (
             self.source.datetime
             and previous_time
             and self.source.datetime < previous_time
         ):
+            items.close()
             return  # don't return old data
 
-        return data["Siri"]["ServiceDelivery"]["VehicleMonitoringDelivery"].get(
-            "VehicleActivity"
-        )
+        first_item = next(items, None)
+        if first_item is None:
+            return
+
+        return itertools.chain((first_item,), items)
+
+    @staticmethod
+    def iter_items(response):
+        # decompress and parse the XML as we go,
+        # rather than reading the whole national feed into memory first
+        if response.headers["content-type"] == "application/zip":
+            with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+                namelist = archive.namelist()
+                assert len(namelist) == 1
+                with archive.open(namelist[0]) as open_file:
+                    yield from siri_vm.iter_vehicle_activities(open_file)
+        else:
+            yield from siri_vm.iter_vehicle_activities(io.BytesIO(response.content))
 
     @staticmethod
     def get_vehicle_identity(item):
@@ -671,40 +750,26 @@ class Command(ImportLiveVehiclesCommand):
         return f"{line_ref} {line_name} {journey_ref} {departure} {direction} {destination}"
 
     def handle_items(self, items, identities):
-        vehicle_codes = VehicleCode.objects.filter(
-            code__in=identities, scheme="BODS"
-        ).select_related("vehicle__latest_journey__trip")
-
-        vehicles_by_identity = {code.code: code.vehicle for code in vehicle_codes}
-
-        vehicle_locations = redis_client.mget(
-            [f"vehicle{vc.vehicle_id}" for vc in vehicle_codes]
-        )
-        vehicle_locations = {
-            vehicle_codes[i].vehicle_id: json.loads(item)
-            for i, item in enumerate(vehicle_locations)
-            if item
-        }
+        vehicles, vehicle_locations = self.get_vehicles(items, identities)
 
         for i, item in enumerate(items):
             vehicle_identity = identities[i]
 
             journey_identity = self.journeys_ids[vehicle_identity]
 
-            if vehicle_identity in vehicles_by_identity:
-                vehicle = vehicles_by_identity[vehicle_identity]
-            else:
-                vehicle, created = self.get_vehicle(item)
-                # print(vehicle_identity, vehicle, created)
-                if vehicle:
-                    VehicleCode.objects.create(
-                        code=vehicle_identity, scheme="BODS", vehicle=vehicle
-                    )
+            vehicle = vehicles[i]
+            if not vehicle:
+                self.metrics.count("no_vehicle")
+                continue
 
             keep_journey = False
             if vehicle_identity in self.journeys_ids_ids:
-                journey_identity_id = self.journeys_ids_ids[vehicle_identity]
-                if journey_identity_id == (journey_identity, vehicle.latest_journey_id):
+                previous_identity, journey = self.journeys_ids_ids[vehicle_identity]
+                if (
+                    previous_identity == journey_identity
+                    and journey.id
+                    and journey.id == vehicle.latest_journey_id
+                ):
                     keep_journey = True  # can dumbly keep same latest_journey
 
             result = self.handle_item(
@@ -718,9 +783,10 @@ class Command(ImportLiveVehiclesCommand):
             if result:
                 location, vehicle = result
 
+                # (a new journey won't have an id until it's created in save())
                 self.journeys_ids_ids[vehicle_identity] = (
                     journey_identity,
-                    vehicle.latest_journey_id,
+                    location.journey,
                 )
 
             self.identifiers[vehicle_identity] = item["RecordedAtTime"]
@@ -740,7 +806,10 @@ class Command(ImportLiveVehiclesCommand):
 
         total_items = 0
 
-        for i, item in enumerate(items or self.get_items() or ()):
+        if items is None:
+            items = self.get_items() or ()
+
+        for i, item in enumerate(items):
             vehicle_identity = self.get_vehicle_identity(item)
 
             journey_identity = self.get_journey_identity(item)
@@ -774,15 +843,26 @@ class Command(ImportLiveVehiclesCommand):
     def update(self):
         now = timezone.now()
 
-        (
-            changed_items,
-            changed_journey_items,
-            changed_item_identities,
-            changed_journey_identities,
-            total_items,
-        ) = self.get_changed_items()
+        # forget remembered services, in case they've stopped being current since -
+        # the service index is only updated by import_transxchange,
+        # so can still include services other importers have made not current
+        self.indexed_services.clear()
+
+        # (the response is parsed as it's read, so this stage includes "download")
+        with self.metrics.stage("parse"):
+            (
+                changed_items,
+                changed_journey_items,
+                changed_item_identities,
+                changed_journey_identities,
+                total_items,
+            ) = self.get_changed_items()
+        self.metrics.count(
+            "unchanged", total_items - len(changed_items) - len(changed_journey_items)
+        )
 
         age = int((now - self.source.datetime).total_seconds())
+        self.metrics.set_feed_age(now, self.source.datetime)
         self.hist[now.second % 10] = age
         print(self.hist)
         print(
@@ -807,6 +887,7 @@ class Command(ImportLiveVehiclesCommand):
 
         time_taken = (timezone.now() - now).total_seconds()
         print(f"{time_taken=}")
+        self.metrics.flush(self.source_name, time_taken)
 
         if self.fallback_mode:
             self.fallback_mode = False
@@ -1,4 +1,3 @@
-import requests
 from django.contrib.gis.geos import GEOSGeometry
 
 from busstops.models import Service
@@ -12,10 +11,6 @@ from .import_nx import parse_datetime
 class Command(ImportLiveVehiclesCommand):
     wait = 92
 
-    def get_items(self):
-        self.session = requests.Session()
-        return super().get_items()
-
     @staticmethod
     def add_arguments(parser):
         parser.add_argument("source_name", type=str)
@@ -19,6 +19,8 @@ from ..import_live_vehicles import ImportLiveVehiclesCommand
 
 
 class Command(ImportLiveVehiclesCommand):
+    polled = False
+
     def handle_item(self, item, vehicle):
         journey_code, vehicle_code = self.split_vehicle_id(item)
 
@@ -0,0 +1,236 @@
+"""Import any GTFS-Realtime feed - VehiclePositions and (optionally) TripUpdates -
+configured by a DataSource's settings, e.g.
+
+    ./manage.py import_gtfsr "Some Operator GTFS-RT"
+    ./manage.py run_live_feeds "import_gtfsr:Some Operator GTFS-RT"
+
+with settings like
+
+    {
+        "vehicle_positions_url": "https://example.com/gtfsr/VehiclePositions",
+        "trip_updates_url": "https://example.com/gtfsr/TripUpdates",
+        "headers": {"x-api-key": "..."},
+        "timezone": "Europe/London",
+        "operator": "ABCD",
+        "timetable_source": "Some Operator GTFS"
+    }
+
+all optional - vehicle_positions_url defaults to the source's url, timezone to
+Europe/London, and timetable_source (the name of the DataSource of the GTFS
+timetables whose trip ids the feed uses) to the source itself.
+
+Trip updates are stored for pages to use (see departures.gtfsr), and vehicles are
+matched to trips by trip id (Trip.ticket_machine_code) - all of a cycle's unknown
+trips in one query.
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.utils import timezone as django_timezone
+from django.utils.dateparse import parse_duration
+from google.protobuf import json_format
+from google.transit import gtfs_realtime_pb2
+
+from busstops.models import DataSource
+from bustimes.models import Trip
+from bustimes.utils import get_calendars
+from departures import gtfsr
+
+from ...models import Vehicle, VehicleJourney, VehicleLocation
+from ..import_live_vehicles import ImportLiveVehiclesCommand
+from .import_gtfsr_ie import occupancies
+
+logger = logging.getLogger(__name__)
+
+
+class Command(ImportLiveVehiclesCommand):
+    max_trips_age = timedelta(hours=1)  # in case timetables have changed
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("source_name", type=str)
+
+    def handle(self, source_name, **options):
+        self.source_name = source_name
+        super().handle(**options)
+
+    def do_source(self):
+        super().do_source()
+
+        settings = self.source.settings or {}
+        self.url = settings.get("vehicle_positions_url") or self.source.url
+        self.trip_updates_url = settings.get("trip_updates_url")
+        self.headers = settings.get("headers")
+        self.tzinfo = ZoneInfo(settings.get("timezone", "Europe/London"))
+        self.operator_id = settings.get("operator")
+        if "timetable_source" in settings:
+            self.timetable_source = DataSource.objects.get(
+                name=settings["timetable_source"]
+            )
+        else:
+            self.timetable_source = self.source
+
+        # vehicle id: (timestamp, latitude, longitude) of the last entity handled
+        self.previous_locations = {}
+        self.clear_trips()
+        return self
+
+    def clear_trips(self):
+        self.trips = {}  # trip id: [trips]
+        self.trips_cleared_at = django_timezone.now()
+
+    def get_feed(self, url):
+        response = self.session.get(url, headers=self.headers, timeout=10)
+        response.raise_for_status()
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(response.content)
+        return feed
+
+    def prefetch_trips(self, trip_ids):
+        if django_timezone.now() - self.trips_cleared_at > self.max_trips_age:
+            self.clear_trips()
+
+        trip_ids = {trip_id for trip_id in trip_ids if trip_id not in self.trips}
+        if not trip_ids:
+            return
+
+        for trip_id in trip_ids:
+            self.trips[trip_id] = []
+        for trip in Trip.objects.filter(
+            ticket_machine_code__in=trip_ids, route__source=self.timetable_source
+        ).select_related("route__service"):
+            self.trips[trip.ticket_machine_code].append(trip)
+
+    def get_items(self):
+        if self.trip_updates_url:
+            # (don't let a problem with the trip updates stop vehicle positions)
+            try:
+                with self.metrics.stage("trip_updates"):
+                    gtfsr.save_trip_updates(
+                        self.timetable_source.id, self.get_feed(self.trip_updates_url)
+                    )
+            except Exception as e:
+                logger.exception(e)
+
+        feed = self.get_feed(self.url)
+        if feed.header.timestamp:
+            self.metrics.set_feed_age(
+                django_timezone.now(),
+                datetime.fromtimestamp(feed.header.timestamp, timezone.utc),
+            )
+
+        # only the vehicles that have moved, or at least reported again
+        items = []
+        for item in feed.entity:
+            if not item.HasField("vehicle"):
+                continue
+            key = self.get_vehicle_identity(item)
+            value = (
+                item.vehicle.timestamp,
+                item.vehicle.position.latitude,
+                item.vehicle.position.longitude,
+            )
+            if self.previous_locations.get(key) == value:
+                self.metrics.count("unchanged")
+            else:
+                self.previous_locations[key] = value
+                items.append(item)
+
+        self.prefetch_trips(
+            item.vehicle.trip.trip_id for item in items if item.vehicle.trip.trip_id
+        )
+
+        return items
+
+    @staticmethod
+    def get_vehicle_identity(item):
+        return item.vehicle.vehicle.id or item.id
+
+    @staticmethod
+    def get_datetime(item):
+        if item.vehicle.timestamp:
+            return datetime.fromtimestamp(item.vehicle.timestamp, timezone.utc)
+
+    def get_vehicle(self, item, commit=True):
+        defaults = {"operator_id": self.operator_id}
+        if item.vehicle.vehicle.label:
+            defaults["fleet_code"] = item.vehicle.vehicle.label[:24]
+        vehicle_code = self.get_vehicle_identity(item)
+        if not commit:
+            # VehicleResolver has already checked that it doesn't exist
+            return Vehicle(code=vehicle_code, source=self.source, **defaults), True
+        return Vehicle.objects.get_or_create(
+            defaults, code=vehicle_code, source=self.source
+        )
+
+    def get_trip(self, item):
+        trips = self.trips.get(item.vehicle.trip.trip_id)
+        if not trips:
+            return
+        if len(trips) > 1 and item.vehicle.trip.start_date:
+            start_date = datetime.strptime(item.vehicle.trip.start_date, "%Y%m%d")
+            calendars = set(
+                get_calendars(
+                    start_date.date(), [trip.calendar_id for trip in trips]
+                ).values_list("id", flat=True)
+            )
+            trips = [trip for trip in trips if trip.calendar_id in calendars] or trips
+        return trips[0]
+
+    def get_journey_datetime(self, item, trip):
+        if item.vehicle.trip.start_date:
+            # GTFS spec for working out datetimes:
+            start_date = datetime.strptime(
+                f"{item.vehicle.trip.start_date} 12:00:00", "%Y%m%d %H:%M:%S"
+            )
+            if item.vehicle.trip.start_time:
+                start_time = parse_duration(item.vehicle.trip.start_time)
+            elif trip:
+                start_time = trip.start
+            else:
+                return
+            return (start_date + start_time - timedelta(hours=12)).replace(
+                tzinfo=self.tzinfo
+            )
+
+    def get_journey(self, item, vehicle):
+        journey = VehicleJourney(
+            code=item.vehicle.trip.trip_id or item.vehicle.trip.route_id
+        )
+
+        if (
+            latest_journey := vehicle.latest_journey
+        ) and latest_journey.code == journey.code:
+            return latest_journey
+
+        trip = self.get_trip(item)
+        journey.datetime = self.get_journey_datetime(item, trip)
+
+        if trip:
+            journey.trip = trip
+            journey.service = trip.route.service
+            journey.destination = trip.headsign
+            if trip.operator_id and not vehicle.operator_id:
+                vehicle.operator_id = trip.operator_id
+                vehicle.save(update_fields=["operator"])
+
+        if journey.service:
+            journey.route_name = journey.service.line_name
+
+        vehicle.latest_journey_data = json_format.MessageToDict(item)
+
+        return journey
+
+    def create_vehicle_location(self, item):
+        return VehicleLocation(
+            heading=item.vehicle.position.bearing or None,
+            latlong=GEOSGeometry(
+                f"POINT({item.vehicle.position.longitude} "
+                f"{item.vehicle.position.latitude})"
+            ),
+            occupancy=occupancies.get(item.vehicle.occupancy_status or None),
+        )
@@ -29,7 +29,6 @@ occupancies = {
 
 class Command(ImportLiveVehiclesCommand):
     source_name = "Realtime Transport Operators"
-    vehicle_code_scheme = "NTA"
 
     def do_source(self):
         self.tzinfo = ZoneInfo("Europe/Dublin")
@@ -69,8 +68,11 @@ class Command(ImportLiveVehiclesCommand):
 
         return feed.entity
 
-    def get_vehicle(self, item):
+    def get_vehicle(self, item, commit=True):
         vehicle_code = item.vehicle.vehicle.id
+        if not commit:
+            # VehicleResolver has already checked that it doesn't exist
+            return Vehicle(code=vehicle_code, source=self.source), True
         return Vehicle.objects.get_or_create(code=vehicle_code, source=self.source)
 
     def get_journey(self, item, vehicle):
@@ -36,6 +36,7 @@ def parse_timestamp(timestamp):
 
 
 class Command(ImportLiveVehiclesCommand):
+    polled = False
     source_name = "Satellites"
     previous_locations = {}
 
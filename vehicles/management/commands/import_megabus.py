@@ -1,15 +1,15 @@
 import functools
-import json
 from datetime import timedelta
 from time import sleep
 
 import ciso8601
 from django.contrib.gis.geos import Point
-from django.core.serializers.json import DjangoJSONEncoder
 from requests import RequestException
 
 from busstops.models import Service
 
+from ... import history
+from ...location_encoding import decode_location, encode_location
 from ...models import VehicleJourney, VehicleLocation
 from ...utils import redis_client
 from .import_nx import Command as NatExpCommand
@@ -114,9 +114,8 @@ class Command(NatExpCommand):
             item["active_vehicle"]["last_update_time_formatted_local"]
         )
 
-        latest = redis_client.get(f"vehicle{journey.id}")
+        latest = decode_location(redis_client.get(f"vehicle{journey.id}"))
         if latest:
-            latest = json.loads(latest)
             latest_datetime = ciso8601.parse_datetime(latest["datetime"])
             if latest_datetime >= updated_at:
                 return
@@ -138,7 +137,7 @@ class Command(NatExpCommand):
         location.id = journey.id
         pipeline = redis_client.pipeline(transaction=False)
 
-        pipeline.rpush(*location.get_appendage())
+        history.push(pipeline, *location.get_appendage(), updated_at.timestamp())
 
         match item["trip"]["class_code"]:
             case "DE":  # Dublin Express
@@ -171,7 +170,8 @@ class Command(NatExpCommand):
 
         if service:
             redis_json["service"]["url"] = service.get_absolute_url()
-        redis_json = json.dumps(redis_json, cls=DjangoJSONEncoder)
+        # (will be JSON, with the extra fields)
+        redis_json = encode_location(redis_json)
         pipeline.set(f"vehicle{journey.id}", redis_json, ex=900)
 
         pipeline.execute()
@@ -0,0 +1,36 @@
+"""Run a live vehicle importer as usual, but save every response it downloads,
+for replay_live_feed to replay later, e.g.
+
+    ./manage.py record_live_feed import_bod_avl recordings/bod_avl --cycles 60
+"""
+
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from ...feed_recordings import Recorder
+from .run_live_feeds import Command as RunLiveFeedsCommand
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("feed", type=str)
+        parser.add_argument("path", type=str)
+        parser.add_argument("--cycles", type=int, default=None)
+
+    def handle(self, feed, path, cycles, **options):
+        command = RunLiveFeedsCommand.get_feed_command(feed)
+        recorder = Recorder(path)
+        command.session.hooks["response"].append(recorder)
+
+        command.load_status()
+        command.do_source()
+
+        recorded = 0
+        while cycles is None or recorded < cycles:
+            wait = command.update()
+            recorder.cycle += 1
+            recorded += 1
+            self.stdout.write(f"cycle {recorder.cycle}: {recorder.count} responses")
+            if cycles is None or recorded < cycles:
+                sleep(wait)
@@ -0,0 +1,101 @@
+"""Drive a live vehicle importer through a recording made by record_live_feed,
+against the local database and Redis, and report how fast it was, e.g.
+
+    ./manage.py replay_live_feed import_bod_avl recordings/bod_avl --speed 10
+
+--speed 1 (the default) replays cycles as far apart as they were recorded,
+--speed 10 ten times as fast, and --speed 0 as fast as possible.
+
+Importers remember vehicles' latest locations in Redis, and ignore ones that aren't
+newer - so to compare runs, start each from the same database and an empty Redis.
+"""
+
+from time import perf_counter, sleep
+
+from django.core.management.base import BaseCommand
+
+from ...feed_recordings import (
+    ReplayAdapter,
+    ReplayMetrics,
+    get_replay_session,
+    read_recording,
+)
+from ...ingest_metrics import Stage
+from .run_live_feeds import Command as RunLiveFeedsCommand
+
+
+def percentile(values: list, fraction: float):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("feed", type=str)
+        parser.add_argument("path", type=str)
+        parser.add_argument("--speed", type=float, default=1.0)
+        parser.add_argument("--cycles", type=int, default=None)
+
+    def handle(self, feed, path, speed, cycles, **options):
+        recording = read_recording(path)[:cycles]
+
+        command = RunLiveFeedsCommand.get_feed_command(feed)
+        adapter = ReplayAdapter(path)
+        command.session = get_replay_session(adapter)
+        command.metrics = ReplayMetrics()
+
+        command.load_status()
+        command.do_source()
+
+        results = []  # (items, seconds, queries) for each cycle
+        start = perf_counter()
+        for i, entries in enumerate(recording):
+            if speed:
+                # as long after the first cycle as it was when it was recorded
+                due = start + (entries[0]["time"] - recording[0][0]["time"]) / speed
+                if (wait := due - perf_counter()) > 0:
+                    sleep(wait)
+
+            adapter.load_cycle(entries)
+
+            totals = [0, 0.0, 0]  # calls, seconds, queries
+            with Stage(totals):
+                command.update()
+
+            if len(command.metrics.cycles) <= i:
+                # (importers without a source name don't flush their metrics)
+                command.metrics.cycles.append(command.metrics.get_cycle(totals[1]))
+                command.metrics.reset()
+            items = sum(command.metrics.cycles[i]["items"].values())
+
+            results.append((items, totals[1], totals[2]))
+            self.stdout.write(
+                f"cycle {i + 1}: {items} items, {totals[1]:.3f}s, {totals[2]} queries"
+            )
+
+        self.report(results)
+
+    def report(self, results):
+        if not results:
+            self.stdout.write("no cycles recorded")
+            return
+
+        items = sum(cycle_items for cycle_items, _, _ in results)
+        seconds = [cycle_seconds for _, cycle_seconds, _ in results]
+        queries = sum(cycle_queries for _, _, cycle_queries in results)
+        total_seconds = sum(seconds)
+
+        self.stdout.write(
+            f"{len(results)} cycles, {items} items in {total_seconds:.3f}s "
+            f"({items / total_seconds if total_seconds else 0:.1f} items/s)"
+        )
+        self.stdout.write(
+            f"cycle latency: mean {total_seconds / len(results):.3f}s, "
+            f"median {percentile(seconds, 0.5):.3f}s, "
+            f"95th percentile {percentile(seconds, 0.95):.3f}s, "
+            f"max {max(seconds):.3f}s"
+        )
+        self.stdout.write(
+            f"{queries} queries ({queries / len(results):.1f} per cycle, "
+            f"{queries / items if items else 0:.2f} per item)"
+        )
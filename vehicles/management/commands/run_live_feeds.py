@@ -0,0 +1,103 @@
+"""Run several live vehicle importers in one process.
+
+Each feed is the name of an ImportLiveVehiclesCommand subclass,
+optionally followed by a colon and a DataSource name for the commands that need one, e.g.
+
+    ./manage.py run_live_feeds import_nx import_megabus "import_bushub:Bus Hub X"
+
+Each feed keeps its own schedule (update() returns how long to wait until the next one),
+but they share one event loop, one HTTP connection pool,
+and a few threads (with their own database connections) to do the actual work in.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.core.management import get_commands, load_command_class
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from ..import_live_vehicles import ImportLiveVehiclesCommand
+
+logger = logging.getLogger(__name__)
+
+
+def get_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def run_in_thread(function):
+    close_old_connections()
+    try:
+        return function()
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("feeds", nargs="+", type=str)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--immediate", action="store_true")
+
+    @staticmethod
+    def get_feed_command(feed):
+        name, _, source_name = feed.partition(":")
+
+        try:
+            app_name = get_commands()[name]
+        except KeyError:
+            raise CommandError(f"Unknown command: {name}")
+        command = load_command_class(app_name, name)
+        if not isinstance(command, ImportLiveVehiclesCommand):
+            raise CommandError(f"{name} isn't a live vehicles importer")
+        if not command.polled:
+            raise CommandError(
+                f"{name} doesn't poll for updates (it runs its own loop in handle()), "
+                "so it can't be run with other feeds"
+            )
+
+        if source_name:
+            command.source_name = source_name
+        return command
+
+    async def run_feed(self, command, executor, immediate):
+        loop = asyncio.get_running_loop()
+
+        if not immediate:
+            await asyncio.sleep(command.wait)
+
+        await loop.run_in_executor(executor, run_in_thread, command.do_source)
+
+        while True:
+            try:
+                wait = await loop.run_in_executor(
+                    executor, run_in_thread, command.update
+                )
+            except Exception as e:
+                logger.exception(e)
+                wait = command.wait
+            await asyncio.sleep(wait)
+
+    async def run_feeds(self, commands, workers, immediate):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            await asyncio.gather(
+                *(self.run_feed(command, executor, immediate) for command in commands)
+            )
+
+    def handle(self, feeds, workers, immediate, **options):
+        commands = [self.get_feed_command(feed) for feed in feeds]
+
+        session = get_session(len(commands))
+        for command in commands:
+            command.session = session
+            command.load_status()
+
+        asyncio.run(self.run_feeds(commands, workers, immediate))
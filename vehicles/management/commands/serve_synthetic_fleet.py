@@ -0,0 +1,147 @@
+"""Serve SIRI-VM and GTFS-RT feeds of a synthetic fleet (see synthetic_fleet),
+for load testing importers, e.g.
+
+    ./manage.py serve_synthetic_fleet --vehicles 60000 --interval 10 --port 8001
+
+then point an importer at it - e.g. set the "Bus Open Data" DataSource's url to
+http://localhost:8001/siri-vm.zip for import_bod_avl, or run import_gtfsr with a
+source whose url is http://localhost:8001/gtfs-rt.
+
+Paths:
+    /siri-vm.xml  every vehicle's latest report, as a SIRI-VM ServiceDelivery
+    /siri-vm.zip  the same, zipped like the Bus Open Data Service's feed
+    /gtfs-rt      the --overlap share of the fleet, as GTFS-RT VehiclePositions
+
+With --push, new reports are also POSTed to a SIRI-VM subscriber - e.g. the
+siri_post view, http://localhost:8000/siri/<SiriSubscription uuid> - every
+--push-interval seconds, to load test handle_siri_post.
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ... import synthetic_fleet
+
+
+class Handler(BaseHTTPRequestHandler):
+    fleet = None
+    lock = threading.Lock()
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/siri-vm.xml":
+            get_body = synthetic_fleet.get_siri_vm
+            content_type = "text/xml"
+            gtfsr = False
+        elif path == "/siri-vm.zip":
+            get_body = synthetic_fleet.get_siri_vm_zip
+            content_type = "application/zip"
+            gtfsr = False
+        elif path == "/gtfs-rt":
+            get_body = synthetic_fleet.get_gtfs_rt
+            content_type = "application/x-protobuf"
+            gtfsr = True
+        else:
+            self.send_error(404)
+            return
+
+        with self.lock:
+            activities = self.fleet.get_activities(gtfsr=gtfsr)
+        body = get_body(activities)
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--vehicles", type=int, default=1000)
+        parser.add_argument(
+            "--interval", type=float, default=10, help="seconds between reports"
+        )
+        parser.add_argument(
+            "--churn",
+            type=float,
+            default=0,
+            help="chance per minute of a vehicle starting a new journey early",
+        )
+        parser.add_argument(
+            "--overlap",
+            type=float,
+            default=0.1,
+            help="share of vehicles in the GTFS-RT feed as well as the SIRI-VM one",
+        )
+        parser.add_argument(
+            "--trips", type=int, default=5000, help="how many trips' patterns to use"
+        )
+        parser.add_argument("--operator", action="append", dest="operators")
+        parser.add_argument("--seed", type=int)
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument("--push", type=str, help="URL to POST SIRI-VM to")
+        parser.add_argument("--push-interval", type=float, default=1)
+
+    def handle(self, *args, **options):
+        patterns = synthetic_fleet.get_patterns(options["trips"], options["operators"])
+        if not patterns:
+            raise CommandError("No current trips with located stops")
+
+        fleet = synthetic_fleet.SyntheticFleet(
+            patterns,
+            options["vehicles"],
+            interval=options["interval"],
+            churn=options["churn"],
+            overlap=options["overlap"],
+            seed=options["seed"],
+        )
+        self.stdout.write(
+            f"{len(fleet.vehicles)} vehicles on {len(patterns)} trips' patterns"
+        )
+
+        Handler.fleet = fleet
+        server = ThreadingHTTPServer(("", options["port"]), Handler)
+        self.stdout.write(f"serving on port {options['port']}")
+
+        if not options["push"]:
+            server.serve_forever()
+            return
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.push(fleet, options["push"], options["push_interval"])
+
+    def push(self, fleet, url, interval):
+        session = requests.Session()
+        since = time.time()
+        while True:
+            time.sleep(interval)
+            now = time.time()
+            with Handler.lock:
+                activities = fleet.get_activities(now, since)
+            since = now
+            if not activities:
+                continue
+            try:
+                response = session.post(
+                    url,
+                    data=synthetic_fleet.get_siri_vm(activities, timezone.now()),
+                    headers={"content-type": "text/xml"},
+                    timeout=10,
+                )
+            except requests.exceptions.RequestException as e:
+                self.stderr.write(str(e))
+            else:
+                self.stdout.write(
+                    f"pushed {len(activities)} activities: {response.status_code} "
+                    f"in {response.elapsed.total_seconds():.3f}s"
+                )
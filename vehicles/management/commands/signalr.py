@@ -12,7 +12,28 @@ from ..import_live_vehicles import ImportLiveVehiclesCommand
 
 
 class Command(ImportLiveVehiclesCommand):
-    def handle_item(self, item):
+    polled = False
+
+    @staticmethod
+    def get_vehicle_identity(item):
+        return item.split("|")[1]
+
+    def get_vehicle(self, item, commit=True):
+        vehicle_code = self.get_vehicle_identity(item)
+        fleet_number = int(vehicle_code) if vehicle_code.isdigit() else None
+        defaults = {
+            "operator_id": self.operator_id,
+            "fleet_code": str(fleet_number or vehicle_code),
+            "fleet_number": fleet_number,
+        }
+        if not commit:
+            # VehicleResolver has already checked that it doesn't exist
+            return Vehicle(**defaults, source=self.source, code=vehicle_code), True
+        return self.vehicles.get_or_create(
+            defaults, source=self.source, code=vehicle_code
+        )
+
+    def handle_item(self, item, vehicle):
         parts = item.split("|")
 
         (
@@ -30,31 +51,14 @@ class Command(ImportLiveVehiclesCommand):
 
         recorded_at_time = parse_datetime(timestamp)
 
-        if False:
-            created = False
-        else:
-            fleet_number = int(vehicle_code) if vehicle_code.isdigit() else None
-            vehicle, created = Vehicle.objects.select_related(
-                "latest_journey"
-            ).get_or_create(
-                {
-                    "operator_id": self.operator_id,
-                    "fleet_code": str(fleet_number or vehicle_code),
-                    "fleet_number": fleet_number,
-                },
-                source=self.source,
-                code=vehicle_code,
-            )
-
         journey = None
-        if not created:
-            if (
-                vehicle.latest_journey
-                and vehicle.latest_journey.code == journey_code
-                and vehicle.latest_journey.route_name == route
-                and vehicle.latest_journey.direction == direction
-            ):
-                journey = vehicle.latest_journey
+        if (
+            vehicle.latest_journey
+            and vehicle.latest_journey.code == journey_code
+            and vehicle.latest_journey.route_name == route
+            and vehicle.latest_journey.direction == direction
+        ):
+            journey = vehicle.latest_journey
 
         if not journey:
             try:
@@ -145,6 +149,12 @@ class Command(ImportLiveVehiclesCommand):
                     part = json.loads(part)
                     if "arguments" in part:
                         for argument in part["arguments"]:
-                            for location in argument["locations"]:
-                                self.handle_item(location)
+                            locations = argument["locations"]
+                            vehicles, _ = self.get_vehicles(
+                                locations,
+                                [self.get_vehicle_identity(item) for item in locations],
+                            )
+                            for location, vehicle in zip(locations, vehicles):
+                                if vehicle:
+                                    self.handle_item(location, vehicle)
                         self.save()
@@ -0,0 +1,25 @@
+"""Build the big map's tile snapshots (see vehicles.tiles) every
+tiles.MIN_INTERVAL seconds, indefinitely:
+
+    ./manage.py update_vehicle_tiles
+"""
+
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...tiles import MIN_INTERVAL, update_tiles
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true")
+
+    def handle(self, *args, once=False, **options):
+        while True:
+            close_old_connections()
+            update_tiles()
+            if once:
+                break
+            sleep(MIN_INTERVAL)
@@ -1,6 +1,7 @@
-import json
 import logging
+from collections import OrderedDict
 from datetime import timedelta
+from itertools import batched
 from time import sleep
 
 import requests
@@ -8,24 +9,156 @@ from ciso8601 import parse_datetime
 from django.contrib.gis.geos import Point
 from django.core.cache import cache
 from django.core.management.base import BaseCommand
-from django.core.serializers.json import DjangoJSONEncoder
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.db.models import Exists, OuterRef, Q
 from django.db.models.functions import Now
 from django.utils import timezone
+from redis.commands.core import Script
 from redis.exceptions import ConnectionError
 from tenacity import before_sleep_log, retry, wait_exponential
 
-from busstops.models import DataSource
+from busstops.models import DataSource, Service
 from bustimes.models import Route, Trip
 
-from ..models import Vehicle, VehicleJourney
-from ..utils import calculate_bearing, redis_client
+from ..history import EXPIRE as HISTORY_EXPIRE
+from ..history import push_stop_event
+from ..playback import push_positions
+from ..ingest_metrics import IngestMetrics
+from ..live_updates import CHANNEL, pack_updates
+from ..location_encoding import decode_location, encode_location
+from ..models import Vehicle, VehicleCode, VehicleJourney
+from ..rtpi import TripCache
+from ..utils import cache_journeys, calculate_bearing, redis_client
 
 logger = logging.getLogger(__name__)
 fifteen_minutes = timedelta(minutes=15)
 twelve_hours = timedelta(hours=12)
 
+# Atomically save a batch of vehicle locations, ignoring any older than the one
+# already saved (perhaps by another process) for a vehicle.
+# ARGV is the number of seconds to keep journey histories for (see vehicles.history),
+# the current timestamp, then groups of 8 -
+#   vehicle id, timestamp, longitude, latitude, encoded location ("" to only add to history),
+#   space-separated names of sets (service and operator) to add the vehicle id to,
+#   journey history key and value ("" to not add to history).
+# Bumps the ingest version if any vehicles were saved or have expired, and records
+# the version at which each one last changed (for vehicles.json?since=).
+# Returns the ids of vehicles whose locations were saved.
+UPDATE_LOCATIONS_SCRIPT = """
+local accepted = {}
+local history_expire = ARGV[1]
+local now = tonumber(ARGV[2])
+-- (the version will be incremented below if any locations are accepted)
+local version = tonumber(redis.call("GET", "vehicle_locations_version") or 0) + 1
+for i = 3, #ARGV, 8 do
+    local vehicle_id = ARGV[i]
+    local timestamp = tonumber(ARGV[i + 1])
+    local record = ARGV[i + 4]
+    local history_key = ARGV[i + 6]
+    local save = true
+    local moved = true
+
+    if record ~= "" then
+        local key = "vehicle" .. vehicle_id
+        local latest = redis.call("GET", key)
+        if latest then
+            local latest_timestamp = tonumber(
+                redis.call("HGET", "vehicle_location_timestamps", vehicle_id)
+            )
+            if latest_timestamp and timestamp < latest_timestamp then
+                save = false
+            elseif latest_timestamp and timestamp == latest_timestamp then
+                moved = false
+            elseif string.byte(latest) == 1
+                and string.sub(latest, 6, 25) == string.sub(record, 6, 25) then
+                -- same journey id and coordinates (see vehicles.location_encoding)
+                moved = false
+            end
+        end
+
+        if save then
+            redis.call("SET", key, record, "EX", 900)
+            redis.call("HSET", "vehicle_location_timestamps", vehicle_id, timestamp)
+            redis.call(
+                "GEOADD", "vehicle_location_locations",
+                ARGV[i + 2], ARGV[i + 3], vehicle_id
+            )
+            redis.call("ZADD", "vehicle_location_expiries", now + 900, vehicle_id)
+            local operator_id = nil
+            for set_name in string.gmatch(ARGV[i + 5], "%S+") do
+                redis.call("SADD", set_name, vehicle_id)
+                operator_id = (
+                    operator_id or string.match(set_name, "^operator(.+)vehicles$")
+                )
+            end
+            -- (for clustering in vehicles.views.get_clusters)
+            if operator_id then
+                redis.call(
+                    "HSET", "vehicle_location_operators", vehicle_id, operator_id
+                )
+            end
+            -- where the vehicle was, and which sets it was in, at its last few
+            -- versions, most recent first (see vehicles.views.was_in_view)
+            local states = version .. " " .. ARGV[i + 2] .. " " .. ARGV[i + 3]
+                .. " " .. ARGV[i + 5]
+            local previous = redis.call("HGET", "vehicle_location_states", vehicle_id)
+            if previous then
+                local count = 1
+                for state in string.gmatch(previous, "[^|]+") do
+                    if count == 3 then
+                        break
+                    end
+                    states = states .. "|" .. state
+                    count = count + 1
+                end
+            end
+            redis.call("HSET", "vehicle_location_states", vehicle_id, states)
+            table.insert(accepted, vehicle_id)
+        end
+    end
+
+    if save and moved and history_key ~= "" then
+        redis.call("RPUSH", history_key, ARGV[i + 7])
+        redis.call("EXPIRE", history_key, history_expire)
+        -- (see vehicles.history.LAST_POINTS_KEY)
+        redis.call("ZADD", "journey_history_last_points", timestamp, history_key)
+    end
+end
+
+local expired = redis.call(
+    "ZRANGEBYSCORE", "vehicle_location_expiries", "-inf", now, "LIMIT", 0, 1000
+)
+if #accepted > 0 or #expired > 0 then
+    redis.call("INCR", "vehicle_locations_version")
+    for _, vehicle_id in ipairs(accepted) do
+        redis.call("ZADD", "vehicle_location_versions", version, vehicle_id)
+        redis.call("ZREM", "vehicle_location_removals", vehicle_id)
+    end
+    for _, vehicle_id in ipairs(expired) do
+        redis.call("ZREM", "vehicle_location_expiries", vehicle_id)
+        redis.call("ZREM", "vehicle_location_versions", vehicle_id)
+        redis.call("ZREM", "vehicle_location_locations", vehicle_id)
+        redis.call("HDEL", "vehicle_location_operators", vehicle_id)
+        redis.call("HDEL", "vehicle_location_timestamps", vehicle_id)
+        redis.call("ZADD", "vehicle_location_removals", version, vehicle_id)
+    end
+    -- forget removals too old to be asked about (see vehicles.views.MAX_DELTA_VERSIONS)
+    -- and the removed vehicles' states
+    local forgotten = redis.call(
+        "ZRANGEBYSCORE", "vehicle_location_removals", "-inf", version - 10000
+    )
+    for _, vehicle_id in ipairs(forgotten) do
+        redis.call("HDEL", "vehicle_location_states", vehicle_id)
+    end
+    redis.call(
+        "ZREMRANGEBYSCORE", "vehicle_location_removals", "-inf", version - 10000
+    )
+end
+return accepted
+"""
+# (only hashed once - and called with whichever client is current, see save_locations)
+update_locations = Script(None, UPDATE_LOCATIONS_SCRIPT.encode())
+
 
 def same_journey(latest_journey, journey, latest_datetime, when):
     if not latest_journey:
@@ -67,13 +200,164 @@ def same_journey(latest_journey, journey, latest_datetime, when):
     return False
 
 
+class VehicleResolver:
+    """Remembers which vehicle each vehicle identity in a feed
+    (e.g. a VehicleCode like "FECS:69321") refers to,
+    so a poll only queries the database for vehicles it hasn't seen recently.
+
+    Vehicles edited or merged elsewhere are forgotten,
+    via the "vehicles_modified" sorted set that vehicles.signals adds to
+    """
+
+    modified_key = "vehicles_modified"
+
+    def __init__(self, command, max_size=50_000):
+        self.command = command
+        self.max_size = max_size
+        self.vehicles = OrderedDict()  # least recently used first
+        self.modified_version = None
+
+    def discard(self, vehicle_ids):
+        vehicle_ids = set(vehicle_ids)
+        for identity in [
+            identity
+            for identity, vehicle in self.vehicles.items()
+            if vehicle.id in vehicle_ids
+        ]:
+            del self.vehicles[identity]
+
+    def discard_modified(self):
+        if not redis_client:
+            return
+
+        if self.modified_version is None:
+            self.modified_version = int(
+                redis_client.get(f"{self.modified_key}_version") or 0
+            )
+            return
+
+        try:
+            modified = redis_client.zrangebyscore(
+                self.modified_key, f"({self.modified_version}", "+inf", withscores=True
+            )
+        except ConnectionError:
+            return
+        if modified:
+            self.discard(int(vehicle_id) for vehicle_id, _ in modified)
+            self.modified_version = int(modified[-1][1])
+
+    def prefetch(self, identities):
+        # one query for all the vehicles we don't already know about
+        scheme = self.command.vehicle_code_scheme
+        if scheme:
+            vehicle_codes = VehicleCode.objects.filter(
+                code__in=identities, scheme=scheme
+            ).select_related("vehicle__latest_journey__trip")
+            return {code.code: code.vehicle for code in vehicle_codes}
+
+        vehicles = self.command.vehicles.filter(
+            source=self.command.source, code__in=identities
+        )
+        return {vehicle.code: vehicle for vehicle in vehicles}
+
+    def get_many(self, items, identities) -> list:
+        """A vehicle (or None) for each item"""
+
+        if not identities:
+            return []
+
+        self.discard_modified()
+
+        if misses := {
+            identity for identity in identities if identity not in self.vehicles
+        }:
+            found = self.prefetch(misses)
+            self.vehicles.update(found)
+            misses.difference_update(found)
+
+        new_vehicles = {}  # unsaved vehicles, to create all at once
+        resolved = []
+
+        for item, identity in zip(items, identities):
+            if identity not in misses or identity in self.vehicles:
+                continue
+            try:
+                vehicle, _ = self.command.get_vehicle(item, commit=False)
+            except Vehicle.MultipleObjectsReturned as e:
+                logger.exception(e)
+                continue
+            if not vehicle:
+                continue
+            if not vehicle.id:
+                key = (vehicle.operator_id, vehicle.code.upper())
+                vehicle = new_vehicles.setdefault(key, vehicle)
+            self.vehicles[identity] = vehicle
+            resolved.append((identity, vehicle))
+
+        if new_vehicles:
+            self.create(new_vehicles.values())
+
+        for identity, vehicle in resolved:
+            if not vehicle.id:
+                del self.vehicles[identity]  # failed to create
+
+        if self.command.vehicle_code_scheme and resolved:
+            VehicleCode.objects.bulk_create(
+                [
+                    VehicleCode(
+                        code=identity,
+                        scheme=self.command.vehicle_code_scheme,
+                        vehicle=vehicle,
+                    )
+                    for identity, vehicle in resolved
+                    if vehicle.id
+                ]
+            )
+
+        vehicles = []
+        for identity in identities:
+            vehicle = self.vehicles.get(identity)
+            if vehicle is not None:
+                self.vehicles.move_to_end(identity)
+            vehicles.append(vehicle)
+
+        while len(self.vehicles) > self.max_size:
+            self.vehicles.popitem(last=False)
+
+        return vehicles
+
+    @staticmethod
+    def create(vehicles):
+        vehicles = list(vehicles)
+        for vehicle in vehicles:
+            vehicle.set_derived_fields()
+        try:
+            with transaction.atomic():
+                Vehicle.objects.bulk_create(vehicles)
+        except IntegrityError:
+            # probably created by another process since we looked -
+            # fall back to creating them one at a time
+            for vehicle in vehicles:
+                try:
+                    vehicle.save()
+                except IntegrityError as e:
+                    logger.exception(e)
+
+
 class ImportLiveVehiclesCommand(BaseCommand):
     url = ""
     vehicles = Vehicle.objects.select_related("latest_journey__trip")
     wait = 15
+    # False for commands that do their own thing in handle() - like listening to a
+    # websocket - instead of polling with update(), so run_live_feeds can't run them
+    polled = True
     history = True
     status = []
     status_key = None
+    # if get_vehicle_identity is defined, vehicles are remembered by a VehicleResolver
+    get_vehicle_identity = None
+    # remember vehicles using VehicleCodes with this scheme, instead of by code and source
+    vehicle_code_scheme = None
 
     @staticmethod
     def add_arguments(parser):
@@ -83,7 +367,14 @@ class ImportLiveVehiclesCommand(BaseCommand):
         super().__init__(*args, **kwargs)
         self.session = requests.Session()
         self.to_save = []
+        self.journeys_to_create = []
+        self.journeys_to_update = {}  # id: (journey, changed fields)
+        self.services_to_track = set()
         self.vehicles_to_update = []
+        self.vehicles_to_cache = set()  # ids of vehicles with new or changed journeys
+        self.vehicle_resolver = VehicleResolver(self)
+        self.trip_cache = TripCache()
+        self.metrics = IngestMetrics()
 
     @staticmethod
     def get_datetime(self):
@@ -132,25 +423,27 @@ class ImportLiveVehiclesCommand(BaseCommand):
         location = None
         if vehicle is None:
             try:
-                vehicle, vehicle_created = self.get_vehicle(item)
+                with self.metrics.stage("vehicles"):
+                    vehicle, vehicle_created = self.get_vehicle(item)
             except Vehicle.MultipleObjectsReturned as e:
                 logger.exception(e)
+                self.metrics.count("multiple_vehicles")
                 return
             if not vehicle:
+                self.metrics.count("no_vehicle")
                 return
 
         latest_datetime = None
 
         if latest is None:
-            latest = redis_client.get(f"vehicle{vehicle.id}")
-            if latest:
-                latest = json.loads(latest)
+            latest = decode_location(redis_client.get(f"vehicle{vehicle.id}"))
         if latest:
             latest_datetime = parse_datetime(latest["datetime"])
             latest_latlong = Point(*latest["coordinates"])
 
             if datetime and latest_datetime >= datetime:
                 # timestamp isn't newer
+                self.metrics.count("not_newer")
                 return
             else:
                 location = self.create_vehicle_location(item)
@@ -161,6 +454,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
                         # – if the vehicle was really stationary the location would "drift" a bit
                         datetime = latest_datetime
                     else:
+                        self.metrics.count("not_moved")
                         return
         # elif now and datetime and (now - datetime).total_seconds() > 600:
         #     # more than 10 minutes old
@@ -176,8 +470,10 @@ class ImportLiveVehiclesCommand(BaseCommand):
         if keep_journey:
             journey = latest_journey
         else:
-            journey = self.get_journey(item, vehicle)
+            with self.metrics.stage("journeys"):
+                journey = self.get_journey(item, vehicle)
         if not journey:
+            self.metrics.count("no_journey")
             return
         journey.vehicle = vehicle
 
@@ -190,6 +486,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
             if ((datetime or now) - latest_datetime).total_seconds() < 300:
                 # less than 5 minutes old
                 if latest_journey.service_id or not journey.service_id:
+                    self.metrics.count("other_source")
                     return  # defer to other source
 
         # if not latest and now and datetime:
@@ -199,6 +496,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
         if not location:
             location = self.create_vehicle_location(item)
             if not location:
+                self.metrics.count("no_location")
                 return
 
         if (
@@ -240,10 +538,15 @@ class ImportLiveVehiclesCommand(BaseCommand):
             if journey.datetime and journey.datetime != latest_journey.datetime:
                 latest_journey.datetime = journey.datetime
                 changed.append("datetime")
-            if changed:
-                latest_journey.save(update_fields=changed)
-                if changed != ["source"]:
-                    cache.delete(f"journey{latest_journey.id}")
+            if changed and latest_journey.id:
+                # (if it has no id it's still in journeys_to_create)
+                if latest_journey.id in self.journeys_to_update:
+                    self.journeys_to_update[latest_journey.id][1].update(changed)
+                else:
+                    self.journeys_to_update[latest_journey.id] = (
+                        latest_journey,
+                        set(changed),
+                    )
 
             journey = latest_journey
 
@@ -251,124 +554,273 @@ class ImportLiveVehiclesCommand(BaseCommand):
             journey.source = self.source
             if not journey.datetime:
                 journey.datetime = location.datetime
-            try:
-                journey.save()
-            except IntegrityError as e:
-                try:
-                    journey = vehicle.vehiclejourney_set.using("default").get(
-                        datetime=journey.datetime
-                    )
-                except VehicleJourney.DoesNotExist:
-                    logger.exception(e)
+            self.journeys_to_create.append(journey)
 
             if journey.service_id and VehicleJourney.service.is_cached(journey):
                 if not journey.service.tracking:
                     journey.service.tracking = True
-                    journey.service.save(update_fields=["tracking"])
+                    self.services_to_track.add(journey.service_id)
 
         location.id = vehicle.id
         location.journey = journey
 
-        if vehicle.latest_journey_id != journey.id:
+        if journey.id is None or vehicle.latest_journey_id != journey.id:
             vehicle.latest_journey = journey
             if type(item) is dict:
                 vehicle.latest_journey_data = item
             self.vehicles_to_update.append(vehicle)
 
         self.to_save.append((location, vehicle))
+        self.metrics.accept(location.datetime)
 
         return location, vehicle
 
+    def create_journeys(self):
+        journeys = self.journeys_to_create
+        self.journeys_to_create = []
+        try:
+            with transaction.atomic():
+                VehicleJourney.objects.bulk_create(journeys)
+        except IntegrityError:
+            # probably a journey with the same vehicle and datetime already exists -
+            # fall back to creating them one at a time
+            for journey in journeys:
+                journey.id = None
+                try:
+                    with transaction.atomic():
+                        journey.save()
+                except IntegrityError as e:
+                    journey.id = (
+                        VehicleJourney.objects.using("default")
+                        .filter(vehicle=journey.vehicle_id, datetime=journey.datetime)
+                        .values_list("id", flat=True)
+                        .first()
+                    )
+                    if journey.id:
+                        journey.refresh_from_db()
+                    else:
+                        logger.exception(e)
+
+    def update_journeys(self):
+        journeys = []
+        fields = set()
+        for journey, changed in self.journeys_to_update.values():
+            journeys.append(journey)
+            fields.update(changed)
+            if changed != {"source"}:
+                self.vehicles_to_cache.add(journey.vehicle_id)
+        self.journeys_to_update = {}
+
+        VehicleJourney.objects.bulk_update(journeys, fields)
+
     def save(self):
+        # write new and changed journeys
+        with self.metrics.stage("save_journeys"):
+            if self.journeys_to_create:
+                self.create_journeys()
+
+            if self.journeys_to_update:
+                self.update_journeys()
+
+            if self.services_to_track:
+                Service.objects.filter(
+                    id__in=self.services_to_track, tracking=False
+                ).update(tracking=True)
+                self.services_to_track = set()
+
         if not self.to_save:
             return
 
         # update vehicle records if necessary
-
         if self.vehicles_to_update:
-            try:
-                Vehicle.objects.bulk_update(
-                    self.vehicles_to_update,
-                    ["latest_journey", "latest_journey_data"],
-                )
-            except IntegrityError as e:
-                logger.exception(e)
-            self.vehicles_to_update = []
+            with self.metrics.stage("save_vehicles"):
+                self.update_vehicles()
 
-        # update locations in Redis
+        # so that vehicles.json doesn't have to
+        with self.metrics.stage("cache_journeys"):
+            cache_journeys(self.vehicles_to_cache)
+        self.vehicles_to_cache = set()
 
-        pipeline = redis_client.pipeline(transaction=False)
+        # update locations in Redis
+        with self.metrics.stage("save_locations"):
+            self.save_locations()
+
+    def update_vehicles(self):
+        # (unless a new journey couldn't be created)
+        self.vehicles_to_update = [
+            vehicle
+            for vehicle in self.vehicles_to_update
+            if vehicle.latest_journey is None or vehicle.latest_journey.id
+        ]
+        try:
+            Vehicle.objects.bulk_update(
+                self.vehicles_to_update,
+                ["latest_journey", "latest_journey_data"],
+            )
+        except IntegrityError as e:
+            logger.exception(e)
+        else:
+            self.vehicles_to_cache.update(
+                vehicle.id for vehicle in self.vehicles_to_update
+            )
+        self.vehicles_to_update = []
 
-        geoadd = []
-        sadd = {}
+    def save_locations(self):
+        args = [int(HISTORY_EXPIRE.total_seconds()), timezone.now().timestamp()]
+        live_count = 0
+        # to publish to the maps - vehicle id: (datetime, index in args, set names)
+        live = {}
+        # for playback - vehicle id: (timestamp, operator id, vehicle id, ...)
+        positions = {}
 
         for location, vehicle in self.to_save:
-            if not location.latlong or (
+            if not location.latlong:
+                continue
+
+            if self.history:
+                history_key, history_value = location.get_appendage()
+            else:
+                history_key = history_value = ""
+
+            if (
                 self.source.datetime
                 and (self.source.datetime - location.datetime).total_seconds() > 600
             ):
+                # too old for the live map, but add it to the journey history
+                args += [
+                    vehicle.id,
+                    location.datetime.timestamp(),
+                    0,
+                    0,
+                    "",
+                    "",
+                    history_key,
+                    history_value,
+                ]
                 continue
 
-            # update live map
-
-            geoadd += [location.latlong.x, location.latlong.y, vehicle.id]
-
+            set_names = []
             if location.journey.service_id:
-                key = f"service{location.journey.service_id}vehicles"
-                if key in sadd:
-                    sadd[key].append(vehicle.id)
-                else:
-                    sadd[key] = [vehicle.id]
+                set_names.append(f"service{location.journey.service_id}vehicles")
             if vehicle.operator_id:
-                key = f"operator{vehicle.operator_id}vehicles"
-                if key in sadd:
-                    sadd[key].append(vehicle.id)
-                else:
-                    sadd[key] = [vehicle.id]
+                set_names.append(f"operator{vehicle.operator_id}vehicles")
             try:
                 if (
                     location.journey.trip
                     and location.journey.trip.operator_id
                     and location.journey.trip.operator_id != vehicle.operator_id
                 ):
-                    key = f"operator{location.journey.trip.operator_id}vehicles"
-                    if key in sadd:
-                        sadd[key].append(vehicle.id)
-                    else:
-                        sadd[key] = [vehicle.id]
+                    set_names.append(
+                        f"operator{location.journey.trip.operator_id}vehicles"
+                    )
             except Trip.DoesNotExist:
                 location.journey.trip = None
 
-            redis_json = location.get_redis_json()
-            redis_json = json.dumps(redis_json, cls=DjangoJSONEncoder)
-            pipeline.set(f"vehicle{vehicle.id}", redis_json, ex=900)
-            # can't use 'mset' cos it doesn't let us specify an expiry (900 secs = 15 min)
+            set_names = " ".join(set_names)
+
+            live_count += 1
+            if vehicle.id not in live or live[vehicle.id][0] < location.datetime:
+                live[vehicle.id] = (location.datetime, len(args) + 4, set_names)
+                positions[vehicle.id] = (
+                    location.datetime.timestamp(),
+                    vehicle.operator_id,
+                    vehicle.id,
+                    location.journey.service_id,
+                    location.latlong.x,
+                    location.latlong.y,
+                    location.heading,
+                )
+            args += [
+                vehicle.id,
+                location.datetime.timestamp(),
+                location.latlong.x,
+                location.latlong.y,
+                location.get_redis_json(),  # (encoded below)
+                set_names,
+                history_key,
+                history_value,
+            ]
 
-        if geoadd:
-            pipeline.geoadd("vehicle_location_locations", geoadd)
-        for key in sadd:
-            pipeline.sadd(key, *sadd[key])
+        self.to_save = []
 
-        try:
-            pipeline.execute()
-        except ConnectionError:
-            pass
+        # work out trip progress and delay - so that pages showing the vehicles
+        # don't all have to - for all the vehicles on each trip at once
+        items = args[6::8]  # ("" if too old for the live map)
+        tracked_items = [item for item in items if item and "trip_id" in item]
+        with self.metrics.stage("progress"):
+            self.trip_cache.add_progress_and_delay(tracked_items)
+            # and which stops they're at, for journey_json etc
+            if self.history:
+                stop_events = self.trip_cache.get_stop_events(tracked_items)
+            else:
+                stop_events = []
+        args[6::8] = [item and encode_location(item) for item in items]
 
-        if self.history:
-            # add locations to journey history
+        if len(args) > 2:
+            try:
+                accepted = update_locations(args=args, client=redis_client)
+                if accepted:
+                    vehicle_ids = set(map(int, accepted))
+                    redis_client.publish(
+                        CHANNEL,
+                        pack_updates(
+                            [
+                                (args[live[vehicle_id][1]], live[vehicle_id][2])
+                                for vehicle_id in vehicle_ids
+                            ]
+                        ),
+                    )
+                    # (positions are recorded for playback even without history)
+                    self.save_history(stop_events, positions, vehicle_ids)
+            except ConnectionError:
+                pass
+            else:
+                if rejected := live_count - len(accepted):
+                    logger.info("%s locations older than ones already saved", rejected)
+                    self.metrics.count("older_than_saved", rejected)
 
-            pipeline = redis_client.pipeline(transaction=False)
+    @staticmethod
+    def save_history(stop_events, positions, vehicle_ids):
+        # (only those of locations newer than the ones already saved)
+        pipe = redis_client.pipeline(transaction=False)
+        for item, stop_time_id in stop_events:
+            if item["id"] in vehicle_ids and item["journey_id"]:
+                push_stop_event(
+                    pipe, item["journey_id"], stop_time_id, item["datetime"].timestamp()
+                )
+        push_positions(pipe, [positions[vehicle_id] for vehicle_id in vehicle_ids])
+        pipe.execute()
 
-            for location, vehicle in self.to_save:
-                if location.latlong:
-                    pipeline.rpush(*location.get_appendage())
+    def get_vehicles(self, items, identities) -> tuple[list, dict]:
+        """Vehicles for the items (see VehicleResolver), and their latest locations
+        (vehicle id: location dict)
+        """
 
-            self.to_save = []
+        with self.metrics.stage("vehicles"):
+            vehicles = self.vehicle_resolver.get_many(items, identities)
 
-            try:
-                pipeline.execute()
-            except ConnectionError:
-                pass
+        with self.metrics.stage("read_locations"):
+            vehicle_locations = redis_client.mget(
+                [f"vehicle{vehicle.id}" for vehicle in vehicles if vehicle]
+            )
+            vehicle_locations = {
+                location["id"]: location
+                for location in map(decode_location, filter(None, vehicle_locations))
+            }
+
+        # a remembered vehicle's latest journey may have been changed by another process
+        if stale := [
+            vehicle.id
+            for vehicle in vehicles
+            if vehicle
+            and vehicle.id in vehicle_locations
+            and vehicle_locations[vehicle.id]["journey_id"] != vehicle.latest_journey_id
+        ]:
+            self.vehicle_resolver.discard(stale)
+            with self.metrics.stage("vehicles"):
+                vehicles = self.vehicle_resolver.get_many(items, identities)
+
+        return vehicles, vehicle_locations
 
     def do_source(self):
         if self.url:
@@ -387,21 +839,34 @@ class ImportLiveVehiclesCommand(BaseCommand):
         wait = self.wait
 
         try:
-            if items := self.get_items():
-                i = 0
-                for item in items:
-                    try:
-                        # use `self.source.datetime` instead of `now`,
-                        # so `get_items` can increment the time
-                        # if it involves multiple spread out requests
-                        self.handle_item(item, self.source.datetime)
-                    except IntegrityError as e:
-                        logger.exception(e)
-                    i += 1
-                    if i == 50:
-                        self.save()
-                        i = 0
-                self.save()
+            with self.metrics.stage("download"):
+                items = self.get_items()
+            if items:
+                for chunk in batched(items, 50):
+                    if self.get_vehicle_identity:
+                        vehicles, vehicle_locations = self.get_vehicles(
+                            chunk, [self.get_vehicle_identity(item) for item in chunk]
+                        )
+                    else:
+                        vehicles = None
+                    for i, item in enumerate(chunk):
+                        try:
+                            # use `self.source.datetime` instead of `now`,
+                            # so `get_items` can increment the time
+                            # if it involves multiple spread out requests
+                            if vehicles is None:
+                                self.handle_item(item, self.source.datetime)
+                            elif vehicle := vehicles[i]:
+                                self.handle_item(
+                                    item,
+                                    self.source.datetime,
+                                    vehicle=vehicle,
+                                    latest=vehicle_locations.get(vehicle.id, False),
+                                )
+                        except IntegrityError as e:
+                            logger.exception(e)
+                            self.metrics.count("integrity_error")
+                    self.save()
             else:
                 wait = 120  # no items - wait 2 minutes
         except requests.exceptions.RequestException as e:
@@ -422,15 +887,20 @@ class ImportLiveVehiclesCommand(BaseCommand):
             self.status = self.status[-50:]
             cache.set(self.status_key, self.status, None)
 
+            self.metrics.flush(self.source_name, time_taken)
+
         if time_taken < wait:
             return wait - time_taken
         return 0  # took longer than minimum wait
 
-    def handle(self, immediate=False, *args, **options):
+    def load_status(self):
         if self.source_name:
             self.status_key = f'{self.source_name.replace(" ", "_")}_status'
             self.status = cache.get(self.status_key, [])
 
+    def handle(self, immediate=False, *args, **options):
+        self.load_status()
+
         if not immediate:
             sleep(self.wait)
         self.do_source()
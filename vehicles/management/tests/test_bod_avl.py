@@ -1,8 +1,13 @@
+import io
+from datetime import datetime, timezone
 from pathlib import Path
 from unittest import mock
 
 import fakeredis
 import time_machine
+import xmltodict
+import yaml
+from django.core.management import call_command
 from django.test import TestCase, override_settings
 from vcr import use_cassette
 
@@ -16,9 +21,12 @@ from busstops.models import (
     Service,
     StopPoint,
 )
+from bustimes import service_index
 from bustimes.models import Calendar, Garage, Route, StopTime, Trip
 
+from ... import location_encoding, playback, siri_vm, tiles
 from ...models import Livery, Vehicle, VehicleJourney
+from .. import import_live_vehicles
 from ..commands import import_bod_avl
 
 
@@ -117,6 +125,28 @@ class BusOpenDataVehicleLocationsTest(TestCase):
         )
 
     @time_machine.travel("2020-05-01", tick=False)
+    def test_get_indexed_service(self):
+        operators = [Operator.objects.get(noc="HAMS")]
+
+        with mock.patch(
+            "bustimes.service_index.redis_client", fakeredis.FakeStrictRedis()
+        ):
+            service_index.update_service_index([self.service_c.id])
+
+            command = import_bod_avl.Command()
+            self.assertEqual(
+                command.get_indexed_service(operators, ["C"], None, None),
+                self.service_c,
+            )
+
+            # no longer current, but still in the index
+            Service.objects.filter(id=self.service_c.id).update(current=False)
+            command.indexed_services.clear()
+            with self.assertNumQueries(1):
+                self.assertIsNone(
+                    command.get_indexed_service(operators, ["C"], None, None)
+                )
+
     def test_new_bod_avl_a(self):
         command = import_bod_avl.Command()
         command.source = self.source
@@ -138,10 +168,7 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                     "vehicles.management.import_live_vehicles.redis_client",
                     redis_client,
                 ),
-                mock.patch(
-                    "vehicles.management.commands.import_bod_avl.redis_client",
-                    redis_client,
-                ),
+                mock.patch("vehicles.ingest_metrics.redis_client", redis_client),
                 use_cassette(str(self.vcr_path / "bod_avl.yaml")) as cassette,
             ):
                 command.update()
@@ -151,6 +178,15 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                 with self.assertNumQueries(0):
                     command.update()
 
+                # metrics
+                response = self.client.get("/status/metrics.json")
+                metrics = response.json()["Bus Open Data"]
+                self.assertEqual(metrics["totals"]["cycles"], 2)
+                self.assertEqual(metrics["totals"]["items"]["unchanged"], 841)
+                self.assertEqual(metrics["last"]["items"], {"unchanged": 841})
+                self.assertEqual(metrics["last"]["stages"]["parse"]["calls"], 1)
+                self.assertEqual(metrics["last"]["stages"]["parse"]["queries"], 0)
+
             self.assertEqual(841, len(command.identifiers))
 
             # status page
@@ -278,15 +314,12 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             mock.patch(
                 "vehicles.management.import_live_vehicles.redis_client", redis_client
             ),
-            mock.patch(
-                "vehicles.management.commands.import_bod_avl.redis_client", redis_client
-            ),
             mock.patch(
                 "vehicles.management.commands.import_bod_avl.Command.get_items",
                 return_value=items,
             ),
         ):
-            with self.assertNumQueries(43):
+            with self.assertNumQueries(38):
                 wait = command.update()
             self.assertEqual(11, wait)
 
@@ -294,15 +327,19 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                 wait = command.update()
             self.assertEqual(30, wait)
 
+            # vehicles are remembered, so no queries
             items[0]["RecordedAtTime"] = "2020-10-30T05:09:00+00:00"
-            with self.assertNumQueries(1):
+            with self.assertNumQueries(0):
                 command.update()
 
             items[0]["RecordedAtTime"] = "2020-10-30T05:10:00+00:00"
             items[0]["OriginAimedDepartureTime"] = "2020-10-30T09:00:00+00:00"
-            with self.assertNumQueries(1):
+            with self.assertNumQueries(0):
                 wait = command.update()
 
+        # recorded for playback, too
+        self.assertTrue(redis_client.zcard(playback.BUCKETS_KEY))
+
         journeys = VehicleJourney.objects.all()
 
         self.assertEqual(3, journeys.count())
@@ -362,6 +399,61 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             json = response.json()
             self.assertEqual(len(json), 3)
 
+            # only vehicles changed since a version
+            response = self.client.get("/vehicles.json?since=0").json()
+            self.assertTrue(response["full"])
+            self.assertEqual(response["vehicles"], json)
+            version = response["version"]
+            self.assertTrue(version)
+
+            with self.assertNumQueries(0):
+                response = self.client.get(f"/vehicles.json?since={version}")
+            self.assertEqual(
+                response.json(),
+                {"version": version, "full": False, "vehicles": [], "removed": []},
+            )
+
+            response = self.client.get("/vehicles.json?since=ff")
+            self.assertEqual(response.status_code, 400)
+
+            # tile snapshots
+            with mock.patch("vehicles.tiles.redis_client", redis_client):
+                call_command("update_vehicle_tiles", "--once")
+                self.assertFalse(redis_client.exists(tiles.LOCK_KEY))
+
+                response = self.client.get("/vehicles/tiles.json")
+                self.assertEqual(response.json()["version"], version)
+
+                x, y = tiles.get_tile(0.285348, 51.2135, 12)
+                self.assertEqual((x, y), (2051, 1367))
+                with self.assertNumQueries(0):
+                    response = self.client.get(
+                        f"/vehicles/tiles/12/{x}/{y}.json?v={version}"
+                    )
+                self.assertEqual(
+                    [item["id"] for item in response.json()], [journey.vehicle_id]
+                )
+                self.assertIn("immutable", response["Cache-Control"])
+
+                response = self.client.get(f"/vehicles/tiles/12/{x + 1}/{y}.json")
+                self.assertEqual(response.json(), [])
+                self.assertEqual(response["Cache-Control"], "public, max-age=5")
+
+                response = self.client.get("/vehicles/tiles/13/0/0.json")
+                self.assertEqual(response.status_code, 404)
+
+                response = self.client.post("/vehicles/tiles.json")
+                self.assertEqual(response.status_code, 405)
+                response = self.client.post(f"/vehicles/tiles/12/{x}/{y}.json")
+                self.assertEqual(response.status_code, 405)
+
+            # without Redis
+            response = self.client.get("/vehicles/tiles.json")
+            self.assertEqual(response.json()["version"], 0)
+            response = self.client.get(f"/vehicles/tiles/12/{x}/{y}.json")
+            self.assertEqual(response.json(), [])
+            self.assertEqual(response["Cache-Control"], "public, max-age=5")
+
             # trip progress
 
             StopPoint.objects.create(
@@ -393,6 +485,42 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                 response = self.client.get("/vehicles.json?service=ff")
             self.assertEqual(response.status_code, 400)
 
+            # between versions, a vehicle moves out of the bounding box,
+            # and one that was never in it moves (so mustn't be "removed")
+            bounds = "xmin=0.2&ymin=51.2&xmax=0.3&ymax=51.3"
+            version = int(redis_client.get("vehicle_locations_version"))
+
+            def location(vehicle_id, longitude, latitude):
+                record = location_encoding.encode_location(
+                    {
+                        "id": vehicle_id,
+                        "journey_id": None,
+                        "coordinates": (longitude, latitude),
+                        "heading": None,
+                        "datetime": datetime(2023, 11, 14, tzinfo=timezone.utc),
+                    }
+                )
+                return [vehicle_id, 1_700_000_000, longitude, latitude, record]
+
+            import_live_vehicles.update_locations(
+                args=[3600, 0]
+                + location(journey.vehicle_id, 1.0, 52.0)
+                + ["operatorHAMSvehicles", "", ""]
+                + location(999999, -3.0, 55.0)
+                + ["", "", ""],
+                client=redis_client,
+            )
+            response = self.client.get(f"/vehicles.json?{bounds}&since={version}")
+            self.assertEqual(
+                response.json(),
+                {
+                    "version": version + 1,
+                    "full": False,
+                    "vehicles": [],
+                    "removed": [journey.vehicle_id],
+                },
+            )
+
             # test history view
             whippet_journey = VehicleJourney.objects.get(vehicle__operator="WHIP")
 
@@ -415,6 +543,55 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             self.assertContains(response, '<a href="/services/u">U</a>')
             self.assertContains(response, '<a href="/services/u/vehicles">')
 
+    @time_machine.travel("2020-10-17T10:00:00", tick=False)
+    def test_new_journey_keeps_vehicle_remembered(self):
+        item = {
+            "RecordedAtTime": "2020-10-17T08:34:00+00:00",
+            "MonitoredVehicleJourney": {
+                "LineRef": "U",
+                "OperatorRef": "WHIP",
+                "OriginAimedDepartureTime": "2020-10-17T08:23:00+00:00",
+                "VehicleLocation": {"Longitude": "0.141533", "Latitude": "52.1727219"},
+                "VehicleRef": "WHIP-107",
+            },
+        }
+
+        command = import_bod_avl.Command()
+        command.source = self.source
+        command.source.datetime = datetime(2020, 10, 17, 10, tzinfo=timezone.utc)
+
+        redis_client = fakeredis.FakeStrictRedis(version=7)
+
+        with (
+            mock.patch(
+                "vehicles.management.import_live_vehicles.redis_client", redis_client
+            ),
+            mock.patch("vehicles.signals.redis_client", redis_client),
+            mock.patch.object(VehicleJourney, "get_trip", return_value=self.trip),
+            mock.patch(
+                "vehicles.management.commands.import_bod_avl.Command.get_items",
+                return_value=[item],
+            ),
+        ):
+            command.update()
+
+            # a later journey by the same vehicle, matched to a trip
+            item["RecordedAtTime"] = "2020-10-17T09:40:00+00:00"
+            item["MonitoredVehicleJourney"]["OriginAimedDepartureTime"] = (
+                "2020-10-17T09:30:00+00:00"
+            )
+            command.update()
+
+        vehicle = Vehicle.objects.get(operator="WHIP", code="107")
+        self.assertEqual(vehicle.garage_id, self.trip.garage_id)
+        self.assertEqual(vehicle.vehiclejourney_set.count(), 2)
+
+        # only "live" fields were saved, so the vehicle wasn't invalidated
+        self.assertIsNone(redis_client.get("vehicles_modified_version"))
+        self.assertIn(
+            vehicle.id, [v.id for v in command.vehicle_resolver.vehicles.values()]
+        )
+
     def test_handle_item(self):
         command = import_bod_avl.Command()
         command.source = self.source
@@ -562,6 +739,55 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                 ],
             )
 
+            # clusters
+            with (
+                mock.patch(
+                    "vehicles.views.redis_client.geosearch",
+                    return_value=[
+                        [b"1", (1.61, 52.31)],
+                        [b"2", (1.63, 52.33)],
+                        [b"3", (1.69, 52.39)],
+                    ],
+                ),
+                mock.patch(
+                    "vehicles.views.redis_client.hmget",
+                    return_value=[b"BB", None, b"FECS"],
+                ),
+                mock.patch("vehicles.views.CLUSTER_THRESHOLD", 2),
+                self.assertNumQueries(0),
+            ):
+                response = self.client.get(
+                    "/vehicles.json?ymax=52.4&xmax=1.7&ymin=52.3&xmin=1.6&cluster=2"
+                )
+            self.assertEqual(
+                response.json(),
+                {
+                    "count": 3,
+                    "clusters": [
+                        {"count": 2, "coordinates": [1.62, 52.32], "operator": "BB"},
+                        {"count": 1, "coordinates": [1.69, 52.39], "operator": "FECS"},
+                    ],
+                },
+            )
+
+            # below the threshold - vehicles as normal
+            with (
+                mock.patch(
+                    "vehicles.views.redis_client.geosearch",
+                    return_value=[[str(vehicle.id).encode(), (1.675893, 52.328398)]],
+                ),
+                self.assertNumQueries(1),
+            ):
+                response = self.client.get(
+                    "/vehicles.json?ymax=52.4&xmax=1.7&ymin=52.3&xmin=1.6&cluster=8"
+                )
+            self.assertEqual(response.json()[0]["id"], vehicle.id)
+
+            response = self.client.get(
+                "/vehicles.json?ymax=52.4&xmax=1.7&ymin=52.3&xmin=1.6&cluster=100"
+            )
+            self.assertEqual(response.status_code, 400)
+
             with self.assertNumQueries(1):
                 response = self.client.get("/vehicles.json")
             self.assertEqual(
@@ -1214,3 +1440,136 @@ class BusOpenDataVehicleLocationsTest(TestCase):
         with use_cassette(str(self.vcr_path / "bod_avl_error.yaml")):
             items = command.get_items()
             self.assertEqual(items, [])
+
+    def test_siri_vm_parser(self):
+        with (self.vcr_path / "bod_avl.yaml").open() as open_file:
+            body = yaml.safe_load(open_file)["interactions"][0]["response"]["body"]
+        body = body["string"].encode()
+
+        items = siri_vm.iter_vehicle_activities(io.BytesIO(body))
+
+        header = next(items)
+        self.assertEqual(
+            header["ResponseTimestamp"], "2020-07-24T14:14:46.261274+00:00"
+        )
+        self.assertEqual(header["ProducerRef"], "ItoWorld")
+
+        # same as the old, slower way
+        data = xmltodict.parse(body, force_list=["VehicleActivity"])
+        self.assertEqual(
+            list(items),
+            data["Siri"]["ServiceDelivery"]["VehicleMonitoringDelivery"][
+                "VehicleActivity"
+            ],
+        )
+
+    @mock.patch(
+        "vehicles.management.import_live_vehicles.redis_client",
+        fakeredis.FakeStrictRedis(version=7),
+    )
+    def test_journey_already_exists(self):
+        command = import_bod_avl.Command()
+        command.source = self.source
+
+        vehicle = Vehicle.objects.get(code="11111")
+        journey = VehicleJourney.objects.create(
+            vehicle=vehicle,
+            datetime="2021-05-08T12:30:00+00:00",
+            source=self.source,
+            route_name="8",
+        )
+
+        command.handle_item(
+            {
+                "RecordedAtTime": "2021-05-08T12:54:36+00:00",
+                "ItemIdentifier": "db82c74d-e2ac-48f4-8963-4cea2d706b6d",
+                "ValidUntilTime": "2021-05-08T12:59:47.376621",
+                "MonitoredVehicleJourney": {
+                    "LineRef": "8",
+                    "PublishedLineName": "8",
+                    "OperatorRef": "FECS",
+                    "OriginAimedDepartureTime": "2021-05-08T12:30:00+00:00",
+                    "VehicleLocation": {"Longitude": "1.2", "Latitude": "52.6"},
+                    "VehicleRef": "11111",
+                },
+                "Extensions": None,
+            }
+        )
+        self.assertEqual(len(command.journeys_to_create), 1)
+        command.save()
+
+        self.assertEqual(VehicleJourney.objects.get(), journey)
+        vehicle.refresh_from_db()
+        self.assertEqual(vehicle.latest_journey, journey)
+
+    def test_update_locations_script(self):
+        redis_client = fakeredis.FakeStrictRedis(version=7)
+        update_locations = redis_client.register_script(
+            import_live_vehicles.UPDATE_LOCATIONS_SCRIPT
+        )
+
+        def location(timestamp, longitude, journey_id, history_value):
+            record = location_encoding.encode_location(
+                {
+                    "id": 1,
+                    "journey_id": journey_id,
+                    "coordinates": (longitude, 52.0),
+                    "heading": None,
+                    "datetime": datetime.fromtimestamp(timestamp, timezone.utc),
+                }
+            )
+            return [
+                3600,
+                timestamp,
+                1,
+                timestamp,
+                longitude,
+                52.0,
+                record,
+                "service2vehicles operatorFECSvehicles",
+                f"journey{journey_id}",
+                history_value,
+            ]
+
+        self.assertEqual(update_locations(args=location(100, 1.0, 3, "a")), [b"1"])
+        # older - ignored
+        self.assertEqual(update_locations(args=location(90, 1.1, 3, "b")), [])
+        # newer, but hasn't moved - not added to history
+        self.assertEqual(update_locations(args=location(110, 1.0, 3, "c")), [b"1"])
+        self.assertEqual(update_locations(args=location(120, 1.2, 3, "d")), [b"1"])
+
+        self.assertEqual(redis_client.lrange("journey3", 0, -1), [b"a", b"d"])
+        self.assertEqual(redis_client.ttl("journey3"), 3600)
+        self.assertEqual(redis_client.get("vehicle_locations_version"), b"3")
+        self.assertEqual(redis_client.zscore("vehicle_location_versions", 1), 3)
+        self.assertEqual(redis_client.hget("vehicle_location_operators", 1), b"FECS")
+        sets = "service2vehicles operatorFECSvehicles"
+        self.assertEqual(
+            redis_client.hget("vehicle_location_states", 1).decode(),
+            f"3 1.2 52.0 {sets}|2 1.0 52.0 {sets}|1 1.0 52.0 {sets}",
+        )
+
+        # expired 15 minutes after the last location was saved
+        self.assertEqual(update_locations(args=[3600, 1020]), [])
+        self.assertEqual(redis_client.get("vehicle_locations_version"), b"4")
+        self.assertIsNone(redis_client.zscore("vehicle_location_versions", 1))
+        self.assertEqual(redis_client.zscore("vehicle_location_removals", 1), 4)
+        self.assertIsNone(redis_client.hget("vehicle_location_operators", 1))
+        self.assertIsNone(redis_client.hget("vehicle_location_timestamps", 1))
+        self.assertEqual(
+            redis_client.zrange("journey_history_last_points", 0, -1, withscores=True),
+            [(b"journey3", 120.0)],
+        )
+        self.assertEqual(
+            location_encoding.decode_location(redis_client.get("vehicle1")),
+            {
+                "id": 1,
+                "journey_id": 3,
+                "coordinates": [1.2, 52.0],
+                "heading": None,
+                "datetime": "1970-01-01T00:02:00Z",
+            },
+        )
+        self.assertEqual(redis_client.smembers("operatorFECSvehicles"), {b"1"})
+        # no longer on the map
+        self.assertEqual(redis_client.zrange("vehicle_location_locations", 0, -1), [])
@@ -45,7 +45,7 @@ class EdinburghImportTest(TestCase):
             with mock.patch(
                 "vehicles.management.import_live_vehicles.redis_client", redis_client
             ):
-                with self.assertNumQueries(28):
+                with self.assertNumQueries(29):
                     command.update()
 
                 self.assertEqual({}, command.vehicle_cache)
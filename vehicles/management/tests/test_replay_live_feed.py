@@ -0,0 +1,128 @@
+import datetime
+import os
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import fakeredis
+import requests
+import time_machine
+from django.core.management import call_command
+from django.test import TestCase
+from vcr import use_cassette
+
+from busstops.models import Operator, Region
+from vehicles.models import VehicleJourney
+
+from ...feed_recordings import (
+    INDEX,
+    Recorder,
+    ReplayAdapter,
+    get_replay_session,
+    read_recording,
+)
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+URL = "http://sojbuslivetimespublic.azurewebsites.net/api/Values/GetMin?secondsAgo=360"
+
+
+class ReplayLiveFeedTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Region.objects.create(id="JE")
+        Operator.objects.create(noc="libertybus", region_id="JE")
+
+    def record(self, path):
+        recorder = Recorder(path)
+        session = requests.Session()
+        session.hooks["response"].append(recorder)
+
+        with use_cassette(
+            os.path.join(DIR, "vcr", "import_live_jersey.yaml"),
+            decode_compressed_response=True,
+            allow_playback_repeats=True,
+        ):
+            session.get(URL)
+            recorder.cycle += 1
+            session.get(URL)
+
+    def test_recording(self):
+        with TemporaryDirectory() as path:
+            self.record(path)
+
+            cycles = read_recording(path)
+            self.assertEqual(len(cycles), 2)
+            self.assertEqual(cycles[0][0]["url"], URL)
+            self.assertEqual(
+                cycles[0][0]["headers"]["Content-Type"],
+                "application/json; charset=utf-8",
+            )
+            self.assertNotIn("content-length", cycles[0][0]["headers"])
+
+            # carries on from the end of an existing recording
+            recorder = Recorder(path)
+            self.assertEqual(recorder.count, 2)
+            self.assertEqual(recorder.cycle, 2)
+
+            adapter = ReplayAdapter(path)
+            session = get_replay_session(adapter)
+            adapter.load_cycle(cycles[1])
+
+            response = session.get(URL)
+            self.assertEqual(len(response.json()["minimumInfoUpdates"]), 2)
+
+            # only recorded once in this cycle
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                session.get(URL)
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                session.get("https://example.com")
+
+    def test_credentials_redacted(self):
+        url = "https://example.com/feed?api_key=s3cret&operator=FOO&token=t0ken"
+
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response._content = b"[]"
+        response.request = requests.Request("GET", url).prepare()
+
+        with TemporaryDirectory() as path:
+            Recorder(path)(response)
+
+            index = (Path(path) / INDEX).read_text()
+            self.assertNotIn("s3cret", index)
+            self.assertNotIn("t0ken", index)
+            cycles = read_recording(path)
+            self.assertEqual(
+                cycles[0][0]["url"],
+                "https://example.com/feed?api_key=REDACTED&operator=FOO&token=REDACTED",
+            )
+
+            # replayed for a request with the real credentials
+            adapter = ReplayAdapter(path)
+            session = get_replay_session(adapter)
+            adapter.load_cycle(cycles[0])
+            self.assertEqual(session.get(url).json(), [])
+
+    @patch(
+        "vehicles.management.import_live_vehicles.redis_client",
+        fakeredis.FakeStrictRedis(),
+    )
+    @time_machine.travel(datetime.datetime(2018, 8, 21, 0, 0, 9))
+    def test_replay(self):
+        with TemporaryDirectory() as path:
+            self.record(path)
+
+            stdout = StringIO()
+            call_command(
+                "replay_live_feed", "import_live_jersey", path, speed=0, stdout=stdout
+            )
+
+        self.assertEqual(VehicleJourney.objects.count(), 2)
+
+        output = stdout.getvalue()
+        self.assertIn("cycle 1: 2 items", output)
+        self.assertIn("cycle 2: 2 items", output)  # (not newer)
+        self.assertIn("2 cycles, 4 items in ", output)
+        self.assertIn("cycle latency: mean ", output)
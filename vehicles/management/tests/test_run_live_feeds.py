@@ -0,0 +1,26 @@
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+
+from ..commands import import_bushub, import_nx, run_live_feeds
+
+
+class RunLiveFeedsTest(SimpleTestCase):
+    def test_get_feed_command(self):
+        command = run_live_feeds.Command.get_feed_command("import_nx")
+        self.assertIsInstance(command, import_nx.Command)
+
+        command = run_live_feeds.Command.get_feed_command("import_bushub:Bus Hub X")
+        self.assertIsInstance(command, import_bushub.Command)
+        self.assertEqual(command.source_name, "Bus Hub X")
+
+        with self.assertRaises(CommandError):
+            run_live_feeds.Command.get_feed_command("run_live_feeds")
+        with self.assertRaises(CommandError):
+            run_live_feeds.Command.get_feed_command("import_nothing")
+        # listens to a websocket instead of polling
+        with self.assertRaisesMessage(CommandError, "doesn't poll"):
+            run_live_feeds.Command.get_feed_command("import_first:Aberdeen")
+
+    def test_get_session(self):
+        session = run_live_feeds.get_session(30)
+        self.assertEqual(session.get_adapter("https://example.com")._pool_maxsize, 30)
@@ -10,6 +10,7 @@ from vcr import use_cassette
 
 from busstops.models import DataSource
 
+from ... import location_encoding, siri_queue, tasks
 from ...models import SiriSubscription, Vehicle
 
 
@@ -98,13 +99,8 @@ class SiriPostTest(TestCase):
     </ServiceDelivery>
 </Siri>"""
 
-        with (
-            mock.patch(
-                "vehicles.management.import_live_vehicles.redis_client", redis_client
-            ),
-            mock.patch(
-                "vehicles.management.commands.import_bod_avl.redis_client", redis_client
-            ),
+        with mock.patch(
+            "vehicles.management.import_live_vehicles.redis_client", redis_client
         ):
             response = self.client.post(
                 "/siri/475d1d1f-5708-4ee1-8f51-c63d948bc0b9",
@@ -118,3 +114,68 @@ class SiriPostTest(TestCase):
 
         response = self.client.get("/siri/475d1d1f-5708-4ee1-8f51-c63d948bc0b9")
         self.assertEqual(response.headers["Content-Type"], "text/xml")
+
+    @time_machine.travel("2024-03-15T06:09:50Z")
+    def test_siri_post_queue(self):
+        redis_client = fakeredis.FakeStrictRedis(version=7)
+        uuid = "475d1d1f-5708-4ee1-8f51-c63d948bc0b9"
+        tasks.get_bod_avl_command.cache_clear()  # forget vehicles from other tests
+
+        def delivery(time, latitude):
+            return f"""<?xml version="1.0" encoding="UTF-8" ?>
+<Siri xmlns="http://www.siri.org.uk/siri" version="1.3">
+    <ServiceDelivery>
+        <ResponseTimestamp>{time}</ResponseTimestamp>
+        <VehicleMonitoringDelivery>
+            <VehicleActivity>
+                <RecordedAtTime>{time}</RecordedAtTime>
+                <MonitoredVehicleJourney>
+                    <VehicleRef>NADT-MB181</VehicleRef>
+                    <OperatorRef>NADT</OperatorRef>
+                    <VehicleLocation>
+                        <Latitude>{latitude}</Latitude>
+                        <Longitude>-3.3494811</Longitude>
+                    </VehicleLocation>
+                </MonitoredVehicleJourney>
+            </VehicleActivity>
+        </VehicleMonitoringDelivery>
+    </ServiceDelivery>
+</Siri>"""
+
+        with (
+            mock.patch("vehicles.views.redis_client", redis_client),
+            mock.patch("vehicles.siri_queue.redis_client", redis_client),
+            mock.patch(
+                "vehicles.management.import_live_vehicles.redis_client", redis_client
+            ),
+        ):
+            for data in (
+                delivery("2024-03-15T06:09:42+00:00", "51.3869667"),
+                # cut off, so it can't be parsed
+                delivery("2024-03-15T06:09:45+00:00", "51.3874667")[:-30],
+                delivery("2024-03-15T06:09:47+00:00", "51.3879667"),
+            ):
+                response = self.client.post(
+                    f"/siri/{uuid}", data=data, content_type="text/xml"
+                )
+                self.assertEqual(200, response.status_code)
+
+            # not handled yet
+            self.assertEqual(redis_client.llen(siri_queue.get_queue_key(uuid)), 3)
+            self.assertFalse(Vehicle.objects.exists())
+
+            # the bad delivery doesn't stop the others being handled
+            with self.assertLogs("vehicles.tasks", "WARNING"):
+                tasks.handle_siri_post(uuid)
+            self.assertFalse(redis_client.exists(siri_queue.get_queue_key(uuid)))
+            self.assertFalse(redis_client.exists(siri_queue.get_pending_key(uuid)))
+
+            # only the latest location of the vehicle
+            vehicle = Vehicle.objects.get()
+            location = location_encoding.decode_location(
+                redis_client.get(f"vehicle{vehicle.id}")
+            )
+            self.assertAlmostEqual(location["coordinates"][1], 51.3879667, 5)
+
+            response = self.client.get(f"/siri/{uuid}")
+            self.assertContains(response, "51.3879667")
@@ -281,6 +281,14 @@ class Vehicle(models.Model):
         return not self.locked
 
     def save(self, *args, update_fields=None, **kwargs):
+        self.set_derived_fields(update_fields)
+
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+    def set_derived_fields(self, update_fields=None):
+        """Fill in fleet_code, fleet_number and reg from each other.
+        Called by save(), and should be called before bulk_create()
+        """
         if (
             update_fields is None or "fleet_number" in update_fields
         ) and self.fleet_number:
@@ -304,8 +312,6 @@ class Vehicle(models.Model):
         elif update_fields is None or "reg" in update_fields:
             self.reg = self.reg.upper().replace(" ", "")
 
-        super().save(*args, update_fields=update_fields, **kwargs)
-
     class Meta:
         indexes = [
             models.Index(Upper("fleet_code"), name="fleet_code"),
@@ -0,0 +1,379 @@
+"""Where all the vehicles were at a past time, for "map at time T" playback.
+
+Journey histories (see history) can only be read a journey at a time, so as live
+importers save locations they also record each vehicle's latest position in
+BUCKET-second buckets - a Redis hash per bucket and operator, of vehicle id:
+packed position (see ImportLiveVehiclesCommand.save_locations).
+
+Like journey histories, archive() moves buckets to compressed files on disk before
+they expire - one file per operator per hour, sorted by bucket, which later runs
+merge more buckets into - and get_playback() reads buckets from Redis while they're
+hot and from the archive when they're cold. Each day's directory has an index of
+the range of buckets in each file, so only the files that cover them are read.
+"""
+
+import json
+import logging
+import struct
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from redis.exceptions import ConnectionError
+
+from .history import ARCHIVE_AFTER, EXPIRE
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+BUCKET = 60  # seconds
+
+# how far back to look for vehicles that haven't reported in a bucket
+LOOKBACK = 5 * BUCKET
+
+PARTITION = 3600  # seconds of buckets in each archive file
+
+# in each day's archive directory - {file path: [first bucket, last bucket]}
+INDEX = "index.json"
+
+# bucket key: bucket timestamp
+BUCKETS_KEY = "vehicle_positions_buckets"
+
+# vehicle id, service id (0 if none), longitude, latitude, has heading, heading
+position_struct = struct.Struct("I I 2f ?h")
+
+position_dtype = np.dtype(
+    {
+        "names": ["vehicle_id", "service_id", "x", "y", "has_heading", "heading"],
+        "formats": [np.uint32, np.uint32, np.float32, np.float32, np.bool_, np.int16],
+        "offsets": [0, 4, 8, 12, 16, 18],
+        "itemsize": position_struct.size,
+    }
+)
+
+
+def get_bucket(timestamp: float) -> int:
+    return int(timestamp) // BUCKET * BUCKET
+
+
+def get_bucket_key(bucket: int, operator_id) -> str:
+    return f"vehicle_positions:{bucket}:{operator_id or '_'}"
+
+
+def get_archive_dir() -> Path:
+    return Path(
+        getattr(
+            settings, "VEHICLE_POSITIONS_DIR", settings.DATA_DIR / "vehicle_positions"
+        )
+    )
+
+
+def get_date(bucket: int):
+    return timezone.localdate(datetime.fromtimestamp(bucket, dt_timezone.utc))
+
+
+def get_date_dir(date) -> Path:
+    return get_archive_dir() / date.isoformat()
+
+
+def get_partition_name(bucket: int, operator_id) -> str:
+    """Relative to the day's directory"""
+    return f"{operator_id or '_'}/{bucket // PARTITION * PARTITION}.npz"
+
+
+def read_index(date_dir: Path) -> dict:
+    try:
+        return json.loads((date_dir / INDEX).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def write_index(date_dir: Path, index: dict):
+    tmp_path = date_dir / f"{INDEX}.tmp"
+    tmp_path.write_text(json.dumps(index, sort_keys=True))
+    tmp_path.rename(date_dir / INDEX)
+
+
+def push_positions(pipe, positions):
+    """positions is a list of
+    (timestamp, operator id, vehicle id, service id, longitude, latitude, heading)
+    tuples - only the latest one for each vehicle in each bucket is kept
+    """
+    for timestamp, operator_id, vehicle_id, service_id, x, y, heading in positions:
+        if type(heading) is str:  # (see VehicleLocation.get_appendage)
+            heading = float(heading) if heading else None
+        bucket = get_bucket(timestamp)
+        key = get_bucket_key(bucket, operator_id)
+        pipe.hset(
+            key,
+            vehicle_id,
+            position_struct.pack(
+                vehicle_id,
+                service_id or 0,
+                x,
+                y,
+                heading is not None,
+                0 if heading is None else round(heading),
+            ),
+        )
+        pipe.expire(key, EXPIRE)
+        pipe.zadd(BUCKETS_KEY, {key: bucket})
+
+
+def decode_positions(values):
+    return np.frombuffer(b"".join(values), dtype=position_dtype)
+
+
+def write_partition(path: Path, buckets: list) -> tuple:
+    """buckets is a list of (bucket timestamp, [packed positions]) tuples -
+    merged with the file's existing buckets, if any.
+    Returns the first and last bucket in the file
+    """
+
+    bucket_column = np.repeat(
+        np.array([bucket for bucket, _ in buckets], np.uint32),
+        [len(values) for _, values in buckets],
+    )
+    rows = decode_positions([b"".join(values) for _, values in buckets])
+
+    if path.exists():
+        old_buckets, old_rows = read_partition(path)
+        bucket_column = np.concatenate([old_buckets, bucket_column])
+        rows = np.concatenate([old_rows, rows])
+
+    # sort by bucket, and only keep each vehicle's last position in each bucket
+    # (in case a bucket was archived again after an interruption)
+    order = np.lexsort((rows["vehicle_id"], bucket_column))
+    bucket_column = bucket_column[order]
+    rows = rows[order]
+    keep = np.ones(len(rows), np.bool_)
+    keep[:-1] = (bucket_column[1:] != bucket_column[:-1]) | (
+        rows["vehicle_id"][1:] != rows["vehicle_id"][:-1]
+    )
+    bucket_column = bucket_column[keep]
+    rows = rows[keep]
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".npz.tmp")
+    with tmp_path.open("wb") as open_file:
+        np.savez_compressed(
+            open_file,
+            bucket=bucket_column,
+            **{name: np.ascontiguousarray(rows[name]) for name in position_dtype.names},
+        )
+    tmp_path.rename(path)
+
+    return int(bucket_column[0]), int(bucket_column[-1])
+
+
+def read_partition(path: Path, first=None, last=None) -> tuple:
+    """The buckets and positions from first to last bucket (inclusive),
+    or all of them
+    """
+
+    with np.load(path) as archive:
+        buckets = archive["bucket"]
+        start = 0 if first is None else np.searchsorted(buckets, first, "left")
+        end = len(buckets) if last is None else np.searchsorted(buckets, last, "right")
+
+        positions = np.empty(end - start, position_dtype)
+        for name in position_dtype.names:
+            positions[name] = archive[name][start:end]
+
+    return buckets[start:end], positions
+
+
+def get_archived(first: int, last: int, operator_ids=None) -> tuple:
+    """The buckets and positions from first to last bucket (inclusive),
+    from the archive files whose range of buckets overlaps
+    """
+
+    results = []
+
+    date = get_date(first)
+    while date <= get_date(last):
+        date_dir = get_date_dir(date)
+        for name, (file_first, file_last) in sorted(read_index(date_dir).items()):
+            if file_first > last or file_last < first:
+                continue
+            if operator_ids and name.split("/", 1)[0] not in operator_ids:
+                continue
+            results.append(read_partition(date_dir / name, first, last))
+        date += timedelta(days=1)
+
+    if not results:
+        return np.empty(0, np.uint32), np.empty(0, position_dtype)
+    return (
+        np.concatenate([buckets for buckets, _ in results]),
+        np.concatenate([positions for _, positions in results]),
+    )
+
+
+def get_hot(first: int, last: int, operator_ids=None) -> tuple:
+    """The buckets and positions from first to last bucket (inclusive) still in
+    Redis, or None if Redis couldn't be asked
+    """
+
+    if not redis_client:
+        return
+
+    try:
+        if operator_ids:
+            keys = [
+                (get_bucket_key(bucket, operator_id), bucket)
+                for bucket in range(first, last + 1, BUCKET)
+                for operator_id in operator_ids
+            ]
+        else:
+            keys = redis_client.zrangebyscore(BUCKETS_KEY, first, last, withscores=True)
+        pipe = redis_client.pipeline(transaction=False)
+        for key, _ in keys:
+            pipe.hvals(key)
+        values = pipe.execute()
+    except ConnectionError:
+        return
+
+    return (
+        np.repeat(
+            np.array([bucket for _, bucket in keys], np.uint32),
+            [len(key_values) for key_values in values],
+        ),
+        decode_positions([value for key_values in values for value in key_values]),
+    )
+
+
+def get_rows(first: int, last: int, operator_ids=None) -> tuple:
+    """The buckets and positions from first to last bucket (inclusive), sorted by
+    bucket - from Redis, and from the archive for any older buckets not in Redis
+    """
+
+    buckets, positions = get_hot(first, last, operator_ids) or (None, None)
+    if buckets is None or not len(buckets):
+        buckets, positions = get_archived(first, last, operator_ids)
+    elif (hot_first := int(buckets.min())) > first:
+        cold_buckets, cold_positions = get_archived(
+            first, hot_first - BUCKET, operator_ids
+        )
+        buckets = np.concatenate([cold_buckets, buckets])
+        positions = np.concatenate([cold_positions, positions])
+
+    order = np.argsort(buckets, kind="stable")
+    return buckets[order], positions[order]
+
+
+def get_latest(positions):
+    """Each vehicle's last position, from positions sorted by bucket"""
+
+    if not len(positions):
+        return positions
+    order = np.argsort(positions["vehicle_id"], kind="stable")
+    positions = positions[order]
+    vehicle_ids = positions["vehicle_id"]
+    last = np.ones(len(positions), np.bool_)
+    last[:-1] = vehicle_ids[1:] != vehicle_ids[:-1]
+    return positions[last]
+
+
+def get_playback(bucket: int, count: int, operator_ids=None) -> list:
+    """A structured array for each of count buckets of where the vehicles were,
+    hot or cold - all operators' unless operator ids are specified.
+
+    Vehicles don't all report every BUCKET seconds, so each vehicle's position in a
+    bucket is its last one in the LOOKBACK seconds up to and including the bucket
+    """
+
+    first = bucket - LOOKBACK + BUCKET
+    last = bucket + (count - 1) * BUCKET
+    buckets, positions = get_rows(first, last, operator_ids)
+
+    result = []
+    for bucket in range(bucket, last + 1, BUCKET):
+        start = np.searchsorted(buckets, bucket - LOOKBACK, "right")
+        end = np.searchsorted(buckets, bucket, "right")
+        result.append(get_latest(positions[start:end]))
+    return result
+
+
+def get_positions(bucket: int, operator_ids=None):
+    """Where the vehicles were in a bucket (see get_playback)"""
+    return get_playback(bucket, 1, operator_ids)[0]
+
+
+def positions_json(positions, bounds=None, service_ids=None) -> list:
+    if bounds:
+        xmin, ymin, xmax, ymax = bounds
+        positions = positions[
+            (positions["x"] >= xmin)
+            & (positions["x"] <= xmax)
+            & (positions["y"] >= ymin)
+            & (positions["y"] <= ymax)
+        ]
+    if service_ids:
+        positions = positions[np.isin(positions["service_id"], service_ids)]
+
+    positions = positions[np.argsort(positions["vehicle_id"], kind="stable")]
+
+    return [
+        {
+            "id": vehicle_id,
+            "service_id": service_id or None,
+            "coordinates": [x, y],
+            "heading": heading if has_heading else None,
+        }
+        for vehicle_id, service_id, x, y, has_heading, heading in zip(
+            *(positions[name].tolist() for name in position_dtype.names)
+        )
+    ]
+
+
+def archive(now=None, batch_size=1000):
+    """Move buckets more than history.ARCHIVE_AFTER old from Redis to disk"""
+
+    if not redis_client:
+        return
+
+    if now is None:
+        now = timezone.now()
+    cutoff = (now - ARCHIVE_AFTER).timestamp()
+
+    total = 0
+    while keys := redis_client.zrangebyscore(
+        BUCKETS_KEY, "-inf", cutoff, start=0, num=batch_size, withscores=True
+    ):
+        pipe = redis_client.pipeline(transaction=False)
+        for key, _ in keys:
+            pipe.hvals(key)
+        values = pipe.execute()
+
+        partitions = {}  # (date, file name): [(bucket, [packed positions])]
+        for (key, bucket), positions in zip(keys, values):
+            if positions:
+                bucket = int(bucket)
+                operator_id = key.decode().split(":", 2)[2]
+                if operator_id == "_":
+                    operator_id = None
+                partition = (get_date(bucket), get_partition_name(bucket, operator_id))
+                partitions.setdefault(partition, []).append((bucket, positions))
+
+        indexes = {}
+        for (date, name), buckets in partitions.items():
+            date_dir = get_date_dir(date)
+            if date not in indexes:
+                indexes[date] = read_index(date_dir)
+            indexes[date][name] = write_partition(date_dir / name, buckets)
+        for date, index in indexes.items():
+            write_index(get_date_dir(date), index)
+
+        # only delete them once they're safely on disk
+        keys = [key for key, _ in keys]
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.delete(*keys)
+        pipe.zrem(BUCKETS_KEY, *keys)
+        pipe.execute()
+
+        total += len(keys)
+
+    if total:
+        logger.info("archived %s position buckets", total)
@@ -1,15 +1,18 @@
 # "Real Time Passenger Information"-ish stuff - calculating delays etc
 
 from datetime import timedelta
-from itertools import pairwise
 
+import numpy as np
 from ciso8601 import parse_datetime
-from django.contrib.gis.geos import LineString, Point
 from django.utils import timezone
+from haversine import Unit, haversine_vector
 
 from bustimes.models import RouteLink, StopTime, Trip
 from bustimes.utils import contiguous_stoptimes_only
-from vehicles.utils import calculate_bearing
+
+
+# how near a stop a vehicle has to be to count as being at it
+STOP_RADIUS = 100  # metres
 
 
 def get_stop_times(item):
@@ -30,10 +33,237 @@ def get_stop_times(item):
     return stop_times
 
 
-class Progress:
-    def __init__(self, stop_times, prev_stop_time, next_stop_time, progress, distance):
+def get_bearings(starts, ends):
+    """Like vehicles.utils.calculate_bearing, for arrays of points"""
+    a_lon, a_lat = np.radians(starts).T
+    b_lon, b_lat = np.radians(ends).T
+
+    y = np.sin(b_lon - a_lon) * np.cos(b_lat)
+    x = np.cos(a_lat) * np.sin(b_lat) - np.sin(a_lat) * np.cos(b_lat)
+
+    return np.rint(np.degrees(np.arctan2(y, x)) % 360).astype(int)
+
+
+def locate(points, starts, vectors, lengths_squared):
+    """For each point (rows) and segment (columns), how far along the segment
+    (0 to 1) the nearest point on it is, and how far away that is
+    """
+    offsets = points[:, np.newaxis, :] - starts  # (points, segments, 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fractions = (offsets * vectors).sum(axis=2) / lengths_squared
+    fractions = np.clip(np.nan_to_num(fractions), 0, 1)  # (zero-length segments)
+    distances = np.hypot(*np.moveaxis(offsets - fractions[..., None] * vectors, 2, 0))
+    return fractions, distances
+
+
+def project_normalized(coords, point) -> float:
+    """Like GEOSGeometry.project_normalized, for a line string as an array"""
+    starts = coords[:-1]
+    vectors = coords[1:] - starts
+    lengths_squared = (vectors**2).sum(axis=1)
+    fractions, distances = locate(point[np.newaxis], starts, vectors, lengths_squared)
+    lengths = np.sqrt(lengths_squared)
+    total = lengths.sum()
+    if not total:
+        return 0.0
+    i = distances[0].argmin()
+    return float((lengths[:i].sum() + fractions[0, i] * lengths[i]) / total)
+
+
+def get_route_link(service_id, from_stop_id, to_stop_id):
+    """The route link's coordinates as an array, or None"""
+    try:
+        geometry = RouteLink.objects.get(
+            service=service_id, from_stop=from_stop_id, to_stop=to_stop_id
+        ).geometry
+    except RouteLink.DoesNotExist:
+        return
+    return np.array(geometry.coords, float)
+
+
+class Segments:
+    """A trip's consecutive pairs of stops, as arrays, so that many vehicles' nearest
+    pairs can be found at once
+    """
+
+    def __init__(self, stop_times):
         self.stop_times = list(stop_times)
-        self.sequence = self.stop_times.index(prev_stop_time)
+        coords = np.array(
+            [stop_time.stop.latlong.coords for stop_time in self.stop_times], float
+        ).reshape(-1, 2)
+        self.stop_coords = coords[:, ::-1]  # (latitude, longitude) for haversine
+        self.starts = coords[:-1]
+        self.vectors = coords[1:] - self.starts
+        self.lengths_squared = (self.vectors**2).sum(axis=1)
+        self.bearings = get_bearings(coords[:-1], coords[1:])
+
+    def get_progress(self, items, trip_cache=None) -> list:
+        """A Progress (or None if not near the route) for each item"""
+
+        if not len(self.starts) or not items:
+            return [None] * len(items)
+
+        points = np.array([item["coordinates"] for item in items], float)
+        fractions, distances = locate(
+            points, self.starts, self.vectors, self.lengths_squared
+        )
+
+        results = []
+        for item, point, item_fractions, item_distances in zip(
+            items, points, fractions, distances
+        ):
+            # pairs nearer than about 1.1 km, nearest first
+            nearby = np.flatnonzero(item_distances < 0.01)
+            if not len(nearby):
+                results.append(None)
+                continue
+            nearby = nearby[np.argsort(item_distances[nearby], kind="stable")]
+
+            closest = nearby[0]
+
+            if len(nearby) >= 2 and item["heading"] is not None:
+                vehicle_heading = int(item["heading"])
+
+                difference = (
+                    vehicle_heading - self.bearings[closest] + 180
+                ) % 360 - 180
+                next_closest = nearby[1]
+
+                if not (abs(difference) < 90) and item_distances[next_closest] < 0.001:
+                    # bus seems to be heading the wrong way -
+                    # does the bus go both ways on this road?
+                    # try the next closest pair of stops:
+                    difference = (
+                        vehicle_heading - self.bearings[next_closest] + 180
+                    ) % 360 - 180
+                    if abs(difference) < 90:
+                        closest = next_closest
+
+            prev_stop_time = self.stop_times[closest]
+            next_stop_time = self.stop_times[closest + 1]
+
+            progress = item_fractions[closest]
+            if "service_id" in item:
+                route_link = (
+                    trip_cache.get_route_link if trip_cache else get_route_link
+                )(item["service_id"], prev_stop_time.stop_id, next_stop_time.stop_id)
+                if route_link is not None:
+                    progress = project_normalized(route_link, point)
+
+            results.append(
+                Progress(
+                    self.stop_times,
+                    prev_stop_time,
+                    next_stop_time,
+                    float(progress),
+                    float(item_distances[closest]),
+                    closest,
+                )
+            )
+
+        return results
+
+    def get_stop_events(self, items) -> list:
+        """For each item, the id of the stop time at the nearest stop if it's within
+        STOP_RADIUS, otherwise None
+        """
+        if not len(self.stop_coords) or not items:
+            return [None] * len(items)
+
+        distances = haversine_vector(
+            self.stop_coords,
+            [item["coordinates"][::-1] for item in items],
+            Unit.METERS,
+            comb=True,
+        )  # (items, stops)
+        nearest = distances.argmin(axis=1)
+        return [
+            self.stop_times[i].id if item_distances[i] < STOP_RADIUS else None
+            for i, item_distances in zip(nearest, distances)
+        ]
+
+
+class TripCache:
+    """Recently tracked trips' Segments, and route links, for a live importer
+    to work out each vehicle's progress when it's updated
+    (instead of every page that shows the vehicle doing so)
+    """
+
+    max_trips = 5000
+    max_age = timedelta(hours=1)  # in case timetables have changed
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.trips = {}  # trip id: Segments
+        self.route_links = {}  # (service id, from stop, to stop): array or None
+        self.cleared_at = timezone.now()
+
+    def get_segments(self, trip_id) -> Segments:
+        if timezone.now() - self.cleared_at > self.max_age:
+            self.clear()
+
+        if trip_id not in self.trips:
+            if len(self.trips) >= self.max_trips:
+                del self.trips[next(iter(self.trips))]  # the oldest
+            try:
+                stop_times = get_stop_times({"trip_id": trip_id})
+            except Trip.DoesNotExist:
+                stop_times = []
+            self.trips[trip_id] = Segments(stop_times)
+        return self.trips[trip_id]
+
+    def get_route_link(self, service_id, from_stop_id, to_stop_id):
+        key = (service_id, from_stop_id, to_stop_id)
+        if key not in self.route_links:
+            if len(self.route_links) >= self.max_trips:
+                del self.route_links[next(iter(self.route_links))]
+            self.route_links[key] = get_route_link(*key)
+        return self.route_links[key]
+
+    def group_by_trip(self, items):
+        by_trip = {}
+        for item in items:
+            by_trip.setdefault(item["trip_id"], []).append(item)
+        for trip_id, trip_items in by_trip.items():
+            yield self.get_segments(trip_id), trip_items
+
+    def add_progress_and_delay(self, items):
+        """For many items at once"""
+        for segments, trip_items in self.group_by_trip(items):
+            for item, progress in zip(
+                trip_items, segments.get_progress(trip_items, self)
+            ):
+                if progress:
+                    add_delay(item, progress)
+
+    def get_stop_events(self, items) -> list:
+        """(item, stop time id) for each item that's at one of its trip's stops"""
+        stop_events = []
+        for segments, trip_items in self.group_by_trip(items):
+            for item, stop_time_id in zip(
+                trip_items, segments.get_stop_events(trip_items)
+            ):
+                if stop_time_id:
+                    stop_events.append((item, stop_time_id))
+        return stop_events
+
+
+class Progress:
+    def __init__(
+        self,
+        stop_times,
+        prev_stop_time,
+        next_stop_time,
+        progress,
+        distance,
+        sequence=None,
+    ):
+        self.stop_times = stop_times
+        if sequence is None:
+            sequence = self.stop_times.index(prev_stop_time)
+        self.sequence = int(sequence)
         self.prev_stop_time = prev_stop_time
         self.next_stop_time = next_stop_time
         self.progress = round(progress, 3)
@@ -49,80 +279,27 @@ class Progress:
         }
 
 
-def get_progress(item, stop_time=None):
-    point = Point(*item["coordinates"])
-
-    if stop_time:
-        stop_times = stop_time.trip.stoptime_set.all()  # prefetched earlier
+def get_progress(item, stop_time=None, trip_cache=None):
+    if trip_cache:
+        segments = trip_cache.get_segments(item["trip_id"])
     else:
-        try:
-            stop_times = get_stop_times(item)
-        except Trip.DoesNotExist:
-            return
-
-    pairs = [
-        (a, b, LineString([a.stop.latlong, b.stop.latlong]))
-        for a, b in pairwise(stop_times)
-    ]
-
-    # compute distances:
-    pairs = ((pair, pair[2].distance(point)) for pair in pairs)
-    # filter out pairs further about than 1.1 km:
-    nearby_pairs = [pair for pair in pairs if pair[1] < 0.01]
-
-    if not nearby_pairs:
-        return
+        if stop_time:
+            stop_times = stop_time.trip.stoptime_set.all()  # prefetched earlier
+        else:
+            try:
+                stop_times = get_stop_times(item)
+            except Trip.DoesNotExist:
+                return
+        segments = Segments(stop_times)
 
-    nearby_pairs.sort(key=lambda pair: pair[1])
+    return segments.get_progress([item], trip_cache)[0]
 
-    closest, distance = nearby_pairs[0]
-
-    if len(nearby_pairs) >= 2 and item["heading"] is not None:
-        vehicle_heading = int(item["heading"])
-
-        # TODO: use RouteLink if there is one
-        route_bearing = calculate_bearing(
-            closest[0].stop.latlong, closest[1].stop.latlong
-        )
-
-        difference = (vehicle_heading - route_bearing + 180) % 360 - 180
-        next_closest, next_closest_distance = nearby_pairs[1]
-
-        if not (abs(difference) < 90) and next_closest_distance < 0.001:
-            # bus seems to be heading the wrong way - does the bus go both ways on this road?
-            # try the next closest pair of stops:
-            route_bearing = calculate_bearing(
-                next_closest[0].stop.latlong, next_closest[1].stop.latlong
-            )
-
-            difference = (vehicle_heading - route_bearing + 180) % 360 - 180
-            if abs(difference) < 90:
-                closest = next_closest
-                distance = next_closest_distance
-
-    line_string = closest[2]
-    if "service_id" in item:
-        try:
-            line_string = RouteLink.objects.get(
-                service=item["service_id"],
-                from_stop=closest[0].stop_id,
-                to_stop=closest[1].stop_id,
-            ).geometry
-        except RouteLink.DoesNotExist:
-            pass
-
-    progress = line_string.project_normalized(point)
-
-    return Progress(stop_times, closest[0], closest[1], progress, distance)
-
-
-def add_progress_and_delay(item, stop_time=None):
-    progress = get_progress(item, stop_time)
-    if not progress:
-        return
 
+def add_delay(item, progress):
     item["progress"] = progress.to_json()
-    when = parse_datetime(item["datetime"])
+    when = item["datetime"]
+    if type(when) is str:
+        when = parse_datetime(when)
     when = timezone.localtime(when)
     when = timedelta(hours=when.hour, minutes=when.minute, seconds=when.second)
 
@@ -140,3 +317,9 @@ def add_progress_and_delay(item, stop_time=None):
     expected_time = prev_time + (next_time - prev_time) * progress.progress
     delay = int((when - expected_time).total_seconds())
     item["delay"] = delay
+
+
+def add_progress_and_delay(item, stop_time=None, trip_cache=None):
+    progress = get_progress(item, stop_time, trip_cache)
+    if progress:
+        add_delay(item, progress)
@@ -1,16 +1,47 @@
 from django.core.cache import cache
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from redis.exceptions import ConnectionError
 
 from .models import Livery, Vehicle
+from .utils import journeys_modified, redis_client
+
+# fields that live vehicle importers update all the time,
+# and which don't affect which vehicle a feed's vehicle identity refers to
+LIVE_FIELDS = {"latest_journey", "latest_journey_data", "garage"}
+
+
+def vehicles_modified(*vehicle_ids):
+    """Tell live importers' VehicleResolvers to forget about these vehicles"""
+    if not redis_client:
+        return
+    try:
+        version = redis_client.incr("vehicles_modified_version")
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.zadd(
+            "vehicles_modified", {vehicle_id: version for vehicle_id in vehicle_ids}
+        )
+        pipeline.zremrangebyrank("vehicles_modified", 0, -10_001)  # keep 10,000
+        pipeline.execute()
+    except ConnectionError:
+        pass
 
 
 @receiver(post_save, sender=Livery)
 def liveries_cache_update(sender, instance, **kwargs):
     cache.set("liveries_css_version", int(instance.updated_at.timestamp()), None)
+    journeys_modified(livery_ids=[instance.id])
 
 
 @receiver(post_save, sender=Vehicle)
-def vehicle_cache_update(sender, instance, created, **kwargs):
+def vehicle_cache_update(sender, instance, created, update_fields, **kwargs):
     if not created and instance.latest_journey_id:
         cache.delete(f"journey{instance.latest_journey_id}")
+    if not created and (update_fields is None or not LIVE_FIELDS >= update_fields):
+        vehicles_modified(instance.id)
+        journeys_modified(vehicle_ids=[instance.id])
+
+
+@receiver(post_delete, sender=Vehicle)
+def vehicle_deleted(sender, instance, **kwargs):
+    vehicles_modified(instance.id)
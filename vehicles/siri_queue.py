@@ -0,0 +1,61 @@
+"""Queueing SIRI-VM deliveries pushed to the siri_post view, so that the view can
+respond straight away however big they are.
+
+The view just appends the raw request body to a Redis list per subscription and,
+unless one is already pending, schedules a handle_siri_post task to run WINDOW
+seconds later. By then several deliveries may have been queued - the task takes
+them all, parses them with the same incremental parser as the poller (see siri_vm),
+and only handles the latest VehicleActivity for each vehicle.
+"""
+
+from .utils import redis_client
+
+WINDOW = 2  # seconds
+MAX_QUEUED = 100  # deliveries - if the worker falls this far behind, drop the oldest
+EXPIRE = 3600  # seconds
+
+
+def get_queue_key(uuid) -> str:
+    return f"siri_posts:{uuid}"
+
+
+def get_pending_key(uuid) -> str:
+    # (exists while a task is scheduled to handle the queue)
+    return f"siri_posts_pending:{uuid}"
+
+
+def get_last_key(uuid) -> str:
+    return f"siri_posts_last:{uuid}"
+
+
+def enqueue(uuid, body: bytes) -> bool:
+    """Returns whether a task needs to be scheduled to handle the queue"""
+
+    key = get_queue_key(uuid)
+    pipe = redis_client.pipeline()
+    pipe.rpush(key, body)
+    pipe.ltrim(key, -MAX_QUEUED, -1)
+    pipe.expire(key, EXPIRE)
+    # (expires in case the task somehow doesn't run)
+    pipe.set(get_pending_key(uuid), 1, nx=True, ex=WINDOW * 30)
+    return bool(pipe.execute()[-1])
+
+
+def dequeue(uuid) -> list:
+    """Take all the queued deliveries, oldest first"""
+
+    pipe = redis_client.pipeline()
+    pipe.lrange(get_queue_key(uuid), 0, -1)
+    # anything queued after this will need a new task
+    pipe.delete(get_queue_key(uuid), get_pending_key(uuid))
+    bodies = pipe.execute()[0]
+
+    if bodies:
+        # for debugging (see siri_post)
+        redis_client.set(get_last_key(uuid), bodies[-1], ex=EXPIRE)
+
+    return bodies
+
+
+def get_last(uuid) -> bytes | None:
+    return redis_client and redis_client.get(get_last_key(uuid))
@@ -0,0 +1,74 @@
+"""Incremental parsing of SIRI-VM XML documents,
+so a big feed can be handled one VehicleActivity at a time
+instead of turning the whole document into dicts first
+"""
+
+import xml.etree.ElementTree as ET
+
+
+def get_tag(element) -> str:
+    # remove any "{http://www.siri.org.uk/siri}"-style namespace
+    return element.tag.rpartition("}")[2]
+
+
+def element_to_dict(element):
+    """Convert an element to the same structure xmltodict.parse would produce"""
+
+    value = {
+        f"@{key.rpartition('}')[2]}": attribute
+        for key, attribute in element.attrib.items()
+    }
+
+    for child in element:
+        tag = get_tag(child)
+        child_value = element_to_dict(child)
+        if tag not in value:
+            value[tag] = child_value
+        elif type(value[tag]) is list:
+            value[tag].append(child_value)
+        else:
+            value[tag] = [value[tag], child_value]
+
+    text = element.text and element.text.strip()
+    if not value:
+        return text or None
+    if text:
+        value["#text"] = text
+    return value
+
+
+def iter_vehicle_activities(open_file):
+    """Yields a dict of the simple elements (ResponseTimestamp, SubscriptionRef, etc)
+    that come before the first VehicleActivity,
+    then a dict for each VehicleActivity, as soon as it has been read.
+
+    For a HeartbeatNotification, the first dict will contain the RequestTimestamp
+    """
+
+    header = {}
+    parents = []
+
+    for event, element in ET.iterparse(open_file, events=("start", "end")):
+        if event == "start":
+            if header is not None and get_tag(element) == "VehicleActivity":
+                yield header
+                header = None
+            parents.append(element)
+            continue
+
+        parents.pop()
+        tag = get_tag(element)
+
+        if tag == "VehicleActivity":
+            yield element_to_dict(element)
+
+            # free the memory used by this VehicleActivity
+            element.clear()
+            if parents:
+                parents[-1].remove(element)
+
+        elif header is not None and not len(element):
+            header.setdefault(tag, element.text and element.text.strip())
+
+    if header is not None:
+        yield header  # no VehicleActivity elements
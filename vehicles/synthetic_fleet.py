@@ -0,0 +1,278 @@
+"""A synthetic fleet of vehicles, for load testing live importers at any scale
+without the network (see the serve_synthetic_fleet command).
+
+Each vehicle works one journey after another, each following a real trip's stops
+and timings (from StopTimes) - though starting whenever the vehicle's previous
+journey ended, rather than at the trip's scheduled time - and reports its position
+every `interval` seconds, like an AVL unit. So however big the fleet, successive
+feeds are consistent with each other: vehicles only move along their routes, at
+timetabled speeds, and only report a new position when it's time to.
+"""
+
+import io
+import random
+import time
+import zipfile
+from datetime import datetime, timezone as dt_timezone
+from xml.sax.saxutils import escape
+
+import numpy as np
+from django.db.models import Prefetch
+from django.utils import timezone
+from google.transit import gtfs_realtime_pb2
+
+from busstops.models import Operator
+from bustimes.models import StopTime, Trip
+
+from .rtpi import get_bearings
+
+
+class Pattern:
+    """A trip's stops' positions and times, as arrays"""
+
+    def __init__(self, trip, stop_times):
+        self.trip_id = trip.ticket_machine_code
+        self.journey_ref = (
+            trip.ticket_machine_code or trip.vehicle_journey_code or str(trip.id)
+        )
+        self.line_name = trip.route.line_name or trip.route.service.line_name
+        self.operator_ref = trip.operator_id or next(
+            (operator.noc for operator in trip.route.service.operator.all()), ""
+        )
+        self.direction = "inbound" if trip.inbound else "outbound"
+        self.origin_ref = stop_times[0].stop_id
+        self.destination_ref = stop_times[-1].stop_id
+        self.destination = trip.headsign
+
+        # arriving at and departing from each stop
+        times = []
+        coords = []
+        for stop_time in stop_times:
+            for when in (
+                stop_time.arrival_or_departure(),
+                stop_time.departure_or_arrival(),
+            ):
+                times.append(when.total_seconds())
+                coords.append(stop_time.stop.latlong.coords)
+
+        times = np.maximum.accumulate(np.array(times, float))
+        self.times = times - times[0]
+        self.duration = float(self.times[-1])
+        self.coords = np.array(coords, float)
+
+    def get_position(self, elapsed: float) -> tuple:
+        """Longitude, latitude and bearing (or None if stationary)"""
+        x, y = (
+            np.interp([elapsed, elapsed + 30], self.times, self.coords[:, i])
+            for i in range(2)
+        )
+        if x[0] == x[1] and y[0] == y[1]:
+            bearing = None
+        else:
+            bearing = int(get_bearings([[x[0], y[0]]], [[x[1], y[1]]])[0])
+        return float(x[0]), float(y[0]), bearing
+
+
+def get_patterns(max_trips: int, operator_ids=None) -> list:
+    """Patterns of up to max_trips current trips with at least two located stops"""
+
+    trips = Trip.objects.filter(route__service__current=True).select_related(
+        "route__service"
+    )
+    if operator_ids:
+        trips = trips.filter(route__service__operator__in=operator_ids)
+    trips = trips.prefetch_related(
+        Prefetch("route__service__operator", queryset=Operator.objects.only("noc")),
+        Prefetch(
+            "stoptime_set",
+            StopTime.objects.filter(stop__latlong__isnull=False)
+            .select_related("stop")
+            .only("trip_id", "arrival", "departure", "stop__latlong")
+            .order_by("id"),
+        ),
+    ).order_by("id")[:max_trips]
+
+    patterns = []
+    for trip in trips:
+        stop_times = trip.stoptime_set.all()
+        if len(stop_times) >= 2:
+            pattern = Pattern(trip, stop_times)
+            if pattern.duration:
+                patterns.append(pattern)
+    return patterns
+
+
+class SyntheticVehicle:
+    __slots__ = ("ref", "operator_ref", "phase", "gtfsr", "pattern", "start", "end")
+
+
+class SyntheticFleet:
+    def __init__(
+        self,
+        patterns: list,
+        size: int,
+        interval=10,
+        churn=0.0,
+        overlap=0.0,
+        seed=None,
+        now=None,
+    ):
+        """interval - seconds between each vehicle's reports
+        churn - chance per minute of a vehicle abandoning its journey for another
+        overlap - fraction of vehicles in the GTFS-RT feed as well as the SIRI-VM one
+        """
+        assert patterns
+        # (each vehicle sticks to one operator's trips)
+        self.patterns = {}
+        for pattern in patterns:
+            self.patterns.setdefault(pattern.operator_ref, []).append(pattern)
+        self.interval = interval
+        self.churn = churn
+        self.random = random.Random(seed)
+
+        if now is None:
+            now = time.time()
+
+        self.vehicles = []
+        for i in range(size):
+            vehicle = SyntheticVehicle()
+            vehicle.ref = f"SYN{i:06d}"
+            vehicle.operator_ref = self.random.choice(patterns).operator_ref
+            vehicle.phase = self.random.uniform(0, interval)
+            vehicle.gtfsr = self.random.random() < overlap
+            self.start_journey(vehicle, now)
+            # (already part way through its first journey)
+            elapsed = self.random.uniform(0, vehicle.end - vehicle.start)
+            vehicle.start -= elapsed
+            vehicle.end -= elapsed
+            self.vehicles.append(vehicle)
+
+    def start_journey(self, vehicle, start: float):
+        vehicle.pattern = self.random.choice(self.patterns[vehicle.operator_ref])
+        vehicle.start = start
+        vehicle.end = start + vehicle.pattern.duration
+        if self.churn:
+            vehicle.end = min(
+                vehicle.end, start + self.random.expovariate(self.churn / 60)
+            )
+
+    def get_activities(self, now=None, since=None, gtfsr=False) -> list:
+        """A dict for each vehicle's latest report (only those after `since`,
+        and only the GTFS-RT feed's vehicles if gtfsr is true)
+        """
+
+        if now is None:
+            now = time.time()
+
+        activities = []
+        for vehicle in self.vehicles:
+            if gtfsr and not vehicle.gtfsr:
+                continue
+
+            recorded_at = now - (now - vehicle.phase) % self.interval
+            if since is not None and recorded_at <= since:
+                continue
+
+            while recorded_at >= vehicle.end:
+                self.start_journey(vehicle, vehicle.end)
+
+            pattern = vehicle.pattern
+            x, y, bearing = pattern.get_position(recorded_at - vehicle.start)
+            activities.append(
+                {
+                    "vehicle_ref": vehicle.ref,
+                    "pattern": pattern,
+                    "departure": timezone.localtime(
+                        datetime.fromtimestamp(round(vehicle.start), dt_timezone.utc)
+                    ),
+                    "recorded_at": datetime.fromtimestamp(
+                        round(recorded_at), dt_timezone.utc
+                    ),
+                    "coordinates": (x, y),
+                    "bearing": bearing,
+                }
+            )
+        return activities
+
+
+def get_vehicle_activity_xml(activity: dict) -> str:
+    pattern = activity["pattern"]
+    x, y = activity["coordinates"]
+    recorded_at = activity["recorded_at"].isoformat()
+    departure = activity["departure"].isoformat()
+    bearing = activity["bearing"]
+    return f"""<VehicleActivity>
+<RecordedAtTime>{recorded_at}</RecordedAtTime>
+<ValidUntilTime>{recorded_at}</ValidUntilTime>
+<MonitoredVehicleJourney>
+<LineRef>{escape(pattern.line_name)}</LineRef>
+<DirectionRef>{pattern.direction}</DirectionRef>
+<FramedVehicleJourneyRef>
+<DataFrameRef>{departure[:10]}</DataFrameRef>
+<DatedVehicleJourneyRef>{escape(pattern.journey_ref)}</DatedVehicleJourneyRef>
+</FramedVehicleJourneyRef>
+<PublishedLineName>{escape(pattern.line_name)}</PublishedLineName>
+<OperatorRef>{escape(pattern.operator_ref)}</OperatorRef>
+<OriginRef>{escape(pattern.origin_ref)}</OriginRef>
+<DestinationRef>{escape(pattern.destination_ref)}</DestinationRef>
+<DestinationName>{escape(pattern.destination)}</DestinationName>
+<OriginAimedDepartureTime>{departure}</OriginAimedDepartureTime>
+<VehicleLocation>
+<Longitude>{x:.6f}</Longitude>
+<Latitude>{y:.6f}</Latitude>
+</VehicleLocation>
+{"" if bearing is None else f"<Bearing>{bearing}</Bearing>"}
+<VehicleRef>{activity["vehicle_ref"]}</VehicleRef>
+</MonitoredVehicleJourney>
+</VehicleActivity>"""
+
+
+def get_siri_vm(activities: list, now=None) -> bytes:
+    if now is None:
+        now = timezone.now()
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<Siri xmlns="http://www.siri.org.uk/siri" version="2.0">
+<ServiceDelivery>
+<ResponseTimestamp>{now.isoformat()}</ResponseTimestamp>
+<ProducerRef>synthetic</ProducerRef>
+<VehicleMonitoringDelivery>
+<ResponseTimestamp>{now.isoformat()}</ResponseTimestamp>
+{"".join(get_vehicle_activity_xml(activity) for activity in activities)}
+</VehicleMonitoringDelivery>
+</ServiceDelivery>
+</Siri>""".encode()
+
+
+def get_siri_vm_zip(activities: list, now=None) -> bytes:
+    """Like the Bus Open Data Service's whole-country feed"""
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("siri.xml", get_siri_vm(activities, now))
+    return output.getvalue()
+
+
+def get_gtfs_rt(activities: list, now=None) -> bytes:
+    if now is None:
+        now = timezone.now()
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(now.timestamp())
+
+    for activity in activities:
+        pattern = activity["pattern"]
+        entity = feed.entity.add()
+        entity.id = activity["vehicle_ref"]
+        vehicle_position = entity.vehicle
+        vehicle_position.trip.trip_id = pattern.trip_id
+        vehicle_position.trip.start_date = activity["departure"].strftime("%Y%m%d")
+        vehicle_position.trip.start_time = activity["departure"].strftime("%H:%M:%S")
+        vehicle_position.vehicle.id = activity["vehicle_ref"]
+        vehicle_position.position.longitude, vehicle_position.position.latitude = (
+            activity["coordinates"]
+        )
+        if activity["bearing"] is not None:
+            vehicle_position.position.bearing = activity["bearing"]
+        vehicle_position.timestamp = int(activity["recorded_at"].timestamp())
+
+    return feed.SerializeToString()
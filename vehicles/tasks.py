@@ -1,4 +1,7 @@
 import functools
+import io
+import logging
+import xml.etree.ElementTree as ET
 from datetime import timedelta
 
 from ciso8601 import parse_datetime
@@ -11,9 +14,14 @@ from huey.contrib.djhuey import db_periodic_task, db_task
 
 from busstops.models import DataSource, Operator
 
+from . import siri_queue, siri_vm
+from .history import archive
+from .playback import archive as archive_positions
 from .management.commands import import_bod_avl
 from .models import SiriSubscription, Vehicle, VehicleJourney, VehicleRevision
 
+logger = logging.getLogger(__name__)
+
 
 @functools.cache
 def get_bod_avl_command(source_name):
@@ -23,26 +31,78 @@ def get_bod_avl_command(source_name):
     return command
 
 
+def get_latest_activities(bodies) -> tuple[dict, list]:
+    """From some SIRI-VM deliveries, the simple elements of the latest one
+    (see siri_vm.iter_vehicle_activities), and the latest VehicleActivity for each
+    vehicle - or None and [] if none of them could be parsed
+    """
+
+    header = None
+    items = {}  # vehicle identity: VehicleActivity
+
+    for body in bodies:
+        activities = siri_vm.iter_vehicle_activities(io.BytesIO(body))
+        try:
+            delivery_header = next(activities)
+            # (a heartbeat only counts if there's nothing else)
+            if (
+                header is None
+                or "ResponseTimestamp" in delivery_header
+                and (
+                    "ResponseTimestamp" not in header
+                    or parse_datetime(header["ResponseTimestamp"])
+                    <= parse_datetime(delivery_header["ResponseTimestamp"])
+                )
+            ):
+                header = delivery_header
+
+            for item in activities:
+                identity = import_bod_avl.Command.get_vehicle_identity(item)
+                if identity not in items or parse_datetime(
+                    items[identity]["RecordedAtTime"]
+                ) <= parse_datetime(item["RecordedAtTime"]):
+                    items[identity] = item
+        except ET.ParseError as e:
+            # (keep any VehicleActivities before the error, and carry on)
+            logger.warning("couldn't parse SIRI-VM delivery: %s", e)
+
+    return header, list(items.values())
+
+
 @db_task()
-def handle_siri_post(uuid, data):
-    now = timezone.now()
+def handle_siri_post(uuid, bodies=None):
+    """Handle deliveries pushed to the siri_post view - queued in Redis (see
+    siri_queue), unless passed directly
+    """
+
+    if bodies is None:
+        bodies = siri_queue.dequeue(uuid)
+        if not bodies:
+            return
+
+    header, items = get_latest_activities(bodies)
+    if header is not None:
+        handle_siri_delivery(uuid, header, items)
 
-    data = data["Siri"]
+
+@db_task()
+def handle_overland_post(uuid, header, items):
+    handle_siri_delivery(uuid, header, items)
+
+
+def handle_siri_delivery(uuid, header, items):
+    now = timezone.now()
 
     subscription = SiriSubscription.objects.get(uuid=uuid)
 
-    if "HeartbeatNotification" in data:
-        timestamp = parse_datetime(data["HeartbeatNotification"]["RequestTimestamp"])
+    if "ResponseTimestamp" not in header:  # HeartbeatNotification
+        timestamp = parse_datetime(header["RequestTimestamp"])
         total_items = 0
         subscription_ref = None
     else:
-        data = data["ServiceDelivery"]
-
         command = get_bod_avl_command(subscription.name)
 
-        items = data["VehicleMonitoringDelivery"]["VehicleActivity"]
-
-        timestamp = parse_datetime(data["ResponseTimestamp"])
+        timestamp = parse_datetime(header["ResponseTimestamp"])
         command.source.datetime = timestamp
 
         (
@@ -56,7 +116,7 @@ def handle_siri_post(uuid, data):
         command.handle_items(changed_items, changed_item_identities)
         command.handle_items(changed_journey_items, changed_journey_identities)
 
-        subscription_ref = data["VehicleMonitoringDelivery"].get("SubscriptionRef")
+        subscription_ref = header.get("SubscriptionRef")
 
     # stats for last 50 updates:
     if subscription.name == "Transport for Wales":
@@ -248,3 +308,9 @@ def timetable_source_stats():
     history.append(stats)
 
     cache.set("timetable-source-stats", history, None)
+
+
+@db_periodic_task(crontab(minute="*/15"))
+def archive_journey_history():
+    archive()
+    archive_positions()
@@ -3,6 +3,7 @@ from unittest.mock import patch
 
 import fakeredis
 import time_machine
+from ciso8601 import parse_datetime
 from django.test import TestCase
 
 from busstops.models import DataSource, Service, StopPoint, StopUsage
@@ -246,6 +247,46 @@ class ScheduleAdherenceTest(TestCase):
         self.assertEqual(item["progress"]["progress"], 1)
         self.assertEqual(item["delay"], 967)
 
+        # as a live importer would - the trip's stop times are only fetched once
+        trip_cache = rtpi.TripCache()
+        with self.assertNumQueries(2):
+            rtpi.add_progress_and_delay(item, trip_cache=trip_cache)
+        item["datetime"] = parse_datetime(item["datetime"])
+        with self.assertNumQueries(0):
+            rtpi.add_progress_and_delay(item, trip_cache=trip_cache)
+        self.assertEqual(item["progress"]["progress"], 1)
+        self.assertEqual(item["delay"], 967)
+        item["datetime"] = "2023-08-31T09:50:07Z"
+
+        # lots of vehicles at once
+        items = [
+            {
+                "coordinates": [-0.326838, 51.750598],
+                "trip_id": self.journey.trip_id,
+                "heading": None,
+                "datetime": "2023-08-31T09:50:07Z",
+            },
+            {
+                "coordinates": [0, 50],
+                "trip_id": self.journey.trip_id,
+                "heading": None,
+                "datetime": "2023-08-31T09:50:07Z",
+            },
+        ]
+        with self.assertNumQueries(0):
+            trip_cache.add_progress_and_delay(items)
+        self.assertEqual(items[0]["delay"], 847)
+        self.assertNotIn("progress", items[1])
+
+        # which stops they're at
+        with self.assertNumQueries(0):
+            stop_events = trip_cache.get_stop_events(items)
+        self.assertEqual(len(stop_events), 1)
+        self.assertIs(stop_events[0][0], items[0])
+        self.assertEqual(
+            StopTime.objects.get(id=stop_events[0][1]).stop_id, "210021505160"
+        )
+
         # more than 12 hours early/late - should adjust by 24 hours
         item["datetime"] = "2023-08-30T22:59:00Z"
         rtpi.add_progress_and_delay(item)
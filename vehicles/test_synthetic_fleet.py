@@ -0,0 +1,120 @@
+import io
+import zipfile
+
+from django.test import TestCase
+from google.transit import gtfs_realtime_pb2
+
+from busstops.models import DataSource, Operator, Service, StopPoint
+from bustimes.models import Route, StopTime, Trip
+
+from . import siri_vm, synthetic_fleet
+
+
+class SyntheticFleetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        StopPoint.objects.bulk_create(
+            [
+                StopPoint(
+                    atco_code="210021503158",
+                    latlong="POINT(-0.336513 51.754215)",
+                    active=True,
+                ),
+                StopPoint(
+                    atco_code="210021506795",
+                    latlong="POINT(-0.326993 51.750312)",
+                    active=True,
+                ),
+                StopPoint(
+                    atco_code="210021502000",
+                    latlong="POINT(-0.305844 51.763425)",
+                    active=True,
+                ),
+            ]
+        )
+        operator = Operator.objects.create(noc="UNOE", name="Uno")
+        service = Service.objects.create(
+            service_code="614", line_name="614", current=True
+        )
+        service.operator.add(operator)
+        source = DataSource.objects.create(name="UNO")
+        route = Route.objects.create(service=service, source=source, line_name="614")
+        trip = Trip.objects.create(
+            route=route,
+            ticket_machine_code="1234",
+            headsign="Hatfield",
+            start="09:00:00",
+            end="09:20:00",
+        )
+        StopTime.objects.bulk_create(
+            [
+                StopTime(
+                    trip=trip, sequence=0, stop_id="210021503158", departure="09:00:00"
+                ),
+                StopTime(
+                    trip=trip,
+                    sequence=1,
+                    stop_id="210021506795",
+                    arrival="09:10:00",
+                    departure="09:11:00",
+                ),
+                StopTime(
+                    trip=trip, sequence=2, stop_id="210021502000", arrival="09:20:00"
+                ),
+            ]
+        )
+
+    def test_synthetic_fleet(self):
+        with self.assertNumQueries(3):
+            patterns = synthetic_fleet.get_patterns(10)
+        self.assertEqual(len(patterns), 1)
+        self.assertEqual(patterns[0].operator_ref, "UNOE")
+        self.assertEqual(patterns[0].duration, 1200)
+
+        fleet = synthetic_fleet.SyntheticFleet(
+            patterns, 20, interval=10, churn=1, overlap=0.5, seed=1, now=1_700_000_000
+        )
+
+        activities = fleet.get_activities(now=1_700_000_005)
+        self.assertEqual(len(activities), 20)
+        for activity in activities:
+            timestamp = activity["recorded_at"].timestamp()
+            self.assertTrue(1_699_999_995 <= timestamp <= 1_700_000_005)
+            x, y = activity["coordinates"]
+            self.assertTrue(-0.336513 <= x <= -0.305844)
+            self.assertTrue(51.750312 <= y <= 51.763425)
+
+        # only the vehicles that have reported since
+        self.assertLess(
+            len(fleet.get_activities(now=1_700_000_006, since=1_700_000_005)), 20
+        )
+
+        # an hour later, with lots of new journeys
+        activities = fleet.get_activities(now=1_700_003_600)
+        self.assertEqual(len(activities), 20)
+
+        items = siri_vm.iter_vehicle_activities(
+            io.BytesIO(synthetic_fleet.get_siri_vm(activities))
+        )
+        self.assertIn("ResponseTimestamp", next(items))
+        items = list(items)
+        self.assertEqual(len(items), 20)
+        journey = items[0]["MonitoredVehicleJourney"]
+        self.assertEqual(journey["OperatorRef"], "UNOE")
+        self.assertEqual(journey["PublishedLineName"], "614")
+        self.assertEqual(
+            journey["FramedVehicleJourneyRef"]["DatedVehicleJourneyRef"], "1234"
+        )
+        self.assertEqual(journey["DestinationName"], "Hatfield")
+
+        with zipfile.ZipFile(
+            io.BytesIO(synthetic_fleet.get_siri_vm_zip(activities))
+        ) as archive:
+            self.assertEqual(archive.namelist(), ["siri.xml"])
+
+        activities = fleet.get_activities(now=1_700_003_600, gtfsr=True)
+        self.assertLess(len(activities), 20)
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(synthetic_fleet.get_gtfs_rt(activities))
+        self.assertEqual(len(feed.entity), len(activities))
+        self.assertEqual(feed.entity[0].vehicle.trip.trip_id, "1234")
@@ -1,4 +1,6 @@
 from http import HTTPStatus
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest.mock import patch
 
 import fakeredis
@@ -11,6 +13,7 @@ from django.test import TestCase, override_settings
 from accounts.models import User
 from busstops.models import DataSource, Operator, Region, Service
 
+from . import history, live_updates, location_encoding, playback, utils
 from .models import (
     Livery,
     Vehicle,
@@ -344,12 +347,23 @@ class VehiclesTests(TestCase):
                 "_selected_action": [self.vehicle_1.id, self.vehicle_2.id],
             },
         )
-        self.client.post(
-            "/admin/vehicles/vehicle/",
-            {
-                "action": "spare_ticket_machine",
-                "_selected_action": [self.vehicle_1.id, self.vehicle_2.id],
-            },
+        redis_client = fakeredis.FakeStrictRedis()
+        with (
+            patch("vehicles.utils.redis_client", redis_client),
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            self.client.post(
+                "/admin/vehicles/vehicle/",
+                {
+                    "action": "spare_ticket_machine",
+                    "_selected_action": [self.vehicle_1.id, self.vehicle_2.id],
+                },
+            )
+        # the vehicles' journeys' details will be cached again by the next importer
+        # cycle
+        self.assertEqual(
+            redis_client.smembers(utils.STALE_VEHICLES_KEY),
+            {str(self.vehicle_1.id).encode(), str(self.vehicle_2.id).encode()},
         )
         response = self.client.get("/admin/vehicles/vehicle/")
         self.assertContains(response, "Copied Optare Spectra to 2 vehicles.")
@@ -1041,3 +1055,418 @@ https://www.flickr.com/photos/goodwinjoshua/51046126023/ blah""",
         with self.assertNumQueries(2):
             response = self.client.get("/api/vehicles/?search=fd54jya")
         self.assertEqual(1, response.json()["count"])
+
+    def test_location_encoding(self):
+        location = VehicleLocation(latlong=Point(-1.5, 52.25), heading="205.0")
+        location.id = 1
+        location.datetime = parse_datetime("2024-07-05T12:03:04.567891+01:00")
+        location.journey = VehicleJourney(id=2, destination="Bulwell", trip_id=3)
+
+        record = location_encoding.encode_location(location.get_redis_json())
+        self.assertEqual(
+            location_encoding.decode_location(record),
+            {
+                "id": 1,
+                "journey_id": 2,
+                "coordinates": [-1.5, 52.25],
+                "heading": "205.0",
+                "datetime": "2024-07-05T12:03:04.567+01:00",
+                "destination": "Bulwell",
+                "block": None,
+                "trip_id": 3,
+            },
+        )
+
+        # old JSON records can still be read
+        self.assertEqual(
+            location_encoding.decode_location(b'{"id": 1, "journey_id": 2}'),
+            {"id": 1, "journey_id": 2},
+        )
+
+    def test_journey_history_archive(self):
+        redis_client = fakeredis.FakeStrictRedis()
+        key = self.journey.get_redis_key()
+        self.journey.datetime = parse_datetime(self.datetime)  # (not a string)
+
+        pipe = redis_client.pipeline()
+        for i, x in enumerate((1.0, 1.5)):
+            location = VehicleLocation(latlong=Point(x, 52), heading=90)
+            location.journey = self.journey
+            location.datetime = parse_datetime(self.datetime)
+            location.datetime = location.datetime.replace(minute=50 + i)
+            history.push(pipe, *location.get_appendage(), location.datetime.timestamp())
+        history.push_stop_event(pipe, self.journey.id, 123, 1603151400)
+        history.push_stop_event(pipe, self.journey.id, 123, 1603151460)
+        pipe.execute()
+        locations = redis_client.lrange(key, 0, -1)
+        self.assertEqual(len(locations), 2)
+        self.assertGreater(redis_client.ttl(key), 0)
+
+        with (
+            TemporaryDirectory() as temp_dir,
+            override_settings(JOURNEY_HISTORY_DIR=temp_dir),
+            patch("vehicles.history.redis_client", redis_client),
+        ):
+            # not old enough yet
+            history.archive(now=parse_datetime("2020-10-20T00:30:00Z"))
+            self.assertTrue(redis_client.exists(key))
+
+            history.archive(now=parse_datetime("2020-10-20T12:00:00Z"))
+            self.assertFalse(redis_client.exists(key))
+            self.assertFalse(redis_client.zcard(history.LAST_POINTS_KEY))
+
+            # read back from the archive
+            self.assertEqual(history.get_locations(self.journey), locations)
+            self.assertFalse(
+                redis_client.exists(history.get_stop_events_key(self.journey.id))
+            )
+            self.assertEqual(
+                history.get_stop_events(self.journey),
+                {123: parse_datetime("2020-10-19T23:51:00Z")},
+            )
+
+            # a later run merges another journey into the same file
+            journey_2 = VehicleJourney.objects.create(
+                vehicle=self.vehicle_2,
+                datetime=self.journey.datetime,
+                source_id=self.journey.source_id,
+                route_name="2",
+            )
+            location = VehicleLocation(latlong=Point(2, 52), heading=90)
+            location.journey = journey_2
+            location.datetime = self.journey.datetime
+            pipe = redis_client.pipeline()
+            history.push(pipe, *location.get_appendage(), location.datetime.timestamp())
+            pipe.execute()
+            history.archive(now=parse_datetime("2020-10-20T12:15:00Z"))
+
+            (date_dir,) = history.get_archive_dir().iterdir()
+            self.assertEqual(
+                sorted(path.name for path in date_dir.iterdir()),
+                ["LYNX.npz", "index.json"],
+            )
+            self.assertEqual(
+                history.read_index(date_dir),
+                {str(self.journey.id): "LYNX.npz", str(journey_2.id): "LYNX.npz"},
+            )
+            self.assertEqual(len(history.get_locations(journey_2)), 1)
+
+            # found via the index, even if the vehicle has changed operator since
+            self.journey.vehicle.operator = self.bova
+            self.assertEqual(history.get_locations(self.journey), locations)
+
+            other_journey = VehicleJourney(
+                id=journey_2.id + 2, datetime=self.journey.datetime
+            )
+            # (without opening the archive files to find out)
+            self.assertEqual(
+                history.has_locations([self.journey, other_journey]), [True, False]
+            )
+            # too recent to have been archived
+            self.assertEqual(
+                history.has_locations(
+                    [other_journey], now=parse_datetime("2020-10-20T00:30:00Z")
+                ),
+                [False],
+            )
+            # nothing archived that day
+            other_journey.datetime = parse_datetime("2020-10-01T12:00:00Z")
+            self.assertEqual(history.has_locations([other_journey]), [False])
+
+            response = self.client.get(
+                f"/vehicles/{self.vehicle_1.id}/journeys/{self.journey.id}.json"
+            )
+            self.assertEqual(
+                [location["coordinates"] for location in response.json()["locations"]],
+                [[1.0, 52.0], [1.5, 52.0]],
+            )
+
+    def test_journey_history_remove_stationary(self):
+        locations = history.decode_locations(
+            [
+                history.location_struct.pack(timestamp, x, 52, True, 90, False, 0)
+                for timestamp, x in (
+                    (1603151460, 1.0001),
+                    (1603151400, 1.0),  # out of order
+                    (1603151520, 1.0002),
+                    (1603151580, 1.01),
+                    (1603151640, 1.0101),
+                )
+            ]
+        )
+        self.assertEqual(
+            history.locations_json(history.remove_stationary(locations)),
+            [
+                {
+                    "id": 1603151400,
+                    "coordinates": [1.0, 52.0],
+                    "delta": None,
+                    "direction": 90,
+                    "datetime": "2020-10-19T23:50:00Z",
+                },
+                {
+                    "id": 1603151520,
+                    "coordinates": [1.0002000331878662, 52.0],
+                    "delta": None,
+                    "direction": 90,
+                    "datetime": "2020-10-19T23:52:00Z",
+                },
+                {
+                    "id": 1603151580,
+                    "coordinates": [1.0099999904632568, 52.0],
+                    "delta": None,
+                    "direction": 90,
+                    "datetime": "2020-10-19T23:53:00Z",
+                },
+                {
+                    "id": 1603151640,
+                    "coordinates": [1.01010000705719, 52.0],
+                    "delta": None,
+                    "direction": 90,
+                    "datetime": "2020-10-19T23:54:00Z",
+                },
+            ],
+        )
+
+    def test_playback(self):
+        redis_client = fakeredis.FakeStrictRedis()
+        timestamp = parse_datetime("2020-10-19T23:50:30Z").timestamp()
+
+        pipe = redis_client.pipeline()
+        playback.push_positions(
+            pipe,
+            [
+                (timestamp, "LYNX", self.vehicle_1.id, 5, 1.5, 52.0, "90"),
+                (timestamp + 10, "LYNX", self.vehicle_1.id, 5, 1.5, 52.5, None),
+                (timestamp, None, self.vehicle_3.id, None, 0.5, 51.0, 45),
+            ],
+        )
+        pipe.execute()
+
+        with (
+            TemporaryDirectory() as temp_dir,
+            override_settings(VEHICLE_POSITIONS_DIR=temp_dir),
+            patch("vehicles.playback.redis_client", redis_client),
+        ):
+            response = self.client.get(
+                "/vehicles/positions.json?time=2020-10-19T23:50:59Z&operator=LYNX"
+            )
+            self.assertEqual(
+                response.json(),
+                {
+                    "datetime": "2020-10-19T23:50:00Z",
+                    "vehicles": [
+                        {
+                            "id": self.vehicle_1.id,
+                            "service_id": 5,
+                            "coordinates": [1.5, 52.5],
+                            "heading": None,
+                        }
+                    ],
+                },
+            )
+
+            playback.archive(now=parse_datetime("2020-10-20T12:00:00Z"))
+            self.assertFalse(redis_client.zcard(playback.BUCKETS_KEY))
+            # one file per operator per hour
+            self.assertEqual(
+                playback.read_index(Path(temp_dir) / "2020-10-20"),
+                {
+                    "LYNX/1603148400.npz": [1603151400, 1603151400],
+                    "_/1603148400.npz": [1603151400, 1603151400],
+                },
+            )
+
+            # read back from the archive
+            response = self.client.get(
+                "/vehicles/positions.json?time=2020-10-20T00:50:00"  # (local time)
+                "&xmin=0&ymin=50&xmax=1&ymax=52"
+            )
+            self.assertEqual(
+                response.json()["vehicles"],
+                [
+                    {
+                        "id": self.vehicle_3.id,
+                        "service_id": None,
+                        "coordinates": [0.5, 51.0],
+                        "heading": 45,
+                    }
+                ],
+            )
+
+            # more than playback.LOOKBACK later
+            response = self.client.get(
+                "/vehicles/positions.json?time=2020-10-19T23:56:00Z"
+            )
+            self.assertEqual(response.json()["vehicles"], [])
+
+            response = self.client.get(
+                "/vehicles/positions/playback.json?time=2020-10-19T23:49:00Z"
+                "&buckets=3&operator=LYNX"
+            )
+            self.assertEqual(
+                [
+                    (bucket["datetime"], len(bucket["vehicles"]))
+                    for bucket in response.json()["buckets"]
+                ],
+                [
+                    ("2020-10-19T23:49:00Z", 0),
+                    ("2020-10-19T23:50:00Z", 1),
+                    ("2020-10-19T23:51:00Z", 1),
+                ],
+            )
+            self.assertEqual(response["Cache-Control"], "public, max-age=3600")
+
+        response = self.client.get("/vehicles/positions.json?time=yesterday")
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(
+            "/vehicles/positions/playback.json?time=2020-10-19T23:50:00Z&buckets=1000"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_playback_lookback(self):
+        # a vehicle that reports every 90 seconds, so isn't in every bucket
+        redis_client = fakeredis.FakeStrictRedis()
+        start = parse_datetime("2020-10-19T23:50:00Z").timestamp()
+
+        pipe = redis_client.pipeline()
+        playback.push_positions(
+            pipe,
+            [
+                (start + i * 90, "LYNX", self.vehicle_1.id, 5, 1.5 + i / 4, 52.0, None)
+                for i in range(4)
+            ],
+        )
+        pipe.execute()
+
+        def get_xs():
+            return [
+                positions["x"].tolist()
+                for positions in playback.get_playback(int(start), 10, ["LYNX"])
+            ]
+
+        expected = [
+            [1.5],
+            [1.75],
+            [1.75],  # (no report in this bucket)
+            [2.0],
+            [2.25],
+            [2.25],
+            [2.25],
+            [2.25],
+            [2.25],
+            [],  # more than playback.LOOKBACK since the last report
+        ]
+
+        with (
+            TemporaryDirectory() as temp_dir,
+            override_settings(VEHICLE_POSITIONS_DIR=temp_dir),
+            patch("vehicles.playback.redis_client", redis_client),
+        ):
+            self.assertEqual(get_xs(), expected)
+
+            playback.archive(now=parse_datetime("2020-10-20T12:00:00Z"))
+            self.assertEqual(get_xs(), expected)
+
+    def test_live_updates(self):
+        def record(vehicle_id, x, y):
+            return location_encoding.encode_location(
+                {
+                    "id": vehicle_id,
+                    "journey_id": None,
+                    "coordinates": (x, y),
+                    "heading": None,
+                    "datetime": parse_datetime(self.datetime),
+                }
+            )
+
+        message = live_updates.pack_updates(
+            [
+                (record(1, -1.5, 52.0), "service2vehicles operatorLYNXvehicles"),
+                (record(2, 0.5, 51.0), ""),
+            ]
+        )
+        updates = live_updates.unpack_updates(message)
+        self.assertEqual(
+            [(item["id"], set_names) for item, set_names in updates],
+            [(1, {"service2vehicles", "operatorLYNXvehicles"}), (2, set())],
+        )
+
+        box = live_updates.Subscriber(bounds=(0, 50, 1, 52))
+        service = live_updates.Subscriber(service_ids=[2])
+        operator = live_updates.Subscriber(operator_ids=["BOVA"])
+        vehicle = live_updates.Subscriber(vehicle_ids=[1])
+        for subscriber in (box, service, operator, vehicle):
+            subscriber.put(updates)
+
+        self.assertEqual([item["id"] for item in box.queue.get_nowait()[0]], [2])
+        self.assertEqual([item["id"] for item in service.queue.get_nowait()[0]], [1])
+        self.assertTrue(operator.queue.empty())
+        self.assertEqual([item["id"] for item in vehicle.queue.get_nowait()[0]], [1])
+
+        # vehicle 2 leaves the box
+        box.put([(location_encoding.decode_location(record(2, 1.5, 51.0)), set())])
+        self.assertEqual(box.queue.get_nowait(), ([], [2]))
+        # but isn't mentioned again, nor is a vehicle the client never had
+        box.put(
+            [
+                (location_encoding.decode_location(record(2, 1.6, 51.0)), set()),
+                (location_encoding.decode_location(record(3, 1.6, 51.0)), set()),
+            ]
+        )
+        self.assertTrue(box.queue.empty())
+
+        # slow clients miss intermediate batches, rather than using lots of memory
+        for _ in range(20):
+            box.put(updates)
+        self.assertEqual(box.queue.qsize(), 10)
+
+        with patch("vehicles.views.redis_client", fakeredis.FakeStrictRedis()):
+            response = self.client.get("/vehicles/stream?service=a")
+            self.assertEqual(response.status_code, 400)
+
+            # not under ASGI
+            response = self.client.get("/vehicles/stream?service=2")
+            self.assertEqual(response.status_code, 503)
+
+    def test_cache_journeys(self):
+        redis_client = fakeredis.FakeStrictRedis()
+
+        with (
+            patch("vehicles.utils.redis_client", redis_client),
+            patch("vehicles.utils.cache.set_many") as set_many,
+        ):
+            # edited vehicles' journeys are cached again by the next importer cycle
+            with self.captureOnCommitCallbacks(execute=True):
+                self.vehicle_1.save(update_fields=["notes"])
+            self.assertEqual(
+                redis_client.smembers(utils.STALE_VEHICLES_KEY),
+                {str(self.vehicle_1.id).encode()},
+            )
+
+            with self.assertNumQueries(1):
+                self.assertEqual(utils.cache_journeys(set()), 1)
+            self.assertFalse(redis_client.exists(utils.STALE_VEHICLES_KEY))
+
+            journeys, timeout = set_many.call_args.args
+            self.assertEqual(timeout, utils.JOURNEY_CACHE_TIMEOUT)
+            journey = journeys[f"journey{self.journey.id}"]
+            self.assertEqual(journey["vehicle"]["features"], "Wi-Fi")
+            self.assertEqual(
+                journey["service"],
+                {"url": "/services/spixworth-hunworth-happisburgh", "line_name": "2"},
+            )
+
+            # nothing to do
+            with self.assertNumQueries(0):
+                self.assertEqual(utils.cache_journeys(set()), 0)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.livery.save()
+            self.assertEqual(
+                redis_client.smembers(utils.STALE_LIVERIES_KEY),
+                {str(self.livery.id).encode()},
+            )
+            with self.assertNumQueries(1):
+                self.assertEqual(utils.cache_journeys(set()), 0)
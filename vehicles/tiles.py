@@ -0,0 +1,134 @@
+"""Snapshots of all the live vehicles in each map tile, at a few zoom levels,
+so that the big map can fetch /vehicles/tiles/{z}/{x}/{y}.json?v={version} -
+the same for everyone looking at the same area, so cacheable by a CDN -
+instead of vehicles.json with its own arbitrary bounding box.
+
+The update_vehicle_tiles management command builds a new set of snapshots every
+MIN_INTERVAL seconds, if there's been a new ingest version since the last set (see
+UPDATE_LOCATIONS_SCRIPT) - one process for all the live importers, rather than
+each of them doing it in its own update cycle. (LOCK_KEY and INTERVAL_KEY stop two
+of them building at once, if two are ever left running.)
+"""
+
+import json
+import logging
+import math
+
+from redis.exceptions import ConnectionError, LockError
+
+from .location_encoding import decode_locations
+from .utils import get_journeys, redis_client
+
+logger = logging.getLogger(__name__)
+
+ZOOM_LEVELS = (6, 9, 12)
+MIN_INTERVAL = 10  # seconds
+LOCK_TIMEOUT = 120  # seconds - much longer than a build should ever take
+EXPIRE = 120  # seconds - long enough for clients to fetch a set of tiles
+
+VERSION_KEY = "vehicle_tiles_version"
+LOCK_KEY = "vehicle_tiles_lock"  # held while building
+INTERVAL_KEY = "vehicle_tiles_interval"  # exists for MIN_INTERVAL after a build
+
+
+def get_tile_key(version, z: int, x: int, y: int) -> str:
+    return f"vehicle_tiles:{version}:{z}/{x}/{y}"
+
+
+def get_version_key(version) -> str:
+    # (exists while a version's tiles do - to tell an empty tile from an expired one)
+    return f"vehicle_tiles:{version}"
+
+
+def get_tile(longitude: float, latitude: float, z: int) -> tuple[int, int]:
+    """The x and y of the "slippy map" tile containing a point"""
+
+    n = 1 << z
+    x = int((longitude + 180) / 360 * n)
+    latitude = math.radians(max(min(latitude, 85.05112878), -85.05112878))
+    y = int((1 - math.asinh(math.tan(latitude)) / math.pi) / 2 * n)
+    return min(x, n - 1), min(y, n - 1)
+
+
+def build_tiles(version) -> int:
+    """Write a snapshot of every non-empty tile for this ingest version"""
+
+    vehicle_ids = [
+        int(vehicle_id)
+        for vehicle_id in redis_client.zrange("vehicle_location_locations", 0, -1)
+    ]
+    vehicle_locations = decode_locations(
+        redis_client.mget([f"vehicle{vehicle_id}" for vehicle_id in vehicle_ids])
+    )
+    journeys = get_journeys(vehicle_ids, vehicle_locations)
+
+    tiles = {}  # (z, x, y): [serialised vehicle, ...]
+    for vehicle_id, item in zip(vehicle_ids, vehicle_locations):
+        if not item:
+            continue
+        if vehicle_id in journeys:
+            if journeys[vehicle_id] is None:
+                continue  # vehicle was deleted?
+            item.update(journeys[vehicle_id])
+
+        serialised = json.dumps(item, separators=(",", ":")).encode()
+        for z in ZOOM_LEVELS:
+            x, y = get_tile(*item["coordinates"], z)
+            tiles.setdefault((z, x, y), []).append(serialised)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for (z, x, y), items in tiles.items():
+        pipe.set(
+            get_tile_key(version, z, x, y),
+            b"[" + b",".join(items) + b"]",
+            ex=EXPIRE,
+        )
+    pipe.set(get_version_key(version), len(tiles), ex=EXPIRE)
+    pipe.set(VERSION_KEY, version)
+    pipe.execute()
+
+    return len(tiles)
+
+
+def update_tiles():
+    """Build a new set of tiles, if there's a new ingest version
+    and no one else has done so recently
+    """
+
+    if not redis_client:
+        return
+
+    try:
+        version = redis_client.get("vehicle_locations_version")
+        if not version or version == redis_client.get(VERSION_KEY):
+            return
+        lock = redis_client.lock(LOCK_KEY, timeout=LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            if redis_client.set(INTERVAL_KEY, 1, nx=True, ex=MIN_INTERVAL):
+                build_tiles(int(version))
+        finally:
+            try:
+                lock.release()
+            except LockError as e:
+                # (the build outlasted LOCK_TIMEOUT)
+                logger.exception(e)
+    except ConnectionError as e:
+        logger.exception(e)
+
+
+def get_version() -> int:
+    if not redis_client:
+        return 0
+    return int(redis_client.get(VERSION_KEY) or 0)
+
+
+def get_tile_json(version, z: int, x: int, y: int) -> tuple[int, bytes]:
+    """The tile for the version if it's still there, otherwise the current version's"""
+
+    if not redis_client:
+        return 0, b"[]"
+    if not version or not redis_client.exists(get_version_key(version)):
+        version = get_version()
+    return version, redis_client.get(get_tile_key(version, z, x, y)) or b"[]"
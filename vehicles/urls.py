@@ -13,6 +13,11 @@ urlpatterns = [
     path("services/<slug>/vehicles", views.service_vehicles_history),
     path("vehicles", views.vehicles),
     path("vehicles.json", views.vehicles_json),
+    path("vehicles/stream", views.vehicles_stream),
+    path("vehicles/tiles.json", views.vehicle_tiles),
+    path("vehicles/tiles/<int:z>/<int:x>/<int:y>.json", views.vehicle_tile),
+    path("vehicles/positions.json", views.vehicle_positions_json),
+    path("vehicles/positions/playback.json", views.vehicle_positions_playback),
     path("vehicles/debug", views.debug),
     path("vehicles/history", views.vehicle_edits),
     path("vehicles/edits", views.vehicle_edits),
@@ -1,9 +1,16 @@
+import logging
 import math
+from datetime import timedelta
 
-from django.core.cache import caches
+from django.contrib.postgres.aggregates import StringAgg
+from django.core.cache import cache, caches
 from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import OperationalError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from redis.exceptions import ConnectionError
 
-from .models import VehicleRevision, VehicleRevisionFeature
+from .models import Vehicle, VehicleRevision, VehicleRevisionFeature
 
 try:
     redis_client = caches["redis"]._cache.get_client()
@@ -181,3 +188,160 @@ def apply_revision(revision, features=None):
             vehicle.features.add(feature.feature_id)
         else:
             vehicle.features.remove(feature.feature_id)
+
+    journeys_modified(vehicle_ids=[vehicle.id])
+
+
+features_string_agg = StringAgg(
+    "features__name", ", ", order_by=["features__name"], default=""
+)
+
+JOURNEY_CACHE_TIMEOUT = 3600 * 6
+
+# vehicles and liveries changed since their journeys' details were cached
+STALE_VEHICLES_KEY = "journey_cache_stale_vehicles"
+STALE_LIVERIES_KEY = "journey_cache_stale_liveries"
+
+
+def journeys_modified(vehicle_ids=(), livery_ids=()):
+    """Tell live importers to cache these vehicles' (or liveries') journeys' details
+    again, once the current transaction has been committed (see cache_journeys)
+    """
+    if not redis_client:
+        return
+
+    def on_commit():
+        try:
+            pipeline = redis_client.pipeline(transaction=False)
+            if vehicle_ids:
+                pipeline.sadd(STALE_VEHICLES_KEY, *vehicle_ids)
+            if livery_ids:
+                pipeline.sadd(STALE_LIVERIES_KEY, *livery_ids)
+            pipeline.execute()
+        except ConnectionError:
+            pass
+
+    transaction.on_commit(on_commit)
+
+
+def get_vehicles_with_details():
+    return (
+        Vehicle.objects.select_related("vehicle_type")
+        .annotate(
+            feature_names=features_string_agg,
+            service_line_name=F("latest_journey__trip__route__line_name"),
+            service_slug=F("latest_journey__service__slug"),
+            route_name=F("latest_journey__route_name"),
+            colour=F("livery__colour"),
+        )
+        .defer("data", "latest_journey_data")
+    )
+
+
+def get_journey_details(vehicle) -> dict:
+    """The "journey{id}" cache value for a vehicle from get_vehicles_with_details()"""
+    journey = {"vehicle": vehicle.get_json()}
+    if vehicle.service_slug:
+        journey["service"] = {
+            "url": f"/services/{vehicle.service_slug}",
+            "line_name": vehicle.service_line_name or vehicle.route_name or None,
+        }
+    return journey
+
+
+def cache_journeys(vehicle_ids) -> int:
+    """Cache the details of these vehicles' latest journeys, and of those of any
+    vehicles or liveries changed since they were cached, so that vehicles.json
+    (see get_journeys) doesn't have to get them from the database.
+
+    Called by live importers after saving new or changed journeys
+    """
+
+    q = Q(id__in=vehicle_ids) if vehicle_ids else None
+
+    if redis_client:
+        try:
+            pipeline = redis_client.pipeline(transaction=False)
+            pipeline.spop(STALE_VEHICLES_KEY, 1000)
+            pipeline.spop(STALE_LIVERIES_KEY, 100)
+            stale_vehicle_ids, stale_livery_ids = pipeline.execute()
+        except ConnectionError:
+            pass
+        else:
+            if stale_vehicle_ids:
+                stale = Q(id__in=[int(vehicle_id) for vehicle_id in stale_vehicle_ids])
+                q = q | stale if q else stale
+            if stale_livery_ids:
+                stale = Q(
+                    livery__in=[int(livery_id) for livery_id in stale_livery_ids],
+                    latest_journey__datetime__gte=timezone.now() - timedelta(days=1),
+                )
+                q = q | stale if q else stale
+
+    if not q:
+        return 0
+
+    journeys = {
+        f"journey{vehicle.latest_journey_id}": get_journey_details(vehicle)
+        for vehicle in get_vehicles_with_details().filter(
+            q, latest_journey__isnull=False
+        )
+    }
+    cache.set_many(journeys, JOURNEY_CACHE_TIMEOUT)
+    return len(journeys)
+
+
+def get_journeys(vehicle_ids, vehicle_locations) -> dict:
+    """Vehicle and service details to add to each location -
+    from the "journey{id}" cache, or the database for any not in the cache.
+
+    Returns {vehicle id: details}, or {vehicle id: None} if the vehicle has been deleted
+    """
+
+    journeys = cache.get_many(
+        [f"journey{item['journey_id']}" for item in vehicle_locations if item]
+    )
+
+    # get vehicles from the database if they have unexpired locations, and weren't in
+    # the cache (live importers should have put them there - see cache_journeys)
+    try:
+        vehicles = get_vehicles_with_details().in_bulk(
+            [
+                vehicle_id
+                for vehicle_id, item in zip(vehicle_ids, vehicle_locations)
+                if item and f"journey{item['journey_id']}" not in journeys
+            ]
+        )
+    except OperationalError:
+        vehicles = {}
+
+    result = {}
+    journeys_to_cache_later = {}
+
+    for vehicle_id, item in zip(vehicle_ids, vehicle_locations):
+        if not item:
+            continue
+
+        journey_cache_key = f"journey{item['journey_id']}"
+
+        if journey_cache_key in journeys:
+            result[vehicle_id] = journeys[journey_cache_key]
+        elif vehicles:
+            try:
+                vehicle = vehicles[vehicle_id]
+            except KeyError:
+                result[vehicle_id] = None  # vehicle was deleted?
+                continue
+            journey = get_journey_details(vehicle)
+            if vehicle.latest_journey_id == item["journey_id"]:
+                journeys_to_cache_later[journey_cache_key] = journey
+            else:
+                logging.warning(
+                    f"{vehicle=} {vehicle.latest_journey_id=} {item['journey_id']=}"
+                )
+            result[vehicle_id] = journey
+
+    if journeys_to_cache_later:
+        cache.set_many(journeys_to_cache_later, JOURNEY_CACHE_TIMEOUT)
+
+    return result
@@ -1,24 +1,35 @@
+import asyncio
 import datetime
+from collections import Counter
 from http import HTTPStatus
 import json
 import logging
 from itertools import pairwise
 from urllib.parse import unquote
 
+import numpy as np
 import subprocess
-import xmltodict
+from asgiref.sync import sync_to_async
+from ciso8601 import parse_datetime
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.auth.decorators import login_required
-from django.contrib.gis.geos import GEOSException, Point
-from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.gis.geos import GEOSException
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
 from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import IntegrityError, OperationalError, connection, transaction
 from django.db.models import Case, F, Max, OuterRef, Q, When
 from django.db.models.functions import Coalesce, Now
-from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils import timezone
@@ -28,7 +39,6 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_safe
 from django.views.generic.detail import DetailView
 from haversine import Unit, haversine, haversine_vector
-from redis.exceptions import ConnectionError
 from sql_util.utils import Exists, SubqueryMax, SubqueryMin
 
 from accounts.models import User
@@ -38,20 +48,26 @@ from busstops.utils import get_bounding_box
 from bustimes.models import Garage, Route, StopTime
 from bustimes.utils import contiguous_stoptimes_only, get_other_trips_in_block
 
-from . import filters, forms
+from . import filters, forms, history, live_updates, playback, siri_queue, tiles
+from .location_encoding import decode_locations
 from .management.commands import import_bod_avl
 from .models import (
     Livery,
     SiriSubscription,
     Vehicle,
     VehicleJourney,
-    VehicleLocation,
     VehicleRevision,
     VehicleRevisionFeature,
 )
-from .rtpi import add_progress_and_delay
-from .tasks import handle_siri_post
-from .utils import apply_revision, get_revision, redis_client  # calculate_bearing,
+from .rtpi import STOP_RADIUS, add_progress_and_delay
+from .tasks import handle_overland_post, handle_siri_post
+from .utils import (  # calculate_bearing,
+    apply_revision,
+    features_string_agg,
+    get_journeys,
+    get_revision,
+    redis_client,
+)
 
 
 class Vehicles:
@@ -124,11 +140,6 @@ def liveries_css(request, version=0):
     return HttpResponse(styles, content_type="text/css")
 
 
-features_string_agg = StringAgg(
-    "features__name", ", ", order_by=["features__name"], default=""
-)
-
-
 def get_vehicle_order(vehicle) -> tuple[str, int, str]:
     if vehicle.notes == "Spare ticket machine":
         return ("", vehicle.fleet_number or 99999, vehicle.code)
@@ -335,6 +346,83 @@ def respond_conditionally(request, response):
     )
 
 
+# how far behind a vehicles.json?since= client can be and still get just the changes
+# (see UPDATE_LOCATIONS_SCRIPT)
+MAX_DELTA_VERSIONS = 10000
+
+# how many of each vehicle's states are kept (see UPDATE_LOCATIONS_SCRIPT)
+MAX_STATES = 3
+
+# vehicles.json?cluster= - clusters instead of vehicles if there are more than this many
+CLUSTER_THRESHOLD = 500
+MAX_CLUSTER_GRID = 64
+
+
+def was_in_view(states, since: int, extent, set_names) -> bool:
+    """Whether a vehicle was in the bounding box (or any of the sets, e.g. services)
+    as of a version - so whether a vehicles.json?since= client would have it -
+    judging by its last few states (see UPDATE_LOCATIONS_SCRIPT)
+    """
+
+    if not states:
+        return True  # can't tell
+
+    states = states.decode().split("|")
+    for state in states:
+        version, x, y, *state_set_names = state.split(" ")
+        if int(version) <= since:
+            if extent:
+                xmin, ymin, xmax, ymax = extent
+                return xmin <= float(x) <= xmax and ymin <= float(y) <= ymax
+            return not set_names.isdisjoint(state_set_names)
+
+    # all its states are since the version, so it was new since then -
+    # unless it's changed more times than there are states, in which case can't tell
+    return len(states) == MAX_STATES
+
+
+def get_clusters(vehicles: list, extent: tuple, grid: int) -> dict:
+    """Divide the bounding box into a grid of grid x grid cells,
+    and count the vehicles in each, with their centroid and most common operator
+    """
+
+    xmin, ymin, xmax, ymax = extent
+    cell_width = (xmax - xmin) / grid or 1
+    cell_height = (ymax - ymin) / grid or 1
+
+    operator_ids = redis_client.hmget(
+        "vehicle_location_operators", [vehicle_id for vehicle_id, _ in vehicles]
+    )
+
+    cells = {}
+    for (_, (x, y)), operator_id in zip(vehicles, operator_ids):
+        key = (
+            min(max(int((x - xmin) / cell_width), 0), grid - 1),
+            min(max(int((y - ymin) / cell_height), 0), grid - 1),
+        )
+        if key in cells:
+            cell = cells[key]
+        else:
+            cell = cells[key] = [0, 0.0, 0.0, Counter()]
+        cell[0] += 1
+        cell[1] += x
+        cell[2] += y
+        if operator_id:
+            cell[3][operator_id.decode()] += 1
+
+    return {
+        "count": len(vehicles),
+        "clusters": [
+            {
+                "count": count,
+                "coordinates": [round(x / count, 6), round(y / count, 6)],
+                "operator": operators.most_common(1)[0][0] if operators else None,
+            }
+            for count, x, y, operators in cells.values()
+        ],
+    }
+
+
 @require_safe
 def vehicles_json(request) -> JsonResponse:
     try:
@@ -344,22 +432,38 @@ def vehicles_json(request) -> JsonResponse:
     except (GEOSException, ValueError):
         return HttpResponseBadRequest()
 
-    all_vehicles = (
-        Vehicle.objects.select_related("vehicle_type")
-        .annotate(
-            feature_names=features_string_agg,
-            service_line_name=F("latest_journey__trip__route__line_name"),
-            service_slug=F("latest_journey__service__slug"),
-            colour=F("livery__colour"),
-        )
-        .defer("data", "latest_journey_data")
-    )
-
     vehicle_ids = None
     set_names = None
     service_ids = None
     operator_ids = None
 
+    # ?since=<version> - only vehicles changed since the version,
+    # and the ids of any removed since
+    since = request.GET.get("since")
+    changed = None
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return HttpResponseBadRequest()
+        version = int(redis_client.get("vehicle_locations_version") or 0)
+        full = not 0 < since <= version or version - since > MAX_DELTA_VERSIONS
+        if not full:
+            changed = {
+                int(vehicle_id)
+                for vehicle_id in redis_client.zrangebyscore(
+                    "vehicle_location_versions", f"({since}", "+inf"
+                )
+            }
+            removed = [
+                int(vehicle_id)
+                for vehicle_id in redis_client.zrangebyscore(
+                    "vehicle_location_removals", f"({since}", "+inf"
+                )
+            ]
+        else:
+            removed = []
+
     if bounds is not None:
         # ids of vehicles within box
         xmin, ymin, xmax, ymax = bounds.extent
@@ -371,6 +475,16 @@ def vehicles_json(request) -> JsonResponse:
         except ValueError as e:
             return HttpResponseBadRequest(e)
 
+        if "cluster" in request.GET:
+            try:
+                grid = int(request.GET["cluster"])
+            except ValueError:
+                return HttpResponseBadRequest()
+            if not 0 < grid <= MAX_CLUSTER_GRID:
+                return HttpResponseBadRequest()
+        else:
+            grid = None
+
         vehicle_ids = redis_client.geosearch(
             "vehicle_location_locations",
             longitude=str((xmax + xmin) / 2),
@@ -378,8 +492,17 @@ def vehicles_json(request) -> JsonResponse:
             unit="km",
             width=str(width),
             height=str(height),
+            withcoord=grid is not None,
         )
 
+        if grid:
+            if len(vehicle_ids) > CLUSTER_THRESHOLD:
+                response = JsonResponse(
+                    get_clusters(vehicle_ids, bounds.extent, grid)
+                )
+                return respond_conditionally(request, response)
+            vehicle_ids = [vehicle_id for vehicle_id, _ in vehicle_ids]
+
     elif "service" in request.GET:
         try:
             service_ids = [
@@ -394,6 +517,8 @@ def vehicles_json(request) -> JsonResponse:
     elif "id" in request.GET:
         # specified vehicle ids
         vehicle_ids = request.GET["id"].split(",")
+    elif changed is not None:
+        vehicle_ids = changed
     else:
         # ids of all vehicles
         vehicle_ids = redis_client.zrange("vehicle_location_locations", 0, -1)
@@ -402,15 +527,40 @@ def vehicles_json(request) -> JsonResponse:
         vehicle_ids = list(redis_client.sunion(set_names))
 
     vehicle_ids = [int(vehicle_id) for vehicle_id in vehicle_ids]
+    single_vehicle = len(vehicle_ids) == 1
+
+    if changed is not None:
+        in_query = set(vehicle_ids)
+        if bounds is not None or set_names:
+            # vehicles that changed but are no longer in the bounding box, services
+            # or operators - or have expired - have gone as far as the client is
+            # concerned, but only if they were there before
+            gone = removed + [
+                vehicle_id for vehicle_id in changed if vehicle_id not in in_query
+            ]
+            states = redis_client.hmget("vehicle_location_states", gone) if gone else []
+            removed = [
+                vehicle_id
+                for vehicle_id, vehicle_states in zip(gone, states)
+                if was_in_view(
+                    vehicle_states,
+                    since,
+                    bounds and bounds.extent,
+                    set_names and set(set_names),
+                )
+            ]
+        elif "id" in request.GET:
+            removed = [vehicle_id for vehicle_id in removed if vehicle_id in in_query]
+        vehicle_ids = [
+            vehicle_id for vehicle_id in vehicle_ids if vehicle_id in changed
+        ]
 
     vehicle_ids.sort()  # for etag stableness
 
     vehicle_locations = redis_client.mget(
         [f"vehicle{vehicle_id}" for vehicle_id in vehicle_ids]
     )
-    vehicle_locations = [
-        json.loads(item) if item else item for item in vehicle_locations
-    ]
+    vehicle_locations = decode_locations(vehicle_locations)
 
     # remove expired items from 'vehicle_location_locations'
     to_remove = [
@@ -422,21 +572,7 @@ def vehicles_json(request) -> JsonResponse:
     if to_remove:
         redis_client.zrem("vehicle_location_locations", *to_remove)
 
-    journeys = cache.get_many(
-        [f"journey{item['journey_id']}" for item in vehicle_locations if item]
-    )
-
-    # get vehicles from the database if they have unexpired locations, and weren't in the cache
-    try:
-        vehicles = all_vehicles.in_bulk(
-            [
-                vehicle_id
-                for vehicle_id, item in zip(vehicle_ids, vehicle_locations)
-                if item and f"journey{item['journey_id']}" not in journeys
-            ]
-        )
-    except OperationalError:
-        vehicles = {}
+    journeys = get_journeys(vehicle_ids, vehicle_locations)
 
     locations = []
 
@@ -444,40 +580,17 @@ def vehicles_json(request) -> JsonResponse:
     if trip:
         trip = int(trip)
 
-    journeys_to_cache_later = {}
-
     for vehicle_id, item in zip(vehicle_ids, vehicle_locations):
         if item:
-            journey_cache_key = f"journey{item['journey_id']}"
-
-            if journey_cache_key in journeys:
-                item.update(journeys[journey_cache_key])
-            elif vehicles:
-                try:
-                    vehicle = vehicles[vehicle_id]
-                except KeyError:
+            if vehicle_id in journeys:
+                if journeys[vehicle_id] is None:
                     continue  # vehicle was deleted?
-                else:
-                    journey = {"vehicle": vehicle.get_json()}
-                    if vehicle.service_slug:
-                        journey["service"] = {
-                            "url": f"/services/{vehicle.service_slug}",
-                            "line_name": vehicle.service_line_name
-                            or item.get("service")
-                            and item["service"]["line_name"],
-                        }
-                    if vehicle.latest_journey_id == item["journey_id"]:
-                        journeys_to_cache_later[journey_cache_key] = journey
-                    else:
-                        logging.warning(
-                            f"{vehicle=} {vehicle.latest_journey_id=} {item['journey_id']=}"
-                        )
-                    item.update(journey)
+                item.update(journeys[vehicle_id])
 
             if (
                 "progress" not in item
                 and "trip_id" in item
-                and (len(vehicle_ids) == 1 or trip and item["trip_id"] == trip)
+                and (single_vehicle or trip and item["trip_id"] == trip)
             ):
                 add_progress_and_delay(item)
 
@@ -489,19 +602,240 @@ def vehicles_json(request) -> JsonResponse:
         ):
             for set_name in set_names:
                 redis_client.srem(set_name, vehicle_id)
+            if since is not None:
+                removed.append(vehicle_id)
         elif item:
             locations.append(item)
+        elif since is not None:
+            removed.append(vehicle_id)
 
-    if journeys_to_cache_later:
-        cache.set_many(journeys_to_cache_later, 3600)  # an hour
-
-    response = JsonResponse(locations, safe=False)
-    if not locations:
-        response.status_code = HTTPStatus.NOT_FOUND
+    if since is not None:
+        response = JsonResponse(
+            {
+                "version": version,
+                "full": full,
+                "vehicles": locations,
+                "removed": sorted(set(removed)),
+            }
+        )
+    else:
+        response = JsonResponse(locations, safe=False)
+        if not locations:
+            response.status_code = HTTPStatus.NOT_FOUND
 
     return respond_conditionally(request, response)
 
 
+async def vehicles_stream(request):
+    """Server-sent events of vehicle locations as they change (see live_updates),
+    for a bounding box, services, operators or vehicles - like vehicles_json.
+
+    Needs an ASGI server (buses.asgi) - vehicles_json is still there for polling
+    """
+
+    if not redis_client:
+        return HttpResponse(status=HTTPStatus.SERVICE_UNAVAILABLE)
+
+    try:
+        bounds = get_bounding_box(request).extent
+    except KeyError:
+        bounds = None
+    except (GEOSException, ValueError):
+        return HttpResponseBadRequest()
+
+    service_ids = operator_ids = vehicle_ids = None
+    try:
+        if "service" in request.GET:
+            service_ids = [
+                int(service_id) for service_id in request.GET["service"].split(",")
+            ]
+        elif "operator" in request.GET:
+            operator_ids = request.GET["operator"].split(",")
+        elif "id" in request.GET:
+            vehicle_ids = [
+                int(vehicle_id) for vehicle_id in request.GET["id"].split(",")
+            ]
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    if not isinstance(request, ASGIRequest):
+        # a WSGI worker would be tied up until it timed out -
+        # so tell the client to poll vehicles_json instead
+        return HttpResponse(status=HTTPStatus.SERVICE_UNAVAILABLE)
+
+    subscriber = live_updates.Subscriber(
+        bounds=bounds,
+        service_ids=service_ids,
+        operator_ids=operator_ids,
+        vehicle_ids=vehicle_ids,
+    )
+
+    return StreamingHttpResponse(
+        stream_vehicles(subscriber),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def stream_vehicles(subscriber):
+    live_updates.broadcaster.subscribe(subscriber)
+    try:
+        yield "retry: 10000\n\n"
+
+        while True:
+            try:
+                items, removed = await asyncio.wait_for(subscriber.queue.get(), 25)
+            except TimeoutError:
+                yield ": keep-alive\n\n"  # so a closed connection is noticed
+                continue
+
+            vehicle_ids = [item["id"] for item in items]
+            journeys = await sync_to_async(get_journeys)(vehicle_ids, items)
+
+            locations = []
+            for item in items:
+                if item["id"] in journeys:
+                    if journeys[item["id"]] is None:
+                        continue  # vehicle was deleted?
+                    item.update(journeys[item["id"]])
+                locations.append(item)
+
+            data = json.dumps(
+                {"vehicles": locations, "removed": removed}, cls=DjangoJSONEncoder
+            )
+            yield f"data: {data}\n\n"
+    finally:
+        live_updates.broadcaster.unsubscribe(subscriber)
+
+
+@require_safe
+def vehicle_tiles(request):
+    """The current version of the tile snapshots (see tiles) and their zoom levels"""
+
+    response = JsonResponse(
+        {"version": tiles.get_version(), "zoom_levels": tiles.ZOOM_LEVELS}
+    )
+    response["Cache-Control"] = response["CDN-Cache-Control"] = "public, max-age=5"
+    return response
+
+
+@require_safe
+def vehicle_tile(request, z, x, y):
+    """A tile snapshot - for a particular version (?v=) if it's still available,
+    in which case it'll never change, otherwise the current version
+    """
+
+    if z not in tiles.ZOOM_LEVELS or x >= 1 << z or y >= 1 << z:
+        raise Http404
+
+    try:
+        requested_version = int(request.GET.get("v", 0))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    version, content = tiles.get_tile_json(requested_version, z, x, y)
+
+    response = HttpResponse(content, content_type="application/json")
+    response["X-Tiles-Version"] = version
+    if version and version == requested_version:
+        cache_control = "public, max-age=3600, immutable"
+    else:
+        cache_control = "public, max-age=5"
+    response["Cache-Control"] = response["CDN-Cache-Control"] = cache_control
+    return response
+
+
+# /vehicles/positions/playback.json - how many buckets can be played back in one go
+MAX_PLAYBACK_BUCKETS = 180
+
+
+def get_playback_query(request) -> tuple:
+    """?time= (ISO 8601), and a bounding box, services or operators -
+    like vehicles_json
+    """
+
+    when = parse_datetime(request.GET["time"])
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+
+    try:
+        bounds = get_bounding_box(request).extent
+    except KeyError:
+        bounds = None
+
+    service_ids = operator_ids = None
+    if "service" in request.GET:
+        service_ids = [
+            int(service_id) for service_id in request.GET["service"].split(",")
+        ]
+    elif "operator" in request.GET:
+        operator_ids = request.GET["operator"].split(",")
+
+    return playback.get_bucket(when.timestamp()), bounds, service_ids, operator_ids
+
+
+def get_playback_json(bucket, positions, bounds, service_ids) -> dict:
+    return {
+        "datetime": datetime.datetime.fromtimestamp(bucket, datetime.timezone.utc),
+        "vehicles": playback.positions_json(positions, bounds, service_ids),
+    }
+
+
+@require_safe
+def vehicle_positions_json(request):
+    """Where vehicles were at a past time (see playback)"""
+
+    try:
+        bucket, bounds, service_ids, operator_ids = get_playback_query(request)
+    except (KeyError, ValueError, GEOSException):
+        return HttpResponseBadRequest()
+
+    positions = playback.get_positions(bucket, operator_ids)
+
+    response = JsonResponse(get_playback_json(bucket, positions, bounds, service_ids))
+    if bucket + playback.BUCKET < timezone.now().timestamp():
+        cache_control = "public, max-age=3600"
+    else:
+        cache_control = "public, max-age=5"
+    response["Cache-Control"] = response["CDN-Cache-Control"] = cache_control
+    return response
+
+
+@require_safe
+def vehicle_positions_playback(request):
+    """Consecutive buckets from a past time, for the client to play back -
+    up to ?buckets= of them (60 by default)
+    """
+
+    try:
+        bucket, bounds, service_ids, operator_ids = get_playback_query(request)
+        count = int(request.GET.get("buckets", 60))
+    except (KeyError, ValueError, GEOSException):
+        return HttpResponseBadRequest()
+    if not 0 < count <= MAX_PLAYBACK_BUCKETS:
+        return HttpResponseBadRequest()
+
+    now = timezone.now().timestamp()
+    last = min(bucket + (count - 1) * playback.BUCKET, playback.get_bucket(now))
+
+    buckets = range(bucket, last + 1, playback.BUCKET)
+    positions = playback.get_playback(bucket, len(buckets), operator_ids)
+
+    response = JsonResponse(
+        {
+            "buckets": [
+                get_playback_json(bucket, bucket_positions, bounds, service_ids)
+                for bucket, bucket_positions in zip(buckets, positions)
+            ]
+        }
+    )
+    if last + playback.BUCKET < now:
+        cache_control = "public, max-age=3600"
+    else:
+        cache_control = "public, max-age=5"
+    response["Cache-Control"] = response["CDN-Cache-Control"] = cache_control
+    return response
+
 
 def get_dates(vehicle=None, service=None):
     if not vehicle:
@@ -589,20 +923,10 @@ def journeys_list(request, journeys, service=None, vehicle=None) -> dict:
 
     context["journeys"] = journeys = list(journeys)
 
-    # annotate journeys with whether each one has some location history in redis
+    # annotate journeys with whether each one has some location history
     # (in order to show the "Map" link or not)
-    if redis_client:
-        try:
-            pipe = redis_client.pipeline(transaction=False)
-            for journey in journeys:
-                pipe.exists(journey.get_redis_key())
-
-            locations = pipe.execute()
-        except (ConnectionError, AttributeError):
-            pass
-        else:
-            for journey, location in zip(journeys, locations):
-                journey.locations = bool(location)
+    for journey, locations in zip(journeys, history.has_locations(journeys)):
+        journey.locations = locations
 
     # "Track this bus" button
     if vehicle and vehicle.latest_journey_id:
@@ -1003,45 +1327,11 @@ def journey_json(request, pk, vehicle_id=None, service_id=None):
         "current": journey.vehicle and journey.id == journey.vehicle.latest_journey_id,
     }
 
-    if redis_client:
-        locations = redis_client and redis_client.lrange(journey.get_redis_key(), 0, -1)
-    else:
-        locations = None
+    locations = history.get_locations(journey)
 
     if locations:
-        locations = [
-            VehicleLocation.decode_appendage(location) for location in locations
-        ]
-        locations.sort(key=lambda location: location["datetime"])
-
-        data["locations"] = []
-
-        stationary = False
-        previous = None
-        previous_latlong = None
-        for location in locations:
-            latlong = Point(location["coordinates"])
-
-            if previous_latlong:
-                distance = latlong.distance(previous_latlong)
-                if distance < 0.0005:
-                    stationary = True
-                elif stationary:
-                    # mark end of stationary period
-                    data["locations"].append(previous)
-                    stationary = False
-
-            if not stationary:
-                data["locations"].append(location)
-
-                previous_latlong = latlong
-
-            previous = location
-
-        if stationary:  # add last location
-            data["locations"].append(location)
-
-        del locations
+        locations = history.remove_stationary(history.decode_locations(locations))
+        data["locations"] = history.locations_json(locations)
 
     # if not trip - calculate using time and first location?
     # if not trip:
@@ -1086,32 +1376,39 @@ def journey_json(request, pk, vehicle_id=None, service_id=None):
                 }
             )
 
-    if "stops" in data and "locations" in data:
+    stop_events = None
+    if "stops" in data:
+        # recorded by the live importer as the vehicle went along
+        # (see rtpi.Segments.get_stop_events)
+        stop_events = history.get_stop_events(journey)
+        for stop in data["stops"]:
+            if stop["id"] in stop_events:
+                stop["actual_departure_time"] = stop_events[stop["id"]]
+
+    if "stops" in data and "locations" in data and not stop_events:
+        # work it out from the locations instead
         # only stops with coordinates
         stops = [stop for stop in data["stops"] if stop["coordinates"]]
         if stops:
             stop_coords = [stop["coordinates"][::-1] for stop in stops]
-            vehicle_coords = [
-                location["coordinates"][::-1] for location in data["locations"]
-            ]
+            vehicle_coords = np.column_stack((locations["y"], locations["x"]))
             try:
-                haversine_vector_results = haversine_vector(
+                distances = haversine_vector(
                     stop_coords,
                     vehicle_coords,
                     Unit.METERS,
                     comb=True,
-                )
+                )  # (locations, stops)
             except ValueError as e:
                 logging.exception(e)
             else:
-                for distances, location in zip(
-                    haversine_vector_results, data["locations"]
-                ):
-                    distance, nearest_stop = min(
-                        zip(distances, stops), key=lambda x: x[0]
-                    )
-                    if distance < 100:
-                        nearest_stop["actual_departure_time"] = location["datetime"]
+                nearest = distances.argmin(axis=1)
+                near = distances[np.arange(len(nearest)), nearest] < STOP_RADIUS
+                # (in time order, so the last time at each stop wins)
+                for i in np.flatnonzero(near).tolist():
+                    stops[nearest[i]]["actual_departure_time"] = data["locations"][i][
+                        "datetime"
+                    ]
 
     if vehicle_id:
         next_previous_filter = {"vehicle_id": vehicle_id}
@@ -1192,16 +1489,14 @@ def siri_post(request, uuid):
     get_object_or_404(SiriSubscription, uuid=uuid)
 
     if request.method == "GET":
-        return HttpResponse(
-            cache.get("last_siri_post")["body"], content_type="text/xml"
-        )
-
-    body = request.body.decode()
-    data = xmltodict.parse(body, force_list=["VehicleActivity"])
+        # the latest delivery handled
+        return HttpResponse(siri_queue.get_last(uuid) or b"", content_type="text/xml")
 
-    handle_siri_post(uuid, data)
-
-    cache.set("last_siri_post", {"headers": request.headers, "body": body})
+    # parse it later (see siri_queue)
+    if not redis_client:
+        handle_siri_post(uuid, [request.body])
+    elif siri_queue.enqueue(uuid, request.body):
+        handle_siri_post.schedule((uuid,), delay=siri_queue.WINDOW)
 
     return HttpResponse("")
 
@@ -1232,19 +1527,7 @@ def overland(request, uuid):
             },
         }
 
-        handle_siri_post(
-            uuid,
-            {
-                "Siri": {
-                    "ServiceDelivery": {
-                        "ResponseTimestamp": when,
-                        "VehicleMonitoringDelivery": {
-                            "VehicleActivity": [activity],
-                        },
-                    }
-                }
-            },
-        )
+        handle_overland_post(uuid, {"ResponseTimestamp": when}, [activity])
 
     # https://github.com/aaronpk/Overland-iOS#api
     return JsonResponse({"result": "ok"})
\ No newline at end of file